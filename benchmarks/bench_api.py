@@ -0,0 +1,318 @@
+"""Latency and throughput of the API endpoints, compared against a baseline.
+
+Seeds a temporary SQLite database with ``--users`` mailboxes of
+``--messages-per-user`` messages, texts between the two ``--text-sizes``, then
+runs every scenario with ``--concurrency`` clients:
+
+- get_full: ``GET /users/<user>/messages?get_old_messages=true``
+- get_page: the same, a random page of ``--page-size`` messages
+- get_new: ``GET /users/<user>/messages``, new messages only
+- post: ``POST /users/<user>/messages``
+- delete: ``DELETE /users/<user>/messages/<id>`` of seeded messages
+- search: ``GET /users/<user>/messages/search?q=<word>``, a page of ``--page-size``
+
+Requests go through ``app.test_client()`` (``client``, the app alone) and over
+HTTP to gunicorn with ``--server-workers`` workers (``server``, what clients
+get). Results, requests/s and p50/p95/p99 latencies in ms, are printed as JSON
+(and written to ``--output``). With a ``--baseline`` from an earlier
+``--output`` the run fails when a scenario got slower than ``--tolerance``.
+
+    $ python benchmarks/bench_api.py --output baseline.json
+    $ python benchmarks/bench_api.py --baseline baseline.json
+
+Texts are words of a ``--vocabulary`` words long vocabulary, skewed so a few
+are common, searching many mailboxes or a large one:
+
+    $ python benchmarks/bench_api.py --users 1000 --messages-per-user 300 --modes client --scenarios search
+    $ python benchmarks/bench_api.py --users 1 --messages-per-user 1000000 --modes client --scenarios search
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ['get_full', 'get_page', 'get_new', 'post', 'delete', 'search']
+MODES = ['client', 'server']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--messages-per-user', type=int, default=100)
+    parser.add_argument('--text-sizes', type=int, nargs=2, default=[20, 200], metavar=('MIN', 'MAX'))
+    parser.add_argument('--vocabulary', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per scenario.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--server-workers', type=int, default=2)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline, 0.2 is 20%% fewer requests/s or a 20%% higher p95.')
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{directory.name}/messages.db'
+    os.environ.setdefault('SQLITE_PROFILE', 'concurrent')
+
+    from message_api import create_app
+    app = create_app('production')
+    app.logger.disabled = True
+
+    results = {
+        'settings': {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')},
+        'results': {},
+    }
+    for mode in args.modes:
+        seeded = seed(app, args, mode)
+        if mode == 'client':
+            results['results'][mode] = run_scenarios(args, TestClientTransport(seeded.app), seeded)
+        else:
+            with GunicornServer(args.server_workers) as server:
+                results['results'][mode] = run_scenarios(args, HttpTransport(server.port), seeded)
+    directory.cleanup()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(json.load(baseline)['results'], results['results'], args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+class Seeded:
+    def __init__(self, app, users, message_ids):
+        self.app = app
+        self.users = users
+        # user -> ids of the seeded messages not deleted yet
+        self.message_ids = message_ids
+
+
+def seed(app, args, mode):
+    """Empty the database and fill the mailboxes, every mode starts from the same data."""
+    random.seed(0)
+    users = [f'user_{i}' for i in range(args.users)]
+    with app.app_context():
+        from message_api.sqlalquemy_store import db, add_messages
+        with db.engine.begin() as connection:
+            for table in reversed(db.Model.metadata.sorted_tables):
+                if table.name != 'schema_version':
+                    connection.execute(table.delete())
+        messages = [(random.choice(users), user, _text(args))
+                    for user in users for _ in range(args.messages_per_user)]
+        stored = add_messages(messages)
+
+    message_ids = {user: [] for user in users}
+    for message in stored:
+        message_ids[message['target']].append(message['id'])
+    for ids in message_ids.values():
+        random.shuffle(ids)
+    print(f'{mode}: seeded {len(stored)} messages', file=sys.stderr)
+    return Seeded(app, users, message_ids)
+
+
+def _text(args, rng=random):
+    size = rng.randint(*args.text_sizes)
+    words = []
+    while sum(len(word) + 1 for word in words) < size:
+        words.append(_word(args, rng))
+    return ' '.join(words)[:size]
+
+
+def _word(args, rng):
+    # word n is about n times less frequent than word 1
+    return f'w{int(args.vocabulary ** rng.random())}'
+
+
+def run_scenarios(args, transport, seeded):
+    results = {}
+    for scenario in args.scenarios:
+        request = _scenario(scenario, args, seeded)
+        results[scenario] = run(request, transport, args.requests, args.concurrency)
+        print(f'{scenario}: {results[scenario]}', file=sys.stderr)
+    return results
+
+
+def _scenario(name, args, seeded):
+    """Function of a random number generator returning the (method, path, body) of a request."""
+    max_page = max(args.messages_per_user // args.page_size - 1, 0)
+    lock = threading.Lock()
+
+    def delete(rng):
+        with lock:
+            users = [user for user in seeded.users if seeded.message_ids[user]]
+            if not users:
+                return None
+            user = rng.choice(users)
+            return 'DELETE', f'/users/{user}/messages/{seeded.message_ids[user].pop()}', None
+
+    return {
+        'get_full': lambda rng: ('GET', f'/users/{rng.choice(seeded.users)}/messages?get_old_messages=true', None),
+        'get_page': lambda rng: (
+            'GET', f'/users/{rng.choice(seeded.users)}/messages?get_old_messages=true'
+                   f'&page={rng.randint(0, max_page)}&page_size={args.page_size}', None),
+        'get_new': lambda rng: ('GET', f'/users/{rng.choice(seeded.users)}/messages', None),
+        'post': lambda rng: ('POST', f'/users/{rng.choice(seeded.users)}/messages',
+                             json.dumps({'user_id': rng.choice(seeded.users), 'text': _text(args, rng)})),
+        'delete': delete,
+        'search': lambda rng: (
+            'GET', f'/users/{rng.choice(seeded.users)}/messages/search?q={_word(args, rng)}'
+                   f'&page_size={args.page_size}', None),
+    }[name]
+
+
+def run(request, transport, requests, concurrency):
+    """Send ``requests`` requests from ``concurrency`` threads, returns requests/s and latencies in ms."""
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def client(number):
+        rng = random.Random(number)
+        client_latencies, client_errors = [], 0
+        while next(counter) < requests:
+            method_path_body = request(rng)
+            if method_path_body is None:
+                break
+            started = time.perf_counter()
+            status = transport.request(*method_path_body)
+            client_latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                client_errors += 1
+        with lock:
+            latencies.extend(client_latencies)
+            errors[0] += client_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': _percentile(latencies, 50),
+        'p95_ms': _percentile(latencies, 95),
+        'p99_ms': _percentile(latencies, 99),
+    }
+
+
+def _percentile(latencies, percent):
+    if not latencies:
+        return None
+    return round(latencies[min(len(latencies) * percent // 100, len(latencies) - 1)] * 1000, 3)
+
+
+def compare(baseline, results, tolerance):
+    """Descriptions of the scenarios slower than in ``baseline``."""
+    regressions = []
+    for mode, scenarios in results.items():
+        for scenario, result in scenarios.items():
+            before = baseline.get(mode, {}).get(scenario)
+            if not before or not result['requests']:
+                continue
+
+            if result['requests_per_second'] < before['requests_per_second'] * (1 - tolerance):
+                regressions.append(f'{mode} {scenario}: {result["requests_per_second"]} requests/s, '
+                                   f'baseline {before["requests_per_second"]}')
+            if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                regressions.append(f'{mode} {scenario}: p95 {result["p95_ms"]} ms, baseline {before["p95_ms"]}')
+    return regressions
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body):
+        test_client = getattr(self._local, 'client', None)
+        if test_client is None:
+            test_client = self._local.client = self._app.test_client()
+        return test_client.open(path, method=method, data=body, content_type='application/json').status_code
+
+
+class HttpTransport:
+    """Keeps one connection per thread."""
+
+    def __init__(self, port):
+        self._port = port
+        self._local = threading.local()
+
+    def request(self, method, path, body):
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPConnection('127.0.0.1', self._port)
+            try:
+                connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed the kept alive connection
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+
+class GunicornServer:
+    def __init__(self, workers):
+        self.workers = workers
+        self.port = _free_port()
+        self._process = None
+
+    def __enter__(self):
+        env = dict(os.environ, PORT=str(self.port), WSGI_WORKERS=str(self.workers))
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                if HttpTransport(self.port).request('GET', '/health/live', None) == 200:
+                    return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__()
+        raise RuntimeError('gunicorn did not start')
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.wait()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Mailbox read latency as the message table grows.
+
+Seeds a temporary SQLite database in steps and times ``get_messages`` for a
+single user at every step. With the (target_key, id) index the read
+latency stays flat, run with ``--drop-indexes`` to compare against a full scan.
+
+    $ python benchmarks/bench_mailbox_read.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 500000])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--drop-indexes', action='store_true')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+
+    from message_api import create_app
+    app = create_app('production')
+
+    try:
+        with app.app_context():
+            from message_api.sqlalquemy_store import db, get_messages, UserMessageModel, _user_keys
+
+            if args.drop_indexes:
+                for index in UserMessageModel.__table__.indexes:
+                    index.drop(bind=db.engine)
+
+            print(f'{"rows":>10} {"paginated ms":>14} {"new only ms":>12}')
+            seeded = 0
+            start_time = datetime.utcnow()
+            keys = _user_keys(
+                db.session, ['sender_%d' % i for i in range(97)] + ['user_%d' % i for i in range(args.users)])
+            for size in sorted(args.sizes):
+                rows = [{
+                    'sender_key': keys['sender_%d' % (i % 97)],
+                    'target_key': keys['user_%d' % (i % args.users)],
+                    'text': 'message %d' % i,
+                    'sent_time': start_time + timedelta(microseconds=i),
+                } for i in range(seeded, size)]
+                db.session.execute(UserMessageModel.__table__.insert(), rows)
+                db.session.commit()
+                seeded = size
+
+                paginated = _time(args.repeat, lambda: get_messages(
+                    'user_1', get_old_messages=True, page=2, page_size=20))
+                new_only = _time(args.repeat, lambda: get_messages('user_2'))
+                print(f'{size:>10} {paginated:>14.3f} {new_only:>12.3f}')
+    finally:
+        os.remove(path)
+
+
+def _time(repeat, func):
+    func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) * 1000 / repeat
+
+
+if __name__ == '__main__':
+    main()
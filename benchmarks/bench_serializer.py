@@ -0,0 +1,78 @@
+"""Listing serialization cost, marshmallow path against the tuple fast path.
+
+Times loading and encoding one mailbox with:
+
+- marshmallow: ``UserMessageModel`` objects, ``user_messages_schema.dump`` and ``json.dumps``
+- fast path: core rows of the five columns, ``serialize_messages`` and ``json.dumps``
+- fast path with orjson, when it is installed
+
+    $ python benchmarks/bench_serializer.py --messages 5000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    from message_api import create_app
+    app = create_app('testing')
+
+    with app.app_context():
+        from message_api.sqlalquemy_store import (
+            db, UserMessageModel, user_messages_schema, serialize_messages, _message_columns, _user_keys)
+
+        start_time = datetime.utcnow()
+        keys = _user_keys(db.session, ['norbert'] + ['sender_%d' % i for i in range(97)])
+        db.session.execute(UserMessageModel.__table__.insert(), [{
+            'sender_key': keys['sender_%d' % (i % 97)],
+            'target_key': keys['norbert'],
+            'text': 'message text number %d' % i,
+            'sent_time': start_time + timedelta(microseconds=i),
+        } for i in range(args.messages)])
+        db.session.commit()
+
+        def marshmallow_path():
+            messages = UserMessageModel.query.filter_by(target_key=keys['norbert']).all()
+            json.dumps(user_messages_schema.dump(messages))
+            db.session.expunge_all()
+
+        def fast_path(dumps=json.dumps):
+            rows = db.session.execute(
+                db.session.query(*_message_columns('norbert'))
+                .filter(UserMessageModel.target_key == keys['norbert']).statement)
+            dumps(serialize_messages(rows))
+
+        results = [('marshmallow', _time(args.repeat, marshmallow_path)),
+                   ('fast path', _time(args.repeat, fast_path))]
+        try:
+            import orjson
+            results.append(('fast path + orjson', _time(args.repeat, lambda: fast_path(orjson.dumps))))
+        except ImportError:
+            pass
+
+    baseline = results[0][1]
+    print(f'{args.messages} messages')
+    for name, elapsed in results:
+        print(f'{name:>20} {elapsed:>9.2f} ms {baseline / elapsed:>6.1f}x')
+
+
+def _time(repeat, func):
+    func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) * 1000 / repeat
+
+
+if __name__ == '__main__':
+    main()
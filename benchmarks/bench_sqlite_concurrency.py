@@ -0,0 +1,114 @@
+"""Throughput of concurrent posts and reads on a SQLite file, by SQLite profile.
+
+Every profile runs in its own interpreter against a fresh temporary database.
+The app is created once and forked into ``--processes`` workers (like gunicorn
+with ``preload_app``), each running ``--threads`` clients for ``--duration``
+seconds. Clients post messages to random users and read their own unread
+messages, which moves the read marker, so half the requests write. Failed
+requests are mostly "database is locked" errors.
+
+    $ python benchmarks/bench_sqlite_concurrency.py --processes 4 --threads 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROFILES = ['default', 'concurrent']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=PROFILES)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--run-profile', choices=PROFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_profile:
+        print(json.dumps(run(args)))
+        return
+
+    print(f'{args.processes} processes x {args.threads} threads, {args.duration}s')
+    print(f'{"profile":>12} {"requests/s":>12} {"failed":>8} {"p99 ms":>8}')
+    for profile in args.profiles:
+        output = subprocess.run(
+            [sys.executable, __file__, '--run-profile', profile] + sys.argv[1:],
+            check=True, stdout=subprocess.PIPE).stdout
+        result = json.loads(output.decode().splitlines()[-1])
+        print(f'{profile:>12} {result["ok"] / args.duration:>12.0f} {result["failed"]:>8} {result["p99"]:>8.1f}')
+
+
+def run(args):
+    directory = tempfile.TemporaryDirectory()
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{directory.name}/messages.db'
+    os.environ['SQLITE_PROFILE'] = args.run_profile
+
+    from message_api import create_app
+    app = create_app('production')
+    app.logger.disabled = True
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_worker, args=(app, args, results)) for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    counts = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    directory.cleanup()
+
+    latencies = sorted(latency for _, _, worker_latencies in counts for latency in worker_latencies)
+    return {
+        'ok': sum(ok for ok, _, _ in counts),
+        'failed': sum(failed for _, failed, _ in counts),
+        'p99': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+    }
+
+
+def _worker(app, args, results):
+    deadline = time.monotonic() + args.duration
+    lock = threading.Lock()
+    counts = [0, 0, []]
+
+    def client():
+        test_client = app.test_client()
+        ok, failed, latencies = 0, 0, []
+        while time.monotonic() < deadline:
+            user = f'user_{random.randrange(args.users)}'
+            started = time.perf_counter()
+            if random.random() < 0.5:
+                response = test_client.post(f'/users/user_{random.randrange(args.users)}/messages',
+                                            data=json.dumps({'user_id': user, 'text': 'hello'}),
+                                            content_type='application/json')
+            else:
+                response = test_client.get(f'/users/{user}/messages')
+            latencies.append(time.perf_counter() - started)
+            if response.status_code < 400:
+                ok += 1
+            else:
+                failed += 1
+        with lock:
+            counts[0] += ok
+            counts[1] += failed
+            counts[2] += latencies
+
+    threads = [threading.Thread(target=client) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(tuple(counts))
+
+
+if __name__ == '__main__':
+    main()
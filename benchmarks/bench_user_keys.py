@@ -0,0 +1,134 @@
+"""Size and mailbox read latency of messages with user id strings against interned user keys.
+
+Seeds a temporary SQLite file with the messages table of older versions,
+sender and target user id strings indexed by (target, id), and times reading
+a page of a mailbox. Then the app upgrades the file in place (see migration 7
+in message_api/migrations.py), messages reference their users by integer key
+and the same pages are read again, senders resolved to strings by primary
+key. Sizes are measured after a VACUUM, with the dbstat virtual table.
+
+    $ python benchmarks/bench_user_keys.py --messages 1000000 --users 10000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STRINGS_SCHEMA = (
+    'CREATE TABLE user_message_model ('
+    ' id INTEGER NOT NULL PRIMARY KEY, sender VARCHAR(100) NOT NULL, target VARCHAR(100) NOT NULL,'
+    ' text TEXT NOT NULL, sent_time DATETIME NOT NULL)',
+    'CREATE INDEX ix_user_message_model_target_id ON user_message_model (target, id)',
+    'CREATE TABLE user_model ('
+    ' id INTEGER NOT NULL PRIMARY KEY, user_id VARCHAR(100) NOT NULL UNIQUE,'
+    ' last_message_read_timestamp DATETIME, last_message_read_id INTEGER,'
+    ' message_count INTEGER NOT NULL DEFAULT 0, unread_count INTEGER NOT NULL DEFAULT 0,'
+    ' mailbox_version INTEGER NOT NULL DEFAULT 0)',
+    'CREATE INDEX ix_user_model_user_id ON user_model (user_id)',
+    'CREATE TABLE schema_version (version INTEGER NOT NULL PRIMARY KEY)',
+    'INSERT INTO schema_version (version) VALUES (6)',
+)
+
+STRINGS_PAGE = ('SELECT id, sender, target, text, sent_time FROM user_message_model'
+                ' WHERE target = :key ORDER BY id LIMIT :limit OFFSET :offset')
+# the statement of _mailbox_query, the key comes from the cache of the store and the target is bound
+KEYS_PAGE = ('SELECT m.id, (SELECT user_id FROM user_model WHERE id = m.sender_key) AS sender,'
+             ' :target AS target, m.text, m.sent_time'
+             ' FROM user_message_model m WHERE m.target_key = :key ORDER BY m.id LIMIT :limit OFFSET :offset')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # user ids as clients tend to pick them
+    users = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(args.users)]
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(path)
+        seed(connection, args, rng, users)
+        strings = measure(connection, args, rng, STRINGS_PAGE, {user: user for user in users})
+        connection.close()
+
+        os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        started = time.perf_counter()
+        from message_api import create_app
+        create_app('production')
+        migration = time.perf_counter() - started
+
+        connection = sqlite3.connect(path)
+        keys = dict(connection.execute('SELECT user_id, id FROM user_model'))
+        interned = measure(connection, args, rng, KEYS_PAGE, keys)
+        connection.close()
+    finally:
+        os.remove(path)
+
+    print(f'{args.messages} messages to {args.users} users, upgraded in {migration:.1f} s')
+    print(f'{"":>8} {"table MB":>9} {"index MB":>9} {"file MB":>8} {"p50 ms":>7} {"p95 ms":>7}')
+    for name, result in (('strings', strings), ('keys', interned)):
+        print(f'{name:>8} {result["table"] / 2 ** 20:>9.1f} {result["index"] / 2 ** 20:>9.1f}'
+              f' {result["file"] / 2 ** 20:>8.1f} {result["p50"]:>7.3f} {result["p95"]:>7.3f}')
+
+
+def seed(connection, args, rng, users):
+    for statement in STRINGS_SCHEMA:
+        connection.execute(statement)
+    connection.executemany('INSERT INTO user_model (user_id) VALUES (?)', [(user,) for user in users])
+
+    start_time = datetime.utcnow() - timedelta(days=1)
+    batch = 10000
+    for start in range(0, args.messages, batch):
+        connection.executemany('INSERT INTO user_message_model VALUES (?, ?, ?, ?, ?)', [
+            (i + 1, rng.choice(users), users[i % len(users)], f'message {i}',
+             (start_time + timedelta(microseconds=i)).isoformat(' '))
+            for i in range(start, min(start + batch, args.messages))])
+    connection.commit()
+
+
+def measure(connection, args, rng, statement, keys):
+    """Sizes and read latency of pages of random mailboxes."""
+    connection.execute('VACUUM')
+    sizes = dict(connection.execute(
+        "SELECT name, SUM(pgsize) FROM dbstat WHERE name LIKE 'user_message_model%'"
+        " OR name LIKE 'ix_user_message_model%' GROUP BY name"))
+    page_count, = connection.execute('PRAGMA page_count').fetchone()
+    page_size, = connection.execute('PRAGMA page_size').fetchone()
+
+    mailbox_size = args.messages // len(keys)
+    user_ids = list(keys)
+    timings = []
+    for _ in range(args.repeat):
+        user_id = rng.choice(user_ids)
+        offset = rng.randrange(max(mailbox_size - args.page_size, 1))
+        started = time.perf_counter()
+        connection.execute(
+            statement, {'target': user_id, 'key': keys[user_id], 'limit': args.page_size, 'offset': offset}).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+
+    return {
+        'table': sizes.get('user_message_model', 0),
+        'index': sum(size for name, size in sizes.items() if name.startswith('ix_')),
+        'file': page_count * page_size,
+        'p50': timings[len(timings) // 2],
+        'p95': timings[int(len(timings) * 0.95)],
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+from multiprocessing import cpu_count
 from os import environ, path
 from dotenv import load_dotenv
 
@@ -16,9 +17,153 @@ class Config:
     # Database
     SQLALCHEMY_DATABASE_URI = environ.get("SQLALCHEMY_DATABASE_URI")
 
+    # comma separated <shard number>=<uri>, mailboxes are spread over these databases, see message_api/shards.py
+    SQLALCHEMY_SHARDS = dict(
+        shard.split('=', 1) for shard in environ.get('SQLALCHEMY_SHARDS', '').split(',') if shard)
+    # points of every shard on the hash ring, more points spread mailboxes more evenly
+    SQLALCHEMY_SHARD_VNODES = int(environ.get('SQLALCHEMY_SHARD_VNODES', 64))
+    # comma separated, listings are read from these replicas of SQLALCHEMY_DATABASE_URI (when not sharded),
+    # see message_api/replicas.py
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in environ.get('SQLALCHEMY_REPLICA_URIS', '').split(',') if uri]
+    # seconds a failed replica is skipped
+    DATABASE_REPLICA_RETRY_AFTER = float(environ.get('DATABASE_REPLICA_RETRY_AFTER', 30))
+    # seconds the reads of a mailbox stay on the primary after a write to it, should exceed the replication lag
+    DATABASE_READ_AFTER_WRITE_WINDOW = float(environ.get('DATABASE_READ_AFTER_WRITE_WINDOW', 5))
+    DATABASE_READ_AFTER_WRITE_MAX_USERS = int(environ.get('DATABASE_READ_AFTER_WRITE_MAX_USERS', 10000))
+
     SQLALCHEMY_ECHO = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Connection pool, per worker process, see message_api/engines.py
+    DATABASE_POOL_SIZE = int(environ.get('DATABASE_POOL_SIZE', 10))
+    DATABASE_MAX_OVERFLOW = int(environ.get('DATABASE_MAX_OVERFLOW', 10))
+    # seconds to wait for a connection when the pool is exhausted
+    DATABASE_POOL_TIMEOUT = float(environ.get('DATABASE_POOL_TIMEOUT', 10))
+    DATABASE_POOL_RECYCLE = int(environ.get('DATABASE_POOL_RECYCLE', 1800))
+    DATABASE_POOL_PRE_PING = environ.get('DATABASE_POOL_PRE_PING', 'true').lower() == 'true'
+    # seconds SQLite waits for a lock held by another connection before failing with "database is locked"
+    SQLITE_BUSY_TIMEOUT = float(environ.get('SQLITE_BUSY_TIMEOUT', 5))
+    # [default|concurrent] 'concurrent' enables WAL and the pragmas below on every connection, and sends
+    # every write through a single writer connection, see message_api/engines.py
+    SQLITE_PROFILE = environ.get('SQLITE_PROFILE', 'default')
+    SQLITE_SYNCHRONOUS = environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    # negative values are in KiB
+    SQLITE_CACHE_SIZE = int(environ.get('SQLITE_CACHE_SIZE', -64000))
+    SQLITE_MMAP_SIZE = int(environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+    # WSGI server, see gunicorn.conf.py
+    WSGI_WORKERS = int(environ.get('WSGI_WORKERS', cpu_count()))
+    WSGI_THREADS = int(environ.get('WSGI_THREADS', 8))
+    # 'gthread' or 'gevent' (pip install gevent) when many clients wait on pushed messages
+    WSGI_WORKER_CLASS = environ.get('WSGI_WORKER_CLASS', 'gthread')
+    WSGI_TIMEOUT = int(environ.get('WSGI_TIMEOUT', 30))
+    WSGI_KEEPALIVE = int(environ.get('WSGI_KEEPALIVE', 5))
+    # restart workers after this many requests, 0 to never restart them
+    WSGI_MAX_REQUESTS = int(environ.get('WSGI_MAX_REQUESTS', 0))
+
+    # compression of responses the client accepts compressed, see message_api/compression.py
+    COMPRESSION_ENABLED = environ.get('COMPRESSION_ENABLED', 'true').lower() == 'true'
+    # smaller responses are sent as they are, streamed ones are always compressed
+    COMPRESSION_MIN_SIZE = int(environ.get('COMPRESSION_MIN_SIZE', 1024))
+    COMPRESSION_GZIP_LEVEL = int(environ.get('COMPRESSION_GZIP_LEVEL', 6))
+    # zstd and brotli are used when the zstandard and brotli packages are installed
+    COMPRESSION_ZSTD_LEVEL = int(environ.get('COMPRESSION_ZSTD_LEVEL', 3))
+    COMPRESSION_BROTLI_LEVEL = int(environ.get('COMPRESSION_BROTLI_LEVEL', 4))
+    # largest gzip request body once decompressed
+    COMPRESSION_MAX_REQUEST_SIZE = int(environ.get('COMPRESSION_MAX_REQUEST_SIZE', 16 * 1024 * 1024))
+
+    # database probes of /health/ready and /healthcheck run every HEALTHCHECK_INTERVAL seconds in the
+    # background, results older than HEALTHCHECK_TTL seconds fail, see message_api/probes.py
+    HEALTHCHECK_INTERVAL = float(environ.get('HEALTHCHECK_INTERVAL', 5))
+    HEALTHCHECK_TTL = float(environ.get('HEALTHCHECK_TTL', 15))
+    # share of a connection pool in use above which the database is not ready
+    HEALTHCHECK_MAX_POOL_SATURATION = float(environ.get('HEALTHCHECK_MAX_POOL_SATURATION', 0.9))
+    # seconds
+    HEALTHCHECK_MAX_WRITE_LATENCY = float(environ.get('HEALTHCHECK_MAX_WRITE_LATENCY', 1))
+    HEALTHCHECK_MAX_REPLICA_LAG = float(environ.get('HEALTHCHECK_MAX_REPLICA_LAG', 30))
+
+    # request timing, SQL and queue metrics on /metrics, see message_api/metrics.py
+    METRICS_ENABLED = environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    # requests taking longer are logged with their SQL statements, 0 to log none
+    METRICS_SLOW_REQUEST_MS = float(environ.get('METRICS_SLOW_REQUEST_MS', 500))
+    METRICS_SLOW_REQUEST_MAX_SQL = int(environ.get('METRICS_SLOW_REQUEST_MAX_SQL', 50))
+
+    # admission control of requests, see message_api/admission.py, 0 turns a limit off
+    # requests per second and burst of every user (the user of the URL, or else the client address)
+    ADMISSION_USER_RATE = float(environ.get('ADMISSION_USER_RATE', 0))
+    ADMISSION_USER_BURST = int(environ.get('ADMISSION_USER_BURST', 20))
+    # comma separated <route>=<requests per second>:<burst> of all users together, ex: /messages/bulk=20:40
+    ADMISSION_ROUTE_RATES = dict(
+        route.rsplit('=', 1) for route in environ.get('ADMISSION_ROUTE_RATES', '').split(',') if route)
+    # requests run at once by a worker process, about the size of its connection pool
+    ADMISSION_MAX_IN_FLIGHT = int(environ.get('ADMISSION_MAX_IN_FLIGHT', 0))
+    # requests that would wait longer for a token or a slot are rejected with 429 or 503
+    ADMISSION_MAX_QUEUE_DELAY_MS = float(environ.get('ADMISSION_MAX_QUEUE_DELAY_MS', 50))
+    # 'memory' or the import path of a factory called with the app config
+    ADMISSION_BACKEND = environ.get('ADMISSION_BACKEND', 'memory')
+    ADMISSION_MAX_KEYS = int(environ.get('ADMISSION_MAX_KEYS', 100000))
+
+    # messages past these retention policies are purged, 0 turns a policy off, see message_api/retention.py
+    RETENTION_MAX_AGE_DAYS = float(environ.get('RETENTION_MAX_AGE_DAYS', 0))
+    RETENTION_MAX_MESSAGES_PER_USER = int(environ.get('RETENTION_MAX_MESSAGES_PER_USER', 0))
+    # read messages are deleted this many days after they were sent
+    RETENTION_READ_MAX_AGE_DAYS = float(environ.get('RETENTION_READ_MAX_AGE_DAYS', 0))
+    # whether this instance purges in the background, in one of its processes (see gunicorn.conf.py)
+    RETENTION_ENABLED = environ.get('RETENTION_ENABLED', 'true').lower() == 'true'
+    # seconds between purges in the background, 0 purges only with `flask purge-messages`
+    RETENTION_INTERVAL = float(environ.get('RETENTION_INTERVAL', 3600))
+    RETENTION_BATCH_SIZE = int(environ.get('RETENTION_BATCH_SIZE', 500))
+    # other writes to the database go in between batches
+    RETENTION_BATCH_PAUSE_MS = float(environ.get('RETENTION_BATCH_PAUSE_MS', 50))
+    # '' only deletes, 'table' moves messages to user_message_archive_model, 'ndjson' appends them to the file
+    RETENTION_ARCHIVE = environ.get('RETENTION_ARCHIVE', '')
+    RETENTION_ARCHIVE_PATH = environ.get('RETENTION_ARCHIVE_PATH', 'messages-archive.ndjson')
+
+    # Messages API
+    # node id of the message ids generated by this instance, see message_api/ids.py, gunicorn workers
+    # use MESSAGES_ID_NODE + 0 to MESSAGES_ID_NODE + WSGI_WORKERS - 1, every instance needs its own range
+    MESSAGES_ID_NODE = int(environ.get('MESSAGES_ID_NODE', 0))
+    MESSAGES_MAX_PAGE_SIZE = int(environ.get('MESSAGES_MAX_PAGE_SIZE', 100))
+    # with true GET never marks messages as read, clients acknowledge them on /users/<user_id>/messages/read
+    MESSAGES_READ_ONLY_GET = environ.get('MESSAGES_READ_ONLY_GET', 'false').lower() == 'true'
+    # rows fetched at a time when streaming listings
+    MESSAGES_STREAM_BATCH_SIZE = int(environ.get('MESSAGES_STREAM_BATCH_SIZE', 500))
+    # [json|orjson] orjson output is compact, see message_api/representations.py
+    MESSAGES_JSON_ENCODER = environ.get('MESSAGES_JSON_ENCODER', 'json')
+    # cache of unread messages, see message_api/cache.py
+    # 'memory' or the import path of a factory called with the app config, empty to disable
+    MESSAGES_CACHE = environ.get('MESSAGES_CACHE', '')
+    MESSAGES_CACHE_TTL = float(environ.get('MESSAGES_CACHE_TTL', 10))
+    MESSAGES_CACHE_MAX_USERS = int(environ.get('MESSAGES_CACHE_MAX_USERS', 10000))
+    MESSAGES_CACHE_MAX_BYTES = int(environ.get('MESSAGES_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    MESSAGES_CACHE_MAX_UNREAD = int(environ.get('MESSAGES_CACHE_MAX_UNREAD', 1000))
+    # push delivery of new messages, see message_api/notifications.py
+    # 'memory' or the import path of a factory called with the app config
+    MESSAGES_NOTIFICATION_HUB = environ.get('MESSAGES_NOTIFICATION_HUB', 'memory')
+    MESSAGES_NOTIFICATION_BUFFER_SIZE = int(environ.get('MESSAGES_NOTIFICATION_BUFFER_SIZE', 100))
+    MESSAGES_NOTIFICATION_MAX_USERS = int(environ.get('MESSAGES_NOTIFICATION_MAX_USERS', 10000))
+    MESSAGES_LONG_POLL_MAX_WAIT = float(environ.get('MESSAGES_LONG_POLL_MAX_WAIT', 30))
+    MESSAGES_SSE_KEEPALIVE = float(environ.get('MESSAGES_SSE_KEEPALIVE', 15))
+    # server-sent event streams are closed after this many seconds, clients reconnect and resume
+    MESSAGES_SSE_MAX_DURATION = float(environ.get('MESSAGES_SSE_MAX_DURATION', 300))
+    MESSAGES_BULK_MAX_ITEMS = int(environ.get('MESSAGES_BULK_MAX_ITEMS', 10000))
+    MESSAGES_BULK_CHUNK_SIZE = int(environ.get('MESSAGES_BULK_CHUNK_SIZE', 1000))
+    # keys of user ids kept by every process, see message_api/user_keys.py
+    MESSAGES_USER_KEY_CACHE_SIZE = int(environ.get('MESSAGES_USER_KEY_CACHE_SIZE', 100000))
+    # searches rank the newest matches of a mailbox, see message_api/search.py
+    MESSAGES_SEARCH_CANDIDATES = int(environ.get('MESSAGES_SEARCH_CANDIDATES', 1000))
+
+    # Group commit of posted messages, see message_api/write_behind.py
+    # 'sync' posts wait until their group was committed, 'async' posts return 202 once queued
+    MESSAGES_WRITE_BEHIND = environ.get('MESSAGES_WRITE_BEHIND', 'false').lower() == 'true'
+    MESSAGES_WRITE_BEHIND_MODE = environ.get('MESSAGES_WRITE_BEHIND_MODE', 'sync')
+    MESSAGES_WRITE_BEHIND_BATCH_SIZE = int(environ.get('MESSAGES_WRITE_BEHIND_BATCH_SIZE', 100))
+    MESSAGES_WRITE_BEHIND_MAX_LINGER_MS = float(environ.get('MESSAGES_WRITE_BEHIND_MAX_LINGER_MS', 5))
+    MESSAGES_WRITE_BEHIND_QUEUE_SIZE = int(environ.get('MESSAGES_WRITE_BEHIND_QUEUE_SIZE', 10000))
+    # how long a post waits for room on a full queue before being rejected with 503
+    MESSAGES_WRITE_BEHIND_ENQUEUE_TIMEOUT_MS = float(environ.get('MESSAGES_WRITE_BEHIND_ENQUEUE_TIMEOUT_MS', 100))
+    MESSAGES_WRITE_BEHIND_WAIT_TIMEOUT = float(environ.get('MESSAGES_WRITE_BEHIND_WAIT_TIMEOUT', 5))
+
 
 class DevelopmentConfig(Config):
     """Configurations for Development."""
@@ -31,6 +176,9 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'  # run in memory
     DEBUG = True
+    # the in memory database has one connection per thread, probe in the polling one
+    HEALTHCHECK_INTERVAL = 0
+    RETENTION_INTERVAL = 0
 
 
 class ProductionConfig(Config):
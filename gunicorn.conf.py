@@ -0,0 +1,45 @@
+"""gunicorn settings, taken from config.py
+
+    $ gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import itertools
+import os
+from os import environ
+
+from config import app_config
+
+_config = app_config[environ.get('CONFIG_NAME', 'production')]
+
+bind = f"0.0.0.0:{environ.get('PORT', 8080)}"
+workers = _config.WSGI_WORKERS
+threads = _config.WSGI_THREADS
+worker_class = _config.WSGI_WORKER_CLASS
+timeout = _config.WSGI_TIMEOUT
+keepalive = _config.WSGI_KEEPALIVE
+max_requests = _config.WSGI_MAX_REQUESTS
+max_requests_jitter = max_requests // 10
+
+# the app is created, and the schema upgraded, once in the master before forking
+# the workers, database connections are not shared with them (see message_api/engines.py)
+preload_app = True
+
+accesslog = '-'
+
+
+def pre_fork(server, worker):
+    # every worker generates message ids with its own node id, MESSAGES_ID_NODE + its slot,
+    # a worker replacing one that exited takes over its slot
+    taken = {getattr(other, 'id_slot', None) for other in server.WORKERS.values()}
+    worker.id_slot = next(slot for slot in itertools.count() if slot not in taken)
+    # one worker purges messages past retention, a worker replacing it takes over
+    worker.purges = not any(getattr(other, 'purges', False) for other in server.WORKERS.values())
+
+
+def post_fork(server, worker):
+    os.environ['MESSAGES_ID_WORKER'] = str(worker.id_slot)
+
+
+def post_worker_init(worker):
+    if worker.purges:
+        from message_api.retention import start_retention
+        start_retention(worker.wsgi)
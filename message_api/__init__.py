@@ -10,6 +10,11 @@ def create_app(config_name):
     if not app.config.get("SQLALCHEMY_DATABASE_URI"):
         raise Exception("Environment variable SQLALCHEMY_DATABASE_URI must be defined")
 
+    from .engines import engine_options
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        engine_options(app.config, app.config['SQLALCHEMY_DATABASE_URI']),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
     from flask_restful import Api
     api = Api(app)
     setattr(app, 'api', api)
@@ -19,5 +24,10 @@ def create_app(config_name):
         from . import sqlalquemy_store
         from . import routes
         from . import healthcheck_routes
+        from . import admission
+        # request bodies are inflated after admission, shedding a request stays cheap
+        from . import compression
+        from . import retention
+        from . import commands
 
         return app
@@ -0,0 +1,245 @@
+"""Admission control of requests, to protect the latency of everyone from a few clients.
+
+Every request takes a token from the bucket of its user, the ``user_id`` of
+the URL or else the client address, refilled at ``ADMISSION_USER_RATE``
+requests per second up to ``ADMISSION_USER_BURST``, and from the bucket of its
+route when ``ADMISSION_ROUTE_RATES`` limits it, shared by every user. Then it
+takes one of the ``ADMISSION_MAX_IN_FLIGHT`` slots of the worker process, so
+no more requests run at once than the connection pool can serve.
+
+A request waits at most ``ADMISSION_MAX_QUEUE_DELAY_MS`` for its tokens and
+its slot, beyond that it fails fast: 429 when over a rate, 503 when the
+process is busy, with a ``Retry-After`` header either way. Health checks and
+/metrics are never limited, and requests waiting for new messages (poll and
+events) don't take a slot, they hold no connection while waiting.
+
+``AdmissionBackend`` is the interface a backend of token buckets implements,
+the in-process one limits every worker process on its own: with ``n``
+workers, a user gets up to ``n`` times its rate. A shared backend can be set
+as ``ADMISSION_BACKEND=package.module:factory``. Accepted and shed requests
+are counted on /metrics.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app as app, request, g
+from werkzeug.utils import import_string
+
+from message_api import metrics
+from message_api.representations import output_json
+
+# never limited, monitoring has to work under load
+EXEMPT_ENDPOINTS = {'liveness', 'readiness', 'healthcheck', 'environment', 'metrics', 'static'}
+# wait for new messages without a database connection
+WAITING_ENDPOINTS = {'messagepoll', 'messageevents'}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now, max_wait):
+        """Take a token, see ``AdmissionBackend.acquire``."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(1 - self.tokens, 0) / self.rate
+        if wait > max_wait:
+            return False, wait
+        # owed by the requests that wait, the bucket refills them first
+        self.tokens -= 1
+        return True, wait
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class AdmissionBackend:
+
+    def acquire(self, key, rate, burst, max_wait):
+        """Take a token from the bucket ``key``, refilled at ``rate`` tokens per second up to ``burst``.
+
+        Returns (True, seconds to wait before proceeding) when a token is
+        available within ``max_wait`` seconds, it is taken, else (False,
+        seconds until it would be available) and nothing is taken.
+        """
+        raise NotImplementedError
+
+    def refund(self, key):
+        """Give back a token taken from the bucket ``key`` by a request that was shed afterwards."""
+
+
+class InProcessAdmissionBackend(AdmissionBackend):
+    """Token buckets of this process, the ``max_keys`` last used ones, an evicted bucket starts full again."""
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, key, rate, burst, max_wait):
+        with self._lock:
+            now = self._clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket.rate, bucket.burst = rate, burst
+            return bucket.take(now, max_wait)
+
+    def refund(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.refund()
+
+
+class InFlightLimiter:
+    """At most ``max_in_flight`` requests of this process at once."""
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def acquire(self, timeout):
+        """Take a slot, waiting up to ``timeout`` seconds, returns whether it was taken."""
+        if not self._slots.acquire(timeout=max(timeout, 0)):
+            return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+
+def route_rates(config):
+    """{route: (requests per second, burst)} of the ``ADMISSION_ROUTE_RATES`` of ``config``."""
+    rates = {}
+    for route, limit in config['ADMISSION_ROUTE_RATES'].items():
+        rate, _, burst = limit.partition(':')
+        rates[route] = (float(rate), int(burst or math.ceil(float(rate))))
+    return rates
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _get_backend():
+    """The backend configured by ``ADMISSION_BACKEND``, 'memory' or the import path of a factory
+    called with the app config."""
+    global _backend
+    backend = app.config['ADMISSION_BACKEND']
+    with _backend_lock:
+        if _backend is None or _backend[0] != backend:
+            if backend == 'memory':
+                admission_backend = InProcessAdmissionBackend(max_keys=app.config['ADMISSION_MAX_KEYS'])
+            else:
+                admission_backend = import_string(backend)(app.config)
+            _backend = (backend, admission_backend)
+        return _backend[1]
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def _get_limiter():
+    """The in-flight limiter of this process, None without ``ADMISSION_MAX_IN_FLIGHT``."""
+    global _limiter
+    max_in_flight = app.config['ADMISSION_MAX_IN_FLIGHT']
+    if not max_in_flight:
+        return None
+
+    with _limiter_lock:
+        # slots taken in the parent process are not released in this one
+        if _limiter is None or _limiter.max_in_flight != max_in_flight or _limiter.pid != os.getpid():
+            _limiter = InFlightLimiter(max_in_flight)
+        return _limiter
+
+
+def admit_request():
+    if request.url_rule is None or request.endpoint in EXEMPT_ENDPOINTS:
+        return None
+
+    route = request.url_rule.rule
+    max_wait = app.config['ADMISSION_MAX_QUEUE_DELAY_MS'] / 1000
+
+    buckets = []
+    if app.config['ADMISSION_USER_RATE']:
+        user_id = (request.view_args or {}).get('user_id') or request.remote_addr
+        buckets.append(('user', f'user:{user_id}', app.config['ADMISSION_USER_RATE'],
+                        app.config['ADMISSION_USER_BURST']))
+    if route in app.config['ADMISSION_ROUTE_RATES']:
+        buckets.append(('route', f'route:{route}', *route_rates(app.config)[route]))
+
+    backend = _get_backend() if buckets else None
+    taken = []
+    delay = 0
+    for limit, key, rate, burst in buckets:
+        admitted, wait = backend.acquire(key, rate, burst, max_wait)
+        if not admitted:
+            # a client is not charged for requests shed by a limit shared with others
+            _refund(backend, taken)
+            return _shed(route, limit, 429, f'Too many requests, retry in {wait:.1f} seconds', wait)
+        taken.append(key)
+        delay = max(delay, wait)
+    if delay:
+        time.sleep(delay)
+
+    limiter = _get_limiter() if request.endpoint not in WAITING_ENDPOINTS else None
+    if limiter is not None:
+        if not limiter.acquire(max_wait - delay):
+            _refund(backend, taken)
+            return _shed(route, 'in_flight', 503, 'Too many requests in progress', 1)
+        g.admission_limiter = limiter
+
+    metrics.ADMISSION_ACCEPTED.inc(route)
+    return None
+
+
+def release_request(exc):
+    # after streamed responses are sent
+    limiter = g.pop('admission_limiter', None)
+    if limiter is not None:
+        limiter.release()
+
+
+def _refund(backend, keys):
+    for key in keys:
+        backend.refund(key)
+
+
+def _shed(route, limit, status, message, retry_after):
+    metrics.ADMISSION_SHED.inc(route, limit)
+    return output_json({'message': message}, status, {'Retry-After': str(max(math.ceil(retry_after), 1))})
+
+
+def _in_flight():
+    limiter = _limiter
+    return limiter.in_flight if limiter is not None and limiter.pid == os.getpid() else 0
+
+
+metrics.registry.register(metrics.Gauge(
+    'admission_in_flight_requests', 'Requests of this process holding an in-flight slot.', _in_flight))
+
+app.before_request(admit_request)
+app.teardown_request(release_request)
@@ -0,0 +1,184 @@
+"""Read-through cache of the unread messages of active users.
+
+Clients polling for new messages mostly get nothing back. The cache keeps, for
+every recently active user, the read marker and the unread messages after it,
+so those polls are answered without touching the database. The store keeps
+entries up to date: new messages are appended, advancing the read marker trims
+them, and deletes invalidate the entry.
+
+``MailboxCache`` is the interface a shared cache backend implements, entries
+are ``MailboxEntry`` objects, unread messages are (id, message) pairs and the
+read marker is the id of the last message read. The unread messages of an
+entry are None when the user has too many of them to be cached, so reads of
+the largest mailboxes don't try to load them again until the entry expires.
+
+The in-process backend is only coherent within one process, with several
+workers an entry can miss changes made by another worker for up to ``ttl``.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+class MailboxEntry:
+    def __init__(self, read_marker, unread):
+        self.read_marker = read_marker
+        self.unread = unread
+
+
+class MailboxCache:
+    """Loads race with writes: a loader reads ``generation(user_id)`` before
+    querying the database and ``set`` drops the entry if the user changed since."""
+
+    def get(self, user_id):
+        """Return the ``MailboxEntry`` of ``user_id``, or None."""
+        raise NotImplementedError
+
+    def generation(self, user_id):
+        raise NotImplementedError
+
+    def set(self, user_id, entry, generation):
+        raise NotImplementedError
+
+    def append(self, user_id, messages):
+        """Add new unread (id, message) pairs to the entry of ``user_id``."""
+        raise NotImplementedError
+
+    def advance(self, user_id, read_marker):
+        """The read marker of ``user_id`` moved forward to ``read_marker``."""
+        raise NotImplementedError
+
+    def invalidate(self, user_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class InProcessMailboxCache(MailboxCache):
+    """LRU of at most ``max_users`` entries and about ``max_bytes``, entries expire after ``ttl`` seconds.
+
+    Users with more than ``max_unread`` unread messages are not cached.
+    """
+
+    def __init__(self, ttl=10, max_users=10000, max_bytes=64 * 1024 * 1024, max_unread=1000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.max_unread = max_unread
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        # user_id -> [entry, expires at, size]
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generations = OrderedDict()
+        self._generation_counter = itertools.count(1)
+        # generation of users whose generation was evicted
+        self._generation_floor = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, user_id):
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is None:
+                return None
+
+            if cached[1] <= self._clock():
+                self._remove(user_id)
+                return None
+
+            self._entries.move_to_end(user_id)
+            return cached[0]
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, self._generation_floor)
+
+    def set(self, user_id, entry, generation):
+        if entry.unread is not None and len(entry.unread) > self.max_unread:
+            return
+
+        with self._lock:
+            if self._generations.get(user_id, self._generation_floor) != generation:
+                return
+
+            self._remove(user_id)
+            size = _entry_size(entry)
+            self._entries[user_id] = [entry, self._clock() + self.ttl, size]
+            self._size += size
+            self._evict()
+
+    def append(self, user_id, messages):
+        with self._lock:
+            self._bump_generation(user_id)
+            cached = self._entries.get(user_id)
+            if cached is not None and cached[0].unread is None:
+                # still too many
+                return
+            if cached is None or len(cached[0].unread) + len(messages) > self.max_unread:
+                self._remove(user_id)
+                return
+
+            cached[0].unread = sorted(cached[0].unread + list(messages), key=lambda x: x[0])
+            size = _entry_size(cached[0])
+            self._size += size - cached[2]
+            cached[2] = size
+            self._evict()
+
+    def advance(self, user_id, read_marker):
+        with self._lock:
+            self._bump_generation(user_id)
+            cached = self._entries.get(user_id)
+            if cached is None:
+                return
+
+            entry = cached[0]
+            if entry.unread is None:
+                # may be few enough now
+                self._remove(user_id)
+                return
+            entry.read_marker = read_marker
+            entry.unread = [x for x in entry.unread if x[0] > read_marker]
+            size = _entry_size(entry)
+            self._size += size - cached[2]
+            cached[2] = size
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+            self._bump_generation(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _bump_generation(self, user_id):
+        self._generations[user_id] = next(self._generation_counter)
+        self._generations.move_to_end(user_id)
+        while len(self._generations) > self.max_users:
+            _, generation = self._generations.popitem(last=False)
+            self._generation_floor = max(self._generation_floor, generation)
+
+    def _remove(self, user_id):
+        cached = self._entries.pop(user_id, None)
+        if cached is not None:
+            self._size -= cached[2]
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_users or self._size > self.max_bytes):
+            _, cached = self._entries.popitem(last=False)
+            self._size -= cached[2]
+
+
+def _entry_size(entry):
+    # rough estimate of the memory used by an entry, in bytes
+    return 200 + sum(300 + len(message['text']) for _, message in entry.unread or ())
@@ -0,0 +1,32 @@
+"""Maintenance commands, run with flask's command line:
+
+    $ FLASK_APP=wsgi.py flask rebalance-shards
+    $ FLASK_APP=wsgi.py flask reconcile-counters
+    $ FLASK_APP=wsgi.py flask purge-messages
+"""
+import click
+from flask import current_app as app
+
+from message_api.retention import purge_options
+from message_api.sqlalquemy_store import rebalance_shards, reconcile_counters, purge_messages
+
+
+@app.cli.command('rebalance-shards')
+@click.option('--batch-size', default=1000, show_default=True, help='Messages moved per transaction.')
+def rebalance_shards_command(batch_size):
+    """Move mailboxes to the shard they belong to, after SQLALCHEMY_SHARDS changed."""
+    click.echo(f'Moved {rebalance_shards(batch_size)} mailboxes')
+
+
+@app.cli.command('reconcile-counters')
+@click.option('--batch-size', default=1000, show_default=True, help='Users recounted per transaction.')
+def reconcile_counters_command(batch_size):
+    """Repair the unread and total message counters of users that drifted from their mailbox."""
+    click.echo(f'Repaired the counters of {reconcile_counters(batch_size)} users')
+
+
+@app.cli.command('purge-messages')
+def purge_messages_command():
+    """Delete, or archive, the messages past the RETENTION_* policies."""
+    purged = purge_messages(**purge_options(app.config))
+    click.echo('Purged ' + ', '.join(f'{count} messages by {policy}' for policy, count in purged.items()))
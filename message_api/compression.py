@@ -0,0 +1,156 @@
+"""Compression of responses and request bodies.
+
+Responses are compressed with the best encoding the client accepts, zstd and
+brotli when those libraries are installed, else gzip. Responses with a body are
+compressed from ``COMPRESSION_MIN_SIZE`` bytes, streamed responses always: every
+chunk is flushed as it is produced, so clients get messages as soon as they
+would uncompressed. The encoding is appended to the ETag of compressed responses,
+``"<etag>-gzip"``, the compressed bytes are not the same as the ones the ETag was computed
+for; ``matching_etag`` tells which form of an ETag a conditional request has.
+
+Request bodies sent with ``Content-Encoding: gzip`` are decompressed before
+they reach the resources, up to ``COMPRESSION_MAX_REQUEST_SIZE`` bytes.
+"""
+import io
+import zlib
+
+from flask import current_app as app, request, abort
+from werkzeug.wsgi import get_input_stream
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/html', 'text/plain'}
+
+
+def _gzip(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+
+
+def _zstd(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return ((lambda data: compressor.compress(data) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)),
+            compressor.flush)
+
+
+def _brotli(level):
+    compressor = brotli.Compressor(quality=level)
+    return (lambda data: compressor.process(data) + compressor.flush()), compressor.finish
+
+
+def _encodings():
+    """(encoding, compressor factory, level config) in order of preference."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append(('zstd', _zstd, 'COMPRESSION_ZSTD_LEVEL'))
+    if brotli is not None:
+        encodings.append(('br', _brotli, 'COMPRESSION_BROTLI_LEVEL'))
+    encodings.append(('gzip', _gzip, 'COMPRESSION_GZIP_LEVEL'))
+    return encodings
+
+
+@app.before_request
+def decompress_request():
+    content_encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if not content_encoding or content_encoding == 'identity':
+        return
+    if content_encoding != 'gzip':
+        abort(415, f"Content-Encoding '{content_encoding}' is not supported, use gzip")
+
+    max_size = app.config['COMPRESSION_MAX_REQUEST_SIZE']
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(get_input_stream(request.environ).read(), max_size + 1)
+    except zlib.error:
+        abort(400, 'Request body is not valid gzip')
+    if len(data) <= max_size and not decompressor.eof:
+        abort(400, 'Request body is truncated gzip')
+    if len(data) > max_size:
+        abort(413, f'Decompressed request body is larger than {max_size} bytes')
+
+    # the body is read from the environ when first used, which is after this hook
+    request.environ['wsgi.input'] = io.BytesIO(data)
+    request.environ['CONTENT_LENGTH'] = str(len(data))
+    del request.environ['HTTP_CONTENT_ENCODING']
+
+
+@app.after_request
+def compress_response(response):
+    if (not app.config['COMPRESSION_ENABLED']
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = _negotiate_encoding()
+    if encoding is None:
+        return response
+
+    name, compressor, level_config = encoding
+    compress, finish = compressor(app.config[level_config])
+    if response.is_streamed:
+        response.response = _compressed_stream(response.response, response.iter_encoded(), compress, finish)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+        response.set_data(compress(data) + finish())
+
+    response.headers['Content-Encoding'] = name
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(_encoded_etag(etag, name), weak=weak)
+    return response
+
+
+def matching_etag(etag):
+    """The form of ``etag`` in the ``If-None-Match`` of the request, or None.
+
+    The response may have been sent uncompressed, as ``etag``, or compressed with
+    the encoding negotiated for this request, the 304 has to carry the one the client has.
+    """
+    candidates = [etag]
+    if app.config['COMPRESSION_ENABLED']:
+        encoding = _negotiate_encoding()
+        if encoding is not None:
+            candidates.append(_encoded_etag(etag, encoding[0]))
+    for candidate in reversed(candidates):
+        if request.if_none_match.contains_weak(candidate):
+            return candidate
+    return None
+
+
+def _encoded_etag(etag, encoding):
+    return f'{etag}-{encoding}'
+
+
+def _negotiate_encoding():
+    best, best_quality = None, 0
+    for encoding in _encodings():
+        quality = request.accept_encodings.quality(encoding[0])
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compressed_stream(iterable, chunks, compress, finish):
+    """Compress the encoded ``chunks`` of the response ``iterable``, closed once done."""
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compress(chunk)
+        yield finish()
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
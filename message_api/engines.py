@@ -0,0 +1,140 @@
+"""Database engine configuration.
+
+``engine_options`` builds the ``create_engine`` options for a database URI
+from the ``DATABASE_*`` settings in ``config.py``, the pool settings only
+apply to databases with a connection pool (not in-memory SQLite).
+
+Connections are never shared between processes: a connection opened before a
+fork (ex: by gunicorn's master with ``preload_app``) is discarded on checkout
+in the worker, which opens its own.
+
+With a SQLite file and ``SQLITE_PROFILE='concurrent'`` every connection is
+switched to WAL, so reads don't wait on writes, and gets the ``SQLITE_*``
+pragmas. SQLite has one writer at a time, a deferred transaction that starts
+reading and then writes fails with "database is locked" without waiting for
+the lock. So writes go through ``writer_engine``, a pool of one connection
+whose transactions take the write lock up front (``BEGIN IMMEDIATE``): threads
+of a process queue for that connection, processes wait on the lock for up to
+``SQLITE_BUSY_TIMEOUT`` seconds, and reads keep using the pool of readers.
+"""
+import os
+import time
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import Pool, QueuePool
+
+from message_api import metrics
+
+
+class TimedQueuePool(QueuePool):
+    """``QueuePool`` recording how long getting a connection takes, see ``metrics.POOL_WAIT``."""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            metrics.POOL_WAIT.observe(time.perf_counter() - started)
+
+
+def engine_options(config, uri):
+    url = make_url(uri)
+    if url.drivername.startswith('sqlite'):
+        if not _is_sqlite_file(url):
+            # a single connection shared by every thread
+            return {}
+
+        options = {
+            'poolclass': TimedQueuePool,
+            'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'], 'check_same_thread': False},
+        }
+    else:
+        options = {
+            'poolclass': TimedQueuePool,
+            'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+            'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+        }
+
+    options.update({
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+    })
+    return options
+
+
+def uses_writer_lane(config, uri):
+    url = make_url(uri)
+    return url.drivername.startswith('sqlite') and _is_sqlite_file(url) and config['SQLITE_PROFILE'] == 'concurrent'
+
+
+def configure_engine(engine, config):
+    """Apply the SQLite profile to the connections ``engine`` opens from now on."""
+    if not uses_writer_lane(config, str(engine.url)):
+        return
+
+    pragmas = [
+        'PRAGMA journal_mode=WAL',
+        f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA cache_size={config['SQLITE_CACHE_SIZE']:d}",
+        f"PRAGMA mmap_size={config['SQLITE_MMAP_SIZE']:d}",
+        f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT'] * 1000):d}",
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def writer_engine(config, uri):
+    """Engine of the single writer connection, None unless the 'concurrent' SQLite profile applies to ``uri``."""
+    if not uses_writer_lane(config, uri):
+        return None
+
+    engine = create_engine(
+        uri,
+        poolclass=TimedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=config['DATABASE_POOL_TIMEOUT'],
+        # the driver's own transaction handling is off, transactions are started below
+        connect_args={'timeout': config['SQLITE_BUSY_TIMEOUT'], 'check_same_thread': False, 'isolation_level': None})
+    configure_engine(engine, config)
+
+    @event.listens_for(engine, 'begin')
+    def begin_immediate(connection):
+        connection.execute('BEGIN IMMEDIATE')
+
+    return engine
+
+
+def bind_url(bind):
+    """URL of the database of ``bind``, an engine, connection or session."""
+    if hasattr(bind, 'get_bind'):
+        # the connection of the session, within its transaction
+        bind = bind.connection()
+    return str(bind.engine.url)
+
+
+def _is_sqlite_file(url):
+    return url.database not in (None, '', ':memory:')
+
+
+@event.listens_for(Pool, 'connect')
+def _remember_process(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _discard_connections_of_parent_process(dbapi_connection, connection_record, connection_proxy):
+    pid = connection_record.info.get('pid')
+    if pid is not None and pid != os.getpid():
+        # forget it without closing it, the parent process still owns it
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f'Connection record belongs to pid {pid}, '
+            f'attempting to check out in pid {os.getpid()}')
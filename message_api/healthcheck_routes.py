@@ -1,8 +1,110 @@
-from flask import current_app as app
+import os
+import threading
+
+from flask import current_app as app, request, Response
 from healthcheck import HealthCheck, EnvironmentDump
 
-health = HealthCheck()
+from message_api import metrics, probes
+from message_api.migrations import Heartbeat
+from message_api.sqlalquemy_store import db, databases, replicas, queue_depths
+
+# probe results are cached by the prober, not by HealthCheck
+liveness = HealthCheck(success_ttl=0, failed_ttl=0)
+readiness = HealthCheck(success_ttl=0, failed_ttl=0, failed_status=503)
 env_dump = EnvironmentDump()
 
-app.add_url_rule("/healthcheck", "healthcheck", view_func=lambda: health.run())
+
+def _database_engines():
+    return {_database_name(shard): engine for shard, engine, _ in databases()}
+
+
+def _database_writers():
+    return {_database_name(shard): writer for shard, _, writer in databases()}
+
+
+def _database_name(shard):
+    return 'primary' if shard is None else f'shard {shard.number}'
+
+
+def _replica_engines():
+    return {repr(replica.url): replica for replica in replicas()}
+
+
+_prober = None
+_prober_lock = threading.Lock()
+
+
+def _get_prober():
+    global _prober
+    with _prober_lock:
+        # the prober thread does not survive a fork, every worker process starts its own
+        if _prober is None or _prober.pid != os.getpid():
+            heartbeat = Heartbeat.__table__
+            _prober = probes.Prober(app._get_current_object(), {
+                'database': probes.connectivity(_database_engines),
+                'database_pool': probes.pool_saturation(
+                    _database_engines, app.config['DATABASE_MAX_OVERFLOW'],
+                    app.config['HEALTHCHECK_MAX_POOL_SATURATION']),
+                'database_write': probes.write_latency(
+                    _database_writers, heartbeat, app.config['HEALTHCHECK_MAX_WRITE_LATENCY']),
+                'database_replicas': probes.replica_lag(
+                    lambda: db.engine, _replica_engines, heartbeat, app.config['HEALTHCHECK_MAX_REPLICA_LAG']),
+            }, interval=app.config['HEALTHCHECK_INTERVAL'], ttl=app.config['HEALTHCHECK_TTL'])
+        return _prober
+
+
+def _check(name):
+    def check():
+        return _get_prober().result(name)
+    check.__name__ = name
+    return check
+
+
+for _name in ('database', 'database_pool', 'database_write', 'database_replicas'):
+    readiness.add_check(_check(_name))
+
+# alive as long as it answers, restarting it does not fix the database
+app.add_url_rule("/health/live", "liveness", view_func=lambda: liveness.run())
+# ready when the databases are, load balancers stop sending requests otherwise
+app.add_url_rule("/health/ready", "readiness", view_func=lambda: readiness.run())
+app.add_url_rule("/healthcheck", "healthcheck", view_func=lambda: readiness.run())
 app.add_url_rule("/environment", "environment", view_func=lambda: env_dump.run())
+
+
+def start_request_metrics():
+    metrics.start_request(app.config['METRICS_SLOW_REQUEST_MAX_SQL'])
+
+
+def record_response_status(response):
+    request_metrics = metrics.current_request()
+    if request_metrics is not None:
+        request_metrics.status = response.status_code
+    return response
+
+
+def finish_request_metrics(exc):
+    # after streamed responses are sent, so their queries count
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_metrics, duration = metrics.finish_request(route, request.method)
+    if request_metrics is None:
+        return
+
+    slow_request_ms = app.config['METRICS_SLOW_REQUEST_MS']
+    if slow_request_ms and duration * 1000 >= slow_request_ms:
+        app.logger.warning(
+            'Slow request %s %s %d took %.1f ms, %d SQL statements %.1f ms, serialization %.1f ms%s',
+            request.method, request.full_path, request_metrics.status, duration * 1000,
+            request_metrics.sql_queries, request_metrics.sql_duration * 1000,
+            request_metrics.serialization_duration * 1000,
+            ''.join(f'\n  {seconds * 1000:.1f} ms {statement}' for statement, seconds in request_metrics.statements))
+
+
+if app.config['METRICS_ENABLED']:
+    metrics.install(queue_depths)
+    app.before_request(start_request_metrics)
+    app.after_request(record_response_status)
+    app.teardown_request(finish_request_metrics)
+
+    app.add_url_rule(
+        "/metrics", "metrics",
+        view_func=lambda: Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4'))
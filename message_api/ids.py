@@ -0,0 +1,67 @@
+"""Time ordered message ids, generated in process.
+
+An id is a 63-bit integer, a signed BIGINT: 41 bits of milliseconds since
+``EPOCH``, then ``NODE_BITS`` bits of node id and ``SEQUENCE_BITS`` bits of
+sequence within the millisecond. Ids sort by creation time, so listings order
+and paginate by id alone, are known before the insert, and don't clash between
+processes as long as every process generating ids has its own node id. They
+are above 2 ** 53, JavaScript clients must parse them as BigInt.
+
+Within a process ids always grow: when the clock goes back, or more than
+``2 ** SEQUENCE_BITS`` ids are generated within a millisecond, ids borrow the
+next milliseconds, at most ``MAX_AHEAD_MS`` ahead of the clock, then wait for
+it. Ids of other processes would otherwise sort before ids handed out long
+ago, behind the read markers of their targets.
+
+Ids of messages stored before stay valid and are below every id generated
+here: those of the database autoincrement, and the 53-bit ids of earlier
+versions, which had 4 bits of sequence.
+"""
+import threading
+import time
+from datetime import datetime
+
+EPOCH = datetime(2020, 1, 1)
+NODE_BITS = 8
+SEQUENCE_BITS = 14
+MAX_AHEAD_MS = 5
+MAX_NODE_ID = 2 ** NODE_BITS - 1
+
+_EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+class IdGenerator:
+    def __init__(self, node_id, clock=time.time, sleep=time.sleep):
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f'Node ids go from 0 to {MAX_NODE_ID}, got {node_id}')
+        self.node_id = node_id
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_ids(self, count):
+        with self._lock:
+            now_ms = int(self._clock() * 1000) - _EPOCH_MS
+            if now_ms > self._last_ms:
+                self._last_ms, self._sequence = now_ms, 0
+
+            message_ids = []
+            for _ in range(count):
+                if self._sequence >> SEQUENCE_BITS:
+                    self._last_ms, self._sequence = self._last_ms + 1, 0
+                    ahead_ms = self._last_ms - (int(self._clock() * 1000) - _EPOCH_MS)
+                    if ahead_ms > MAX_AHEAD_MS:
+                        self._sleep((ahead_ms - MAX_AHEAD_MS) / 1000)
+                message_ids.append(
+                    (self._last_ms << NODE_BITS + SEQUENCE_BITS) | (self.node_id << SEQUENCE_BITS) | self._sequence)
+                self._sequence += 1
+            return message_ids
+
+
+def first_id_at(moment):
+    """Lowest id generated at or after ``moment``, a naive UTC datetime, ids below it were
+    generated before it, or by the database autoincrement."""
+    elapsed_ms = int((moment - EPOCH).total_seconds() * 1000)
+    return max(elapsed_ms, 0) << NODE_BITS + SEQUENCE_BITS
@@ -0,0 +1,267 @@
+"""In-process metrics, exposed in the Prometheus text format on ``/metrics``.
+
+Requests are timed by route and method. Every SQL statement is counted and
+timed through SQLAlchemy engine events, for every engine, and added to the
+request that ran it, along with the time spent encoding the response and
+waiting for a pooled connection. Queue depths are read when scraped.
+
+Metrics are kept per process, with several gunicorn workers every scrape sees
+the worker that answered it, label the targets by worker or run one per port.
+
+Recording is a few additions under a lock per metric, statements are kept by
+reference, so the cost stays small next to the query they measure.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            lines.extend(self._samples(labelvalues, value))
+        return lines
+
+    def _samples(self, labelvalues, value):
+        return [f'{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}']
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                # one count per bucket, +Inf, then the sum
+                counts = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _samples(self, labelvalues, counts):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            bucket_labels = _labels(self.labelnames + ('le',), labelvalues + (_number(bound),))
+            samples.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+        labels = _labels(self.labelnames, labelvalues)
+        samples.append(f'{self.name}_sum{labels} {_number(counts[-1])}')
+        samples.append(f'{self.name}_count{labels} {cumulative}')
+        return samples
+
+
+class Gauge(_Metric):
+    """Value read from ``callback`` when rendered, a number or a {label values: number} dict."""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        with self._lock:
+            self._values = values
+        return super().render()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labelnames, labelvalues):
+    if not labelnames:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    'http_requests_total', 'Requests by route, method and status.', ('route', 'method', 'status')))
+REQUEST_DURATION = registry.register(Histogram(
+    'http_request_duration_seconds', 'Request time by route and method.', ('route', 'method')))
+REQUEST_SQL_QUERIES = registry.register(Histogram(
+    'http_request_sql_queries', 'SQL statements run by a request, by route.', ('route',),
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100)))
+REQUEST_SQL_DURATION = registry.register(Histogram(
+    'http_request_sql_duration_seconds', 'Time a request spent in SQL statements, by route.', ('route',)))
+REQUEST_SERIALIZATION_DURATION = registry.register(Histogram(
+    'http_request_serialization_duration_seconds', 'Time a request spent encoding its response, by route.',
+    ('route',), buckets=(.0001, .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1)))
+SQL_QUERIES = registry.register(Counter('sql_queries_total', 'SQL statements run, in requests or not.'))
+SQL_DURATION = registry.register(Histogram('sql_query_duration_seconds', 'Time of SQL statements.'))
+POOL_WAIT = registry.register(Histogram(
+    'database_pool_wait_seconds', 'Time waiting for a connection of a pool, opening it included.',
+    buckets=(.0001, .001, .005, .01, .05, .1, .5, 1, 5, 10)))
+MESSAGES_PURGED = registry.register(Counter(
+    'messages_purged_total', 'Messages deleted by retention policies, by policy.', ('policy',)))
+MESSAGES_ARCHIVED = registry.register(Counter('messages_archived_total', 'Messages archived before being purged.'))
+ADMISSION_ACCEPTED = registry.register(Counter(
+    'admission_accepted_total', 'Requests admitted by admission control, by route.', ('route',)))
+ADMISSION_SHED = registry.register(Counter(
+    'admission_shed_total', 'Requests rejected by admission control, by route and limit.', ('route', 'limit')))
+
+
+class RequestMetrics:
+    """What a request did, collected while it runs."""
+
+    def __init__(self, max_statements):
+        self.started = time.perf_counter()
+        self.status = 500
+        self.sql_queries = 0
+        self.sql_duration = 0.0
+        self.serialization_duration = 0.0
+        # (statement, seconds) of the first ``max_statements`` statements, for slow request logs
+        self.statements = []
+        self.max_statements = max_statements
+
+
+_current = threading.local()
+
+
+def start_request(max_statements=50):
+    _current.request = RequestMetrics(max_statements)
+    return _current.request
+
+
+def current_request():
+    return getattr(_current, 'request', None)
+
+
+def finish_request(route, method):
+    """Record the current request, returns its ``RequestMetrics`` and duration in seconds."""
+    request_metrics = current_request()
+    if request_metrics is None:
+        return None, None
+    _current.request = None
+
+    duration = time.perf_counter() - request_metrics.started
+    REQUESTS.inc(route, method, str(request_metrics.status))
+    REQUEST_DURATION.observe(duration, route, method)
+    REQUEST_SQL_QUERIES.observe(request_metrics.sql_queries, route)
+    REQUEST_SQL_DURATION.observe(request_metrics.sql_duration, route)
+    REQUEST_SERIALIZATION_DURATION.observe(request_metrics.serialization_duration, route)
+    return request_metrics, duration
+
+
+@contextmanager
+def serialization():
+    """Time the block as serialization of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_metrics = current_request()
+        if request_metrics is not None:
+            request_metrics.serialization_duration += time.perf_counter() - started
+
+
+_installed = False
+
+
+def install(queue_depths):
+    """Time the SQL statements of every engine, and report the ``queue_depths()`` of the
+    store when scraped, once per process."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+
+    registry.register(Gauge(
+        'messages_write_behind_queue_depth', 'Posted messages waiting to be stored.',
+        lambda: queue_depths()['write_behind']))
+    registry.register(Gauge(
+        'messages_subscribers', 'Clients waiting for new messages.',
+        lambda: queue_depths()['subscribers']))
+    registry.register(Gauge(
+        'database_pool_checked_out_connections', 'Connections in use, by pool.',
+        lambda: {(pool,): count for pool, count in queue_depths()['connections'].items()}, ('pool',)))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # by execution context, a statement run without one by its cursor
+    conn.info.setdefault('metrics_started', []).append((context or cursor, time.perf_counter()))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _, started = conn.info['metrics_started'].pop()
+    _record_statement(statement, time.perf_counter() - started)
+
+
+def _handle_error(exception_context):
+    # a statement that raised, ex: database is locked, has no after_cursor_execute
+    conn = exception_context.connection
+    started = conn.info.get('metrics_started') if conn is not None else None
+    if started and started[-1][0] is (exception_context.execution_context or exception_context.cursor):
+        _record_statement(exception_context.statement, time.perf_counter() - started.pop()[1])
+
+
+def _record_statement(statement, duration):
+    SQL_QUERIES.inc()
+    SQL_DURATION.observe(duration)
+
+    request_metrics = current_request()
+    if request_metrics is not None:
+        request_metrics.sql_queries += 1
+        request_metrics.sql_duration += duration
+        if len(request_metrics.statements) < request_metrics.max_statements:
+            request_metrics.statements.append((statement, duration))
@@ -0,0 +1,230 @@
+"""Schema versioning for the message store.
+
+``db.create_all()`` only creates missing tables, it never touches tables that
+already exist, so databases created by older versions would never get new
+indexes or columns. ``upgrade`` records the schema version in the
+``schema_version`` table and applies every pending step in order, in place.
+
+A fresh database is created straight at the latest version. Steps must be
+idempotent, they may be re-run against a database that was partially upgraded.
+Steps spell out their own DDL, they never read the models, which only describe
+the latest schema: a released step does the same whatever the models become.
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+from message_api import search
+from message_api.sqlalquemy_store import db
+
+MIGRATIONS = []
+
+
+def migration(version):
+    def register(func):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda x: x[0])
+        return func
+    return register
+
+
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True)
+
+
+class Heartbeat(db.Model):
+    """Written by the health probes, see message_api/probes.py, replicas show how far behind they are."""
+    __tablename__ = 'heartbeat'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    beat = db.Column(db.Float, nullable=False)
+
+
+def head():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(bind):
+    if not bind.dialect.has_table(bind, SchemaVersion.__tablename__):
+        return 0
+    return bind.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+
+def upgrade(engine=None):
+    """Bring the database behind ``engine`` (``db.engine`` by default) to the latest schema."""
+    engine = engine or db.engine
+
+    with engine.begin() as connection:
+        is_new_database = not connection.dialect.has_table(connection, 'user_message_model')
+        db.Model.metadata.create_all(bind=connection)
+        if is_new_database:
+            # virtual tables are not part of the metadata
+            search.create_index(connection)
+
+        version = head() if is_new_database else current_version(connection)
+        for step_version, step in MIGRATIONS:
+            if step_version > version:
+                step(connection)
+                version = step_version
+
+        connection.execute(SchemaVersion.__table__.delete())
+        connection.execute(SchemaVersion.__table__.insert(), version=version)
+
+    return version
+
+
+def _create_index(connection, table_name, index_name, columns, unique=False):
+    if index_name not in {index['name'] for index in inspect(connection).get_indexes(table_name)}:
+        connection.execute(text(f'CREATE {"UNIQUE " if unique else ""}INDEX {index_name}'
+                                f' ON {table_name} ({", ".join(columns)})'))
+
+
+def _create_search_index(connection, columns):
+    """Create the FTS5 table of searches on ``columns``, returns False when SQLite was built without FTS5."""
+    try:
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {search.SEARCH_TABLE}"
+            f" USING fts5({', '.join(columns)}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"))
+    except OperationalError:
+        return False
+    search.forget_indexes()
+    return True
+
+
+def _drop_index(connection, table_name, index_name):
+    if index_name in {index['name'] for index in inspect(connection).get_indexes(table_name)}:
+        connection.execute(text(f'DROP INDEX {index_name}'
+                                + (f' ON {table_name}' if connection.dialect.name == 'mysql' else '')))
+
+
+@migration(1)
+def add_mailbox_indexes(connection):
+    # older databases could hold several rows per user, keep the most advanced
+    # read marker on the newest row before enforcing uniqueness on user_id
+    connection.execute(text(
+        'UPDATE user_model SET last_message_read_timestamp = ('
+        '  SELECT MAX(u.last_message_read_timestamp) FROM user_model u WHERE u.user_id = user_model.user_id)'))
+    connection.execute(text(
+        'DELETE FROM user_model WHERE id NOT IN ('
+        '  SELECT id FROM (SELECT MAX(id) AS id FROM user_model GROUP BY user_id) AS keep)'))
+
+    _create_index(connection, 'user_message_model', 'ix_user_message_model_target_sent_time_id',
+                  ('target', 'sent_time', 'id'))
+    _create_index(connection, 'user_model', 'ix_user_model_user_id', ('user_id',), unique=True)
+
+
+@migration(2)
+def add_last_message_read_id(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('user_model')}
+    if 'last_message_read_id' not in columns:
+        connection.execute(text('ALTER TABLE user_model ADD COLUMN last_message_read_id INTEGER'))
+
+
+@migration(3)
+def order_mailboxes_by_id(connection):
+    # message ids are time ordered (see message_api/ids.py), mailboxes are sorted and read markers kept by id
+    connection.execute(text(
+        'UPDATE user_model SET last_message_read_id = ('
+        '  SELECT MAX(m.id) FROM user_message_model m'
+        '  WHERE m.target = user_model.user_id AND m.sent_time <= user_model.last_message_read_timestamp)'
+        ' WHERE last_message_read_id IS NULL AND last_message_read_timestamp IS NOT NULL'))
+
+    _create_index(connection, 'user_message_model', 'ix_user_message_model_target_id', ('target', 'id'))
+    _drop_index(connection, 'user_message_model', 'ix_user_message_model_target_sent_time_id')
+
+    # existing ids stay as they are, the columns are widened to hold the new ones, SQLite integers are 64 bits
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('ALTER TABLE user_message_model ALTER COLUMN id TYPE BIGINT'))
+        connection.execute(text('ALTER TABLE user_model ALTER COLUMN last_message_read_id TYPE BIGINT'))
+    elif connection.dialect.name == 'mysql':
+        connection.execute(text('ALTER TABLE user_message_model MODIFY id BIGINT NOT NULL'))
+        connection.execute(text('ALTER TABLE user_model MODIFY last_message_read_id BIGINT NULL'))
+
+
+@migration(4)
+def add_mailbox_counters(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('user_model')}
+    for column in ('message_count', 'unread_count'):
+        if column not in columns:
+            connection.execute(text(f'ALTER TABLE user_model ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0'))
+
+    connection.execute(text(
+        'INSERT INTO user_model (user_id, message_count, unread_count)'
+        ' SELECT DISTINCT target, 0, 0 FROM user_message_model'
+        ' WHERE target NOT IN (SELECT user_id FROM user_model)'))
+    connection.execute(text(
+        'UPDATE user_model SET'
+        ' message_count = (SELECT COUNT(*) FROM user_message_model m WHERE m.target = user_model.user_id),'
+        ' unread_count = (SELECT COUNT(*) FROM user_message_model m WHERE m.target = user_model.user_id'
+        '  AND (user_model.last_message_read_id IS NULL OR m.id > user_model.last_message_read_id))'))
+
+
+@migration(5)
+def add_mailbox_version(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('user_model')}
+    if 'mailbox_version' not in columns:
+        connection.execute(text('ALTER TABLE user_model ADD COLUMN mailbox_version INTEGER NOT NULL DEFAULT 0'))
+
+
+@migration(6)
+def add_search_index(connection):
+    if connection.dialect.name == 'sqlite' and _create_search_index(connection, ('text',)):
+        connection.execute(text(f'DELETE FROM {search.SEARCH_TABLE}'))
+        connection.execute(text(f'INSERT INTO {search.SEARCH_TABLE} (rowid, text) SELECT id, text FROM user_message_model'))
+
+
+@migration(7)
+def intern_user_ids(connection):
+    # messages reference their sender and target by the id of their user_model row, see message_api/user_keys.py
+    columns = {column['name'] for column in inspect(connection).get_columns('user_message_model')}
+    if 'target' not in columns:
+        return
+
+    connection.execute(text(
+        'INSERT INTO user_model (user_id)'
+        ' SELECT user_id FROM (SELECT sender AS user_id FROM user_message_model'
+        '  UNION SELECT target FROM user_message_model) AS users'
+        ' WHERE user_id NOT IN (SELECT user_id FROM user_model)'))
+
+    if connection.dialect.name == 'sqlite':
+        # SQLite can neither drop indexed columns nor add NOT NULL ones, the table is rebuilt
+        connection.execute(text('ALTER TABLE user_message_model RENAME TO user_message_model_strings'))
+        connection.execute(text(
+            'CREATE TABLE user_message_model (id INTEGER NOT NULL PRIMARY KEY, sender_key INTEGER NOT NULL,'
+            ' target_key INTEGER NOT NULL, text TEXT NOT NULL, sent_time DATETIME NOT NULL)'))
+        connection.execute(text(
+            'INSERT INTO user_message_model (id, sender_key, target_key, text, sent_time)'
+            ' SELECT m.id, s.id, t.id, m.text, m.sent_time FROM user_message_model_strings m'
+            ' JOIN user_model s ON s.user_id = m.sender JOIN user_model t ON t.user_id = m.target'))
+        connection.execute(text('DROP TABLE user_message_model_strings'))
+        _create_index(connection, 'user_message_model', 'ix_user_message_model_target_key_id', ('target_key', 'id'))
+        return
+
+    for column in ('sender_key', 'target_key'):
+        if column not in columns:
+            connection.execute(text(f'ALTER TABLE user_message_model ADD COLUMN {column} INTEGER'))
+    connection.execute(text(
+        'UPDATE user_message_model SET'
+        ' sender_key = (SELECT id FROM user_model WHERE user_id = sender),'
+        ' target_key = (SELECT id FROM user_model WHERE user_id = target)'))
+    for column in ('sender_key', 'target_key'):
+        if connection.dialect.name == 'mysql':
+            connection.execute(text(f'ALTER TABLE user_message_model MODIFY {column} INTEGER NOT NULL'))
+        else:
+            connection.execute(text(f'ALTER TABLE user_message_model ALTER COLUMN {column} SET NOT NULL'))
+
+    _create_index(connection, 'user_message_model', 'ix_user_message_model_target_key_id', ('target_key', 'id'))
+    _drop_index(connection, 'user_message_model', 'ix_user_message_model_target_id')
+    for column in ('sender', 'target'):
+        connection.execute(text(f'ALTER TABLE user_message_model DROP COLUMN {column}'))
+
+
+@migration(8)
+def scope_search_index_by_mailbox(connection):
+    # searches match the target key of messages along with their terms, see message_api/search.py
+    if connection.dialect.name != 'sqlite' or not connection.dialect.has_table(connection, search.SEARCH_TABLE):
+        return
+
+    connection.execute(text(f'DROP TABLE {search.SEARCH_TABLE}'))
+    _create_search_index(connection, ('text', 'target_key'))
+    connection.execute(text(
+        f'INSERT INTO {search.SEARCH_TABLE} (rowid, text, target_key) SELECT id, text, target_key FROM user_message_model'))
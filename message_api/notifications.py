@@ -0,0 +1,140 @@
+"""Push delivery of new messages.
+
+The store publishes every committed message to the notification hub, clients
+waiting on a subscription (long polling or server-sent events) are woken up
+and get the new messages from the hub, so idle connections don't query the
+database.
+
+The hub keeps the last ``buffer_size`` messages of every subscribed user, a
+client reconnecting with the last id it saw resumes from that buffer. When the
+buffer can't tell what came after that id (the subscription is new, or messages
+were dropped from the buffer) ``Subscription.wait`` returns None and the caller
+catches up from the database, then calls ``Subscription.caught_up``.
+
+``NotificationHub`` works within one process. With several worker processes
+it is ``partial``, every worker only sees the messages posted through it: a
+message posted through another worker is found by the database query of the
+wait that times out, and a mailbox forgets what it knows when its last
+subscriber leaves. A shared hub (ex: Redis pub/sub) sees every message, it
+can implement the same ``publish`` and ``subscribe`` methods.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class _Mailbox:
+    def __init__(self, lock, buffer_size):
+        self.condition = threading.Condition(lock)
+        self.buffer = deque(maxlen=buffer_size)
+        # the buffer holds every message with an id after this one, None until known
+        self.complete_after = None
+        # id of the latest message pushed out of the buffer, 0 when none was
+        self.highest_dropped = 0
+        self.subscribers = 0
+
+
+class Subscription:
+    def __init__(self, hub, user_id, mailbox):
+        self.user_id = user_id
+        self._hub = hub
+        self._mailbox = mailbox
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def wait(self, after_id, timeout):
+        """Messages with an id after ``after_id``, waiting up to ``timeout`` seconds when there are none.
+
+        Returns None when the buffer can't tell which messages came after ``after_id``.
+        """
+        mailbox = self._mailbox
+        deadline = time.monotonic() + timeout
+        with mailbox.condition:
+            while True:
+                if mailbox.complete_after is None or after_id < mailbox.complete_after:
+                    return None
+
+                messages = [message for message_id, message in mailbox.buffer if message_id > after_id]
+                remaining = deadline - time.monotonic()
+                if messages or remaining <= 0:
+                    return messages
+
+                mailbox.condition.wait(remaining)
+
+    def caught_up(self, message_id):
+        """Every message up to ``message_id`` was read from the database after this subscription started."""
+        mailbox = self._mailbox
+        with mailbox.condition:
+            # messages dropped before the buffer was complete are not in it either
+            mailbox.complete_after = max(message_id, mailbox.highest_dropped, mailbox.complete_after or 0)
+
+    @property
+    def partial(self):
+        """Whether messages may be posted without being published to this subscription."""
+        return self._hub.partial
+
+    def close(self):
+        self._hub._unsubscribe(self.user_id)
+
+
+class NotificationHub:
+    """Mailboxes of users without subscribers are kept for reconnecting
+    clients, at most ``max_users`` of them, least recently used first out."""
+
+    def __init__(self, buffer_size=100, max_users=10000, partial=False):
+        self.buffer_size = buffer_size
+        self.max_users = max_users
+        self.partial = partial
+        self._lock = threading.Lock()
+        self._mailboxes = OrderedDict()
+
+    def subscribe(self, user_id):
+        with self._lock:
+            mailbox = self._mailboxes.get(user_id)
+            if mailbox is None:
+                mailbox = self._mailboxes[user_id] = _Mailbox(self._lock, self.buffer_size)
+            self._mailboxes.move_to_end(user_id)
+            mailbox.subscribers += 1
+            self._evict()
+            return Subscription(self, user_id, mailbox)
+
+    def publish(self, user_id, messages):
+        """Wake up the subscribers of ``user_id`` with new (id, message) pairs, in id order."""
+        with self._lock:
+            mailbox = self._mailboxes.get(user_id)
+            if mailbox is None:
+                return
+
+            for message_id, message in messages:
+                if len(mailbox.buffer) == mailbox.buffer.maxlen:
+                    mailbox.highest_dropped = max(mailbox.highest_dropped, mailbox.buffer.popleft()[0])
+                    if mailbox.complete_after is not None:
+                        mailbox.complete_after = max(mailbox.complete_after, mailbox.highest_dropped)
+                mailbox.buffer.append((message_id, message))
+            mailbox.condition.notify_all()
+
+    def subscribers(self):
+        with self._lock:
+            return sum(mailbox.subscribers for mailbox in self._mailboxes.values())
+
+    def _unsubscribe(self, user_id):
+        with self._lock:
+            mailbox = self._mailboxes[user_id]
+            mailbox.subscribers -= 1
+            if not mailbox.subscribers and self.partial:
+                # messages posted through other processes meanwhile are only in the database
+                mailbox.complete_after = None
+            self._evict()
+
+    def _evict(self):
+        if len(self._mailboxes) <= self.max_users:
+            return
+
+        for user_id in [user_id for user_id, mailbox in self._mailboxes.items() if not mailbox.subscribers]:
+            del self._mailboxes[user_id]
+            if len(self._mailboxes) <= self.max_users:
+                return
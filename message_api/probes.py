@@ -0,0 +1,178 @@
+"""Database health probes, run in the background.
+
+Load balancers poll the health endpoints often, and hardest when the database
+is struggling. Polls never touch the database: a ``Prober`` thread runs the
+probes every ``interval`` seconds and the endpoints read its last results.
+Results older than ``ttl`` fail, so a probe stuck on a hung database shows.
+With an ``interval`` of 0 there is no thread, expired results are probed
+again by the poll that reads them.
+
+Probes return (passed, output), the output tells every database apart:
+
+- ``connectivity``: ``SELECT 1`` on every database, the time it took
+- ``pool_saturation``: share of the connection pools in use
+- ``write_latency``: time to commit a write, the heartbeat, on every database
+- ``replica_lag``: how far behind the primary's heartbeat every replica is
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import select, exists, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+
+
+class Prober:
+    """Runs ``probes``, {name: callable returning (passed, output)}, in a background
+    thread within an app context of ``app``."""
+
+    def __init__(self, app, probes, interval=5, ttl=15, clock=time.monotonic):
+        self._app = app
+        self.probes = probes
+        self.interval = interval
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # name -> (passed, output, probed at)
+        self._results = {}
+        self._stopped = threading.Event()
+        self.pid = os.getpid()
+
+        if interval:
+            threading.Thread(target=self._run, name='health-prober', daemon=True).start()
+
+    def result(self, name):
+        """Last (passed, output) of probe ``name``, failed when it is missing or older than ``ttl``."""
+        with self._lock:
+            result = self._results.get(name)
+        if not self.interval and (result is None or self._clock() - result[2] > self.ttl):
+            self.run_once()
+            with self._lock:
+                result = self._results.get(name)
+
+        if result is None:
+            return False, 'not probed yet'
+
+        passed, output, probed_at = result
+        age = self._clock() - probed_at
+        if age > self.ttl:
+            return False, f'last probed {age:.0f} seconds ago'
+        return passed, output
+
+    def run_once(self):
+        for name, probe in self.probes.items():
+            try:
+                passed, output = probe()
+            except Exception as e:
+                self._app.logger.warning('Health probe %s failed', name, exc_info=True)
+                passed, output = False, str(e)
+
+            with self._lock:
+                self._results[name] = (passed, output, self._clock())
+
+    def close(self):
+        self._stopped.set()
+
+    def _run(self):
+        with self._app.app_context():
+            while not self._stopped.is_set():
+                self.run_once()
+                self._stopped.wait(self.interval)
+
+
+def connectivity(databases):
+    """``databases`` returns {name: engine}."""
+    def probe():
+        return _each(databases(), _select_one)
+    return probe
+
+
+def pool_saturation(databases, max_overflow, max_saturation):
+    def probe():
+        output = {}
+        passed = True
+        for name, engine in databases().items():
+            pool = engine.pool
+            if not isinstance(pool, QueuePool):
+                continue
+            saturation = pool.checkedout() / (pool.size() + max_overflow)
+            output[name] = round(saturation, 3)
+            passed = passed and saturation < max_saturation
+        return passed, output
+    return probe
+
+
+def write_latency(writers, heartbeat, max_latency):
+    """``writers`` returns {name: engine} of the engines writes go through."""
+    def probe():
+        passed, output = _each(writers(), lambda engine: _beat(engine, heartbeat))
+        slow = [name for name, latency in output.items() if isinstance(latency, float) and latency > max_latency]
+        return passed and not slow, output
+    return probe
+
+
+def replica_lag(primary, replicas, heartbeat, max_lag):
+    """Seconds between the last heartbeat of ``primary`` and the one ``replicas`` have."""
+    def probe():
+        beat = _read_beat(primary(), heartbeat)
+        output = {}
+        passed = True
+        for name, engine in replicas().items():
+            try:
+                replica_beat = _read_beat(engine, heartbeat)
+            except Exception as e:
+                output[name] = str(e)
+                passed = False
+                continue
+
+            if beat is None:
+                output[name] = 0.0
+            elif replica_beat is None:
+                output[name] = 'no heartbeat replicated yet'
+                passed = False
+            else:
+                lag = max(beat - replica_beat, 0.0)
+                output[name] = round(lag, 3)
+                passed = passed and lag <= max_lag
+        return passed, output
+    return probe
+
+
+def _each(engines, func):
+    """Seconds ``func(engine)`` takes on every engine, the error of those that fail."""
+    output = {}
+    passed = True
+    for name, engine in engines.items():
+        started = time.perf_counter()
+        try:
+            func(engine)
+        except Exception as e:
+            output[name] = str(e)
+            passed = False
+        else:
+            output[name] = round(time.perf_counter() - started, 6)
+    return passed, output
+
+
+def _select_one(engine):
+    with engine.connect() as connection:
+        connection.execute(select([literal(1)]))
+
+
+def _beat(engine, heartbeat):
+    now = time.time()
+    try:
+        with engine.begin() as connection:
+            if not connection.execute(heartbeat.update().where(heartbeat.c.id == 1).values(beat=now)).rowcount:
+                connection.execute(heartbeat.insert().from_select(
+                    ['id', 'beat'],
+                    select([literal(1), literal(now)]).where(~exists().where(heartbeat.c.id == 1))))
+    except IntegrityError:
+        # another process wrote the first heartbeat at the same time
+        pass
+
+
+def _read_beat(engine, heartbeat):
+    with engine.connect() as connection:
+        return connection.execute(select([heartbeat.c.beat]).where(heartbeat.c.id == 1)).scalar()
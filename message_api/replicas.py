@@ -0,0 +1,61 @@
+"""Routing of reads between the primary database and its replicas.
+
+Listings are read from the replicas in ``SQLALCHEMY_REPLICA_URIS``, in turn.
+A replica that fails is skipped for ``retry_after`` seconds, and reads go to
+the primary when every replica is down. Replicas lag behind the primary, so
+for ``read_after_write_window`` seconds after a write to a mailbox its reads
+stay on the primary: a client sees the messages it posted, deleted or read.
+
+The window is tracked within one process, with several worker processes a
+read can hit a replica right after another worker wrote.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReplicaRouter:
+    """At most ``max_users`` recent writers are remembered, the oldest first out."""
+
+    def __init__(self, replicas, retry_after=30, read_after_write_window=5, max_users=10000, clock=time.monotonic):
+        self.replicas = list(replicas)
+        self.retry_after = retry_after
+        self.read_after_write_window = read_after_write_window
+        self.max_users = max_users
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._next_replica = itertools.cycle(range(len(self.replicas)))
+        # replica index -> time it can be used again
+        self._down_until = {}
+        # user_id -> time its reads can go to replicas again
+        self._recent_writes = OrderedDict()
+
+    def replicas_for(self, user_id):
+        """Replicas to try in order for a read of ``user_id``'s mailbox, empty to read from the primary."""
+        now = self._clock()
+        with self._lock:
+            primary_until = self._recent_writes.get(user_id)
+            if primary_until is not None:
+                if primary_until > now:
+                    return []
+                del self._recent_writes[user_id]
+
+            start = next(self._next_replica, 0)
+            indexes = [(start + i) % len(self.replicas) for i in range(len(self.replicas))]
+            return [self.replicas[i] for i in indexes if self._down_until.get(i, 0) <= now]
+
+    def failed(self, replica):
+        with self._lock:
+            self._down_until[self.replicas.index(replica)] = self._clock() + self.retry_after
+
+    def wrote(self, user_id):
+        if not self.read_after_write_window:
+            return
+
+        with self._lock:
+            self._recent_writes[user_id] = self._clock() + self.read_after_write_window
+            self._recent_writes.move_to_end(user_id)
+            while len(self._recent_writes) > self.max_users:
+                self._recent_writes.popitem(last=False)
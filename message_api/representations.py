@@ -0,0 +1,43 @@
+"""JSON encoding of API responses.
+
+``MESSAGES_JSON_ENCODER='orjson'`` encodes responses with orjson when it is
+installed. Field names and values are the same, but the output is compact, without
+the spaces after ',' and ':' of the standard library encoder, so it is opt-in.
+Debug mode and a ``RESTFUL_JSON`` config always use flask-restful's encoder.
+"""
+import json
+
+from flask import current_app as app, make_response
+from flask_restful.representations.json import output_json as restful_output_json
+
+from message_api import metrics
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def use_orjson():
+    return (orjson is not None
+            and app.config['MESSAGES_JSON_ENCODER'] == 'orjson'
+            and not app.debug
+            and not app.config.get('RESTFUL_JSON'))
+
+
+def dumps(data):
+    if use_orjson():
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+
+def output_json(data, code, headers=None):
+    if not use_orjson():
+        with metrics.serialization():
+            return restful_output_json(data, code, headers)
+
+    with metrics.serialization():
+        body = orjson.dumps(data) + b'\n'
+    response = make_response(body, code)
+    response.headers.extend(headers or {})
+    return response
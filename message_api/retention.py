@@ -0,0 +1,135 @@
+"""Retention of messages, purged in the background.
+
+With any ``RETENTION_*`` policy set, a ``RetentionWorker`` thread runs
+``purge_messages`` every ``RETENTION_INTERVAL`` seconds, in the one process
+of every instance the server calls ``start_retention`` in as it starts: a
+single gunicorn worker (see gunicorn.conf.py), run.py for the development
+server. Purges of several instances at once skip the messages the others
+locked, they still compete for the database: set ``RETENTION_ENABLED=false``
+on all but one, or purge from cron with ``flask purge-messages``.
+
+The purging process reports on /metrics when the last purge ended, how long
+it took, and the lag: how far past ``RETENTION_MAX_AGE_DAYS`` the oldest
+message left was sent. Deleted and archived messages are counted as they go.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+
+from message_api import metrics
+from message_api.sqlalquemy_store import purge_messages, oldest_message_time
+
+
+class RetentionWorker:
+    """Runs ``purge()`` every ``interval`` seconds in a background thread within an app
+    context of ``app``, then ``lag()``, the seconds the retention is behind."""
+
+    def __init__(self, app, purge, lag, interval, clock=time.time):
+        self._app = app
+        self._purge = purge
+        self._lag = lag
+        self.interval = interval
+        self._clock = clock
+        self._stopped = threading.Event()
+        self.pid = os.getpid()
+        # of the last purge that completed
+        self.last_run = None
+        self.last_duration = None
+        self.last_purged = None
+        self.lag = None
+
+        threading.Thread(target=self._run, name='retention-purger', daemon=True).start()
+
+    def run_once(self):
+        started = self._clock()
+        self.last_purged = self._purge()
+        self.last_run = self._clock()
+        self.last_duration = self.last_run - started
+        self.lag = self._lag()
+
+    def close(self):
+        self._stopped.set()
+
+    def _run(self):
+        with self._app.app_context():
+            while not self._stopped.is_set():
+                try:
+                    self.run_once()
+                except Exception:
+                    self._app.logger.exception('Purge of messages failed')
+                self._stopped.wait(self.interval)
+
+
+def purge_options(config):
+    """Keyword arguments of ``purge_messages`` for the ``RETENTION_*`` settings of ``config``."""
+    return {
+        'max_age': _days(config['RETENTION_MAX_AGE_DAYS']),
+        'max_per_user': config['RETENTION_MAX_MESSAGES_PER_USER'] or None,
+        'read_max_age': _days(config['RETENTION_READ_MAX_AGE_DAYS']),
+        'batch_size': config['RETENTION_BATCH_SIZE'],
+        'pause': config['RETENTION_BATCH_PAUSE_MS'] / 1000,
+        'archive': config['RETENTION_ARCHIVE'] or None,
+        'archive_path': config['RETENTION_ARCHIVE_PATH'],
+    }
+
+
+def _days(days):
+    return timedelta(days=days) if days else None
+
+
+def retention_lag(max_age):
+    """Seconds the oldest message is past ``max_age``, 0 when it is not or without a max age."""
+    oldest = oldest_message_time() if max_age is not None else None
+    if oldest is None:
+        return 0
+    return max((datetime.utcnow() - max_age - oldest).total_seconds(), 0)
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_retention(flask_app):
+    """Start purging messages in the background in this process, when ``flask_app`` is configured to.
+    Returns the ``RetentionWorker``, None when it does not purge."""
+    with flask_app.app_context():
+        return _get_retention_worker()
+
+
+def _get_retention_worker():
+    """The worker of this process, None when it does not purge."""
+    global _worker
+    options = purge_options(app.config)
+    if (not app.config['RETENTION_ENABLED'] or not app.config['RETENTION_INTERVAL']
+            or not any(options[policy] for policy in ('max_age', 'max_per_user', 'read_max_age'))):
+        return None
+
+    with _worker_lock:
+        # the thread does not survive a fork, the app is preloaded by the gunicorn master
+        if _worker is None or _worker.pid != os.getpid():
+            _worker = RetentionWorker(
+                app._get_current_object(),
+                lambda: purge_messages(**options),
+                lambda: retention_lag(options['max_age']),
+                app.config['RETENTION_INTERVAL'])
+        return _worker
+
+
+def _worker_value(name):
+    value = getattr(_worker, name, None) if _worker is not None and _worker.pid == os.getpid() else None
+    # a gauge without value has no sample
+    return {} if value is None else value
+
+
+metrics.registry.register(metrics.Gauge(
+    'retention_last_purge_timestamp_seconds', 'When the last purge of messages ended.',
+    lambda: _worker_value('last_run')))
+metrics.registry.register(metrics.Gauge(
+    'retention_last_purge_duration_seconds', 'How long the last purge of messages took.',
+    lambda: _worker_value('last_duration')))
+metrics.registry.register(metrics.Gauge(
+    'retention_lag_seconds', 'How far past the max age the oldest message was sent, after the last purge.',
+    lambda: _worker_value('lag')))
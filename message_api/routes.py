@@ -1,19 +1,42 @@
+import hashlib
 import os
+import threading
+import time
 
 import markdown
-from flask import current_app as app, request, abort
+from flask import current_app as app, request, abort, Response, stream_with_context
 from flask_restful import Resource
-from message_api.sqlalquemy_store import add_message, get_messages, delete_message
+from werkzeug.http import quote_etag
+from message_api.sqlalquemy_store import (
+    add_message, add_messages, get_messages, get_messages_after, iter_messages, delete_message, acknowledge_messages,
+    subscribe_to_messages, wait_for_messages, latest_message_id, count_messages, mailbox_version, search_messages,
+    USER_ID_LEN)
+from message_api.write_behind import WriteBehindError, StoreTimeout
+from message_api.representations import dumps, output_json
+
+
+_readme = None
+_readme_lock = threading.Lock()
 
 
 @app.route('/')
 def index():
-    with open(os.path.dirname(app.root_path) + '/README.md', 'r') as markdown_file:
-        # Read the content of the file
-        content = markdown_file.read()
+    html, etag = _rendered_readme(os.path.dirname(app.root_path) + '/README.md')
+    return _not_modified(etag) or Response(html, headers={'ETag': quote_etag(etag)}, mimetype='text/html')
+
 
-        # Convert to HTML
-        return markdown.markdown(content)
+def _rendered_readme(path):
+    """README.md as HTML and its ETag, rendered again only when the file changed."""
+    global _readme
+    modified_time = os.stat(path).st_mtime
+    with _readme_lock:
+        if _readme is None or _readme[0] != (path, modified_time):
+            with open(path, 'r') as markdown_file:
+                html = markdown.markdown(markdown_file.read())
+            _readme = ((path, modified_time), html, hashlib.sha1(html.encode()).hexdigest())
+        _, html, etag = _readme
+
+    return html, etag
 
 
 class MessageList(Resource):
@@ -25,13 +48,25 @@ class MessageList(Resource):
             abort(400, "'get_old_messages' must be [true|false]")
 
         get_old_messages = get_old_messages == 'true'
+        mark_as_read = not app.config['MESSAGES_READ_ONLY_GET']
+
+        stream = request.args.get("stream")
+        if stream not in (None, "true", "false"):
+            abort(400, "'stream' must be [true|false]")
 
         page = request.args.get("page")
         page_size = request.args.get("page_size")
+        cursor = request.args.get("cursor")
+
+        if page is not None or page_size is not None or cursor is not None:
+            if stream == 'true':
+                abort(400, "Pagination parameters [page|page_size|cursor] can not be used when 'stream=true'")
 
-        if page is not None or page_size is not None:
             if not get_old_messages:
-                abort(400, "Pagination parameters [page|page_size] can only be used when 'get_old_messages=true'")
+                abort(400, "Pagination parameters [page|page_size|cursor] can only be used when 'get_old_messages=true'")
+
+            if page is not None and cursor is not None:
+                abort(400, "'page' and 'cursor' can not be used together")
 
             page = page or 0
             page_size = page_size or 10
@@ -42,12 +77,51 @@ class MessageList(Resource):
             except ValueError:
                 abort(400, "'page' and 'page_size' must be integers")
 
+            if page < 0 or page_size < 1:
+                abort(400, "'page' must be >= 0 and 'page_size' must be >= 1")
+
+            page_size = min(page_size, app.config['MESSAGES_MAX_PAGE_SIZE'])
+
+        # the representation is part of the ETag, the bodies of a listing in each are not the same
+        representation = 'json'
+        if page is None:
+            if request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+                representation = 'ndjson'
+            elif stream == 'true':
+                representation = 'stream'
+
+        headers = {}
+        if get_old_messages or not mark_as_read:
+            # the listing only changes with the mailbox, answered without querying it when the client has it
+            etag = f'{mailbox_version(user_id, with_read_marker=not get_old_messages)}-{representation}'
+            not_modified = _not_modified(etag)
+            if not_modified is not None:
+                return not_modified
+            headers = {'ETag': quote_etag(etag), 'Vary': 'Accept'}
+
+        if cursor is not None:
+            try:
+                messages, next_cursor = get_messages_after(
+                    user_id, cursor=cursor, page_size=page_size, mark_as_read=mark_as_read)
+            except ValueError:
+                abort(400, "'cursor' must be a 'next_cursor' value returned by a previous call")
+
+            return {'messages': messages, 'next_cursor': next_cursor}, 200, headers
+
+        if representation == 'ndjson':
+            return _stream_response(_encode_ndjson, NDJSON_MIMETYPE, user_id, get_old_messages, mark_as_read, headers)
+
+        if representation == 'stream':
+            return _stream_response(
+                _encode_json_array, JSON_MIMETYPE, user_id, get_old_messages, mark_as_read, headers)
+
         messages = get_messages(
             user_id,
             get_old_messages=get_old_messages,
             page=page,
-            page_size=page_size)
-        return messages, 200
+            page_size=page_size,
+            mark_as_read=mark_as_read)
+        return messages, 200, headers
 
     @staticmethod
     def post(user_id):
@@ -61,15 +135,29 @@ class MessageList(Resource):
 
         if not sender_user_id:
             abort(400, 'Missing "user_id"')
+        if not isinstance(sender_user_id, str) or len(sender_user_id) > USER_ID_LEN:
+            abort(400, f'"user_id" must be a string of at most {USER_ID_LEN} characters')
 
         if not text:
             abort(400, 'Missing "text"')
 
-        return add_message(
-            sender_user_id,
-            target_user_id,
-            text,
-        ), 201
+        try:
+            message = add_message(
+                sender_user_id,
+                target_user_id,
+                text,
+            )
+        except StoreTimeout:
+            # still queued, a retry would store it twice
+            message = None
+        except WriteBehindError as e:
+            return {'message': str(e)}, 503, {'Retry-After': '1'}
+
+        if message is None:
+            # queued by the write behind queue, it will be stored shortly
+            return {'sender': sender_user_id, 'target': target_user_id, 'text': text}, 202
+
+        return message, 201
 
     @staticmethod
     def delete(user_id):
@@ -84,6 +172,235 @@ class MessageList(Resource):
         return {'deleted_count': deleted_count}, 200
 
 
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def _stream_response(encode, mimetype, user_id, get_old_messages, mark_as_read, headers):
+    messages = iter_messages(user_id, get_old_messages=get_old_messages, mark_as_read=mark_as_read)
+    return Response(stream_with_context(_buffered(encode(messages))), mimetype=mimetype, headers=headers)
+
+
+def _not_modified(etag):
+    """A 304 when the request has ``etag``, with the form of it the client has, else None."""
+    # imported here, compression registers its request hooks after admission's
+    from message_api.compression import matching_etag
+    etag = matching_etag(etag)
+    if etag is None:
+        return None
+    return Response(status=304, headers={'ETag': quote_etag(etag), 'Vary': 'Accept, Accept-Encoding'})
+
+
+def _buffered(parts, chunk_size=16 * 1024):
+    """Join small encoded parts into chunks of about ``chunk_size`` characters."""
+    buffer = []
+    buffered_size = 0
+    for part in parts:
+        buffer.append(part)
+        buffered_size += len(part)
+        if buffered_size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered_size = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _encode_json_array(messages):
+    separator = '['
+    for message in messages:
+        yield separator + dumps(message)
+        separator = ', '
+
+    yield '[]\n' if separator == '[' else ']\n'
+
+
+def _encode_ndjson(messages):
+    for message in messages:
+        yield dumps(message) + '\n'
+
+
+class MessagePoll(Resource):
+
+    @staticmethod
+    def get(user_id):
+        after_id = _optional_int_arg('after_id')
+        try:
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            abort(400, "'wait' must be a number of seconds")
+        wait = min(max(wait, 0), app.config['MESSAGES_LONG_POLL_MAX_WAIT'])
+
+        if after_id is None:
+            after_id = latest_message_id(user_id)
+
+        with subscribe_to_messages(user_id) as subscription:
+            messages = wait_for_messages(subscription, after_id, wait)
+
+        return {'messages': messages, 'last_id': messages[-1]['id'] if messages else after_id}, 200
+
+
+class MessageEvents(Resource):
+
+    @staticmethod
+    def get(user_id):
+        last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+        try:
+            last_id = int(last_id) if last_id else None
+        except ValueError:
+            abort(400, "'Last-Event-ID' must be a message id")
+
+        if last_id is None:
+            last_id = latest_message_id(user_id)
+
+        response = Response(stream_with_context(_event_stream(user_id, last_id)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # don't let proxies buffer the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+def _event_stream(user_id, last_id):
+    keepalive = app.config['MESSAGES_SSE_KEEPALIVE']
+    closes_at = time.monotonic() + app.config['MESSAGES_SSE_MAX_DURATION']
+
+    with subscribe_to_messages(user_id) as subscription:
+        yield 'retry: 1000\n\n'
+        while time.monotonic() < closes_at:
+            messages = wait_for_messages(subscription, last_id, min(keepalive, closes_at - time.monotonic()))
+            if not messages:
+                # lets the server notice disconnected clients
+                yield ': keepalive\n\n'
+                continue
+
+            yield ''.join(f'id: {message["id"]}\nevent: message\ndata: {dumps(message)}\n\n' for message in messages)
+            last_id = messages[-1]['id']
+
+
+def _optional_int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, f"'{name}' must be an integer")
+
+
+class MessageReadMarker(Resource):
+
+    @staticmethod
+    def post(user_id):
+        request_data = request.get_json(force=True, silent=True) or {}
+        if not isinstance(request_data, dict):
+            abort(400, 'JSON data must be an object')
+
+        message_id = request_data.get('message_id')
+        if message_id is not None:
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                abort(400, '"message_id" must be an integer')
+
+        advanced = acknowledge_messages(user_id, message_id)
+        if advanced is None:
+            abort(404, f'Message {message_id} not found')
+
+        return {'advanced': advanced}, 200
+
+
+class MessageCount(Resource):
+
+    @staticmethod
+    def get(user_id):
+        return count_messages(user_id), 200
+
+
+class MessageSearch(Resource):
+
+    @staticmethod
+    def get(user_id):
+        query = request.args.get('q')
+        if query is None:
+            abort(400, "Missing 'q'")
+
+        try:
+            page = int(request.args.get('page', 0))
+            page_size = int(request.args.get('page_size', 10))
+        except ValueError:
+            abort(400, "'page' and 'page_size' must be integers")
+
+        if page < 0 or page_size < 1:
+            abort(400, "'page' must be >= 0 and 'page_size' must be >= 1")
+
+        page_size = min(page_size, app.config['MESSAGES_MAX_PAGE_SIZE'])
+
+        # results only change with the mailbox
+        etag = mailbox_version(user_id)
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            messages = search_messages(user_id, query, page=page, page_size=page_size)
+        except ValueError:
+            abort(400, "'q' must have a term to search")
+
+        return messages, 200, {'ETag': quote_etag(etag), 'Vary': 'Accept'}
+
+
+class BulkMessageList(Resource):
+
+    @staticmethod
+    def post():
+        request_data = request.get_json(force=True)
+        if not isinstance(request_data, list):
+            abort(400, 'JSON data must be an array of {"sender", "target", "text"} objects')
+
+        max_items = app.config['MESSAGES_BULK_MAX_ITEMS']
+        if len(request_data) > max_items:
+            abort(400, f'At most {max_items} messages can be posted at once')
+
+        errors = []
+        messages = []
+        indexes = []
+        for index, item in enumerate(request_data):
+            error = _validate_bulk_item(item)
+            if error:
+                errors.append({'index': index, 'error': error})
+            else:
+                messages.append((item['sender'], item['target'], item['text']))
+                indexes.append(index)
+
+        created = []
+        for index, message in zip(indexes, add_messages(messages)):
+            if message is None:
+                errors.append({'index': index, 'error': 'Message could not be stored'})
+            else:
+                created.append({'index': index, 'id': message['id']})
+
+        errors.sort(key=lambda x: x['index'])
+        return {'created': created, 'errors': errors}, 201 if created or not errors else 400
+
+
+def _validate_bulk_item(item):
+    if not isinstance(item, dict):
+        return 'Message must be an object'
+
+    for field in ('sender', 'target', 'text'):
+        if not item.get(field):
+            return f'Missing "{field}"'
+        if not isinstance(item[field], str):
+            return f'"{field}" must be a string'
+
+    for field in ('sender', 'target'):
+        if len(item[field]) > USER_ID_LEN:
+            return f'"{field}" must be at most {USER_ID_LEN} characters'
+
+    return None
+
+
 class Message(Resource):
     @staticmethod
     def delete(user_id, message_id):
@@ -92,5 +409,12 @@ class Message(Resource):
         return {'deleted_count': deleted_count}, 200
 
 
+app.api.representations['application/json'] = output_json
 app.api.add_resource(MessageList, '/users/<string:user_id>/messages')
 app.api.add_resource(Message, '/users/<string:user_id>/messages/<string:message_id>')
+app.api.add_resource(MessageReadMarker, '/users/<string:user_id>/messages/read')
+app.api.add_resource(MessagePoll, '/users/<string:user_id>/messages/poll')
+app.api.add_resource(MessageEvents, '/users/<string:user_id>/messages/events')
+app.api.add_resource(MessageCount, '/users/<string:user_id>/messages/count')
+app.api.add_resource(MessageSearch, '/users/<string:user_id>/messages/search')
+app.api.add_resource(BulkMessageList, '/messages/bulk')
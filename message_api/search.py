@@ -0,0 +1,123 @@
+"""Full-text search of mailboxes.
+
+On SQLite with FTS5 the ``user_message_search`` table indexes the text of
+every message by message id, its rowid, along with the key of its target. The
+store keeps it in step with the messages, in the transactions that insert and
+delete them. A search matches messages with every one of its terms, a term
+ending with ``*`` is a prefix, and the target key of the mailbox, so it walks
+the matches of that mailbox only rather than those of every mailbox. The newest
+``candidates`` matches are ranked by bm25, so the cost of a search stays bounded
+however common its terms are, and pages go through those.
+
+Other databases, or SQLite without FTS5, search with ``LIKE``: every term
+anywhere in the text, newest first, scanning the mailbox.
+"""
+import threading
+
+from sqlalchemy import column, table, text, and_, select, literal_column
+from sqlalchemy.exc import OperationalError
+
+from message_api.engines import bind_url
+
+SEARCH_TABLE = 'user_message_search'
+
+search_table = table(SEARCH_TABLE, column('rowid'), column('text'), column('target_key'))
+
+_indexed = {}
+_indexed_lock = threading.Lock()
+
+
+def create_index(connection):
+    """Create the search index if the database supports it, returns whether it exists."""
+    if connection.dialect.name != 'sqlite':
+        return False
+
+    try:
+        # prefix indexes keep short prefix terms from merging thousands of terms
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}"
+            f" USING fts5(text, target_key, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"))
+    except OperationalError:
+        # SQLite built without FTS5
+        return False
+
+    forget_indexes()
+    return True
+
+
+def forget_indexes():
+    """Look again for the index on the next searches, once it was created or dropped."""
+    with _indexed_lock:
+        _indexed.clear()
+
+
+def has_index(bind):
+    """Whether the database of ``bind``, an engine, connection or session, has the search index."""
+    url = bind_url(bind)
+    if hasattr(bind, 'get_bind'):
+        bind = bind.connection()
+    with _indexed_lock:
+        indexed = _indexed.get(url)
+    if indexed is None:
+        indexed = bind.dialect.name == 'sqlite' and bind.dialect.has_table(bind, SEARCH_TABLE)
+        with _indexed_lock:
+            _indexed[url] = indexed
+    return indexed
+
+
+def index_messages(connection, messages):
+    """Add (id, target key, text) ``messages`` to the index."""
+    if messages and has_index(connection):
+        connection.execute(
+            text(f'INSERT INTO {SEARCH_TABLE} (rowid, target_key, text) VALUES (:id, :target_key, :text)'), [
+                {'id': message_id, 'target_key': target_key, 'text': message_text}
+                for message_id, target_key, message_text in messages])
+
+
+def unindex_messages(connection, message_ids):
+    """Remove ``message_ids``, a list of ids or a select of them, from the index."""
+    if has_index(connection):
+        connection.execute(search_table.delete().where(search_table.c.rowid.in_(message_ids)))
+
+
+def parse_terms(query):
+    """Terms of a search ``query``, split on white space."""
+    return [term for term in query.split() if term.strip('*')]
+
+
+def search_statement(bind, messages, columns, target_key, terms, limit, offset, candidates):
+    """Select of ``columns`` of the ``messages`` table, the messages to ``target_key`` with every one of
+    ``terms``, see ``message_api.user_keys``."""
+    if not has_index(bind):
+        return (select(columns)
+                .where(messages.c.target_key == target_key)
+                .where(and_(*[messages.c.text.like(_like_pattern(term), escape='\\') for term in terms]))
+                .order_by(messages.c.id.desc())
+                .limit(limit)
+                .offset(offset))
+
+    match = ' '.join(_quote(term.rstrip('*')) + ('*' if term.endswith('*') else '') for term in terms)
+    # FTS5 walks the matches of the mailbox newest first, the terms match the text only and the target key
+    # weighs nothing in the ranking
+    newest_matches = (select([search_table.c.rowid.label('id'),
+                              literal_column(f'bm25({SEARCH_TABLE}, 1.0, 0.0)').label('score')])
+                      .where(text(f'{SEARCH_TABLE} MATCH :match').bindparams(
+                          match=f'target_key : {_quote(str(target_key))} AND text : ({match})'))
+                      .order_by(search_table.c.rowid.desc())
+                      .limit(candidates)
+                      .alias('newest_matches'))
+    return (select(columns)
+            .select_from(messages.join(newest_matches, newest_matches.c.id == messages.c.id))
+            .order_by(newest_matches.c.score, messages.c.id.desc())
+            .limit(limit)
+            .offset(offset))
+
+
+def _quote(term):
+    # an FTS5 string matches its tokens as a phrase, never as query syntax
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like_pattern(term):
+    escaped = term.rstrip('*').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
@@ -0,0 +1,48 @@
+"""Horizontal sharding of mailboxes by target user.
+
+With ``SQLALCHEMY_SHARDS`` every mailbox, the messages sent to a user and its
+read marker, lives in one of several databases. Every mailbox query is scoped
+to one target user, so the store runs it on that user's shard.
+
+Users are mapped to shards by consistent hashing: every shard owns ``vnodes``
+points of a hash ring and a user belongs to the shard of the first point after
+the hash of its id. Adding a shard only moves about 1/N of the mailboxes, to
+the new shard, ``flask rebalance-shards`` moves them.
+
+Message ids are generated in process (see ``message_api.ids``), they are
+unique across shards and moved messages keep theirs.
+"""
+import bisect
+import hashlib
+
+
+class Shard:
+    def __init__(self, number, engine, writer=None):
+        self.number = number
+        self.engine = engine
+        # the single writer connection of the 'concurrent' SQLite profile, see message_api/engines.py
+        self.writer = writer or engine
+
+
+class HashRing:
+    def __init__(self, names, vnodes=64):
+        points = sorted((_hash(f'{name}#{i}'), name) for name in names for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def get(self, key):
+        return self._names[bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+class ShardRouter:
+    def __init__(self, shards, vnodes=64):
+        self.shards = list(shards)
+        self._shards_by_name = {str(shard.number): shard for shard in self.shards}
+        self._ring = HashRing(self._shards_by_name, vnodes)
+
+    def shard_for(self, user_id):
+        return self._shards_by_name[self._ring.get(user_id)]
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
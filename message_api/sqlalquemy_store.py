@@ -1,8 +1,28 @@
+import base64
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
 
+from sqlalchemy import create_engine, event, or_, select, literal, exists, func, bindparam
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError, DBAPIError
+from sqlalchemy.pool import QueuePool
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask import current_app as app
+from werkzeug.utils import import_string
+
+from message_api import engines, metrics, search
+from message_api.cache import InProcessMailboxCache, MailboxEntry
+from message_api.ids import IdGenerator, first_id_at
+from message_api.notifications import NotificationHub
+from message_api.replicas import ReplicaRouter
+from message_api.shards import Shard, ShardRouter
+from message_api.user_keys import UserKeyCache
+from message_api.write_behind import WriteBehindQueue
 
 db = SQLAlchemy()
 ma = Marshmallow()
@@ -10,86 +30,1224 @@ ma = Marshmallow()
 
 db.init_app(app)
 ma.init_app(app)
+engines.configure_engine(db.engine, app.config)
 
 
 def add_message(sender_user_id, target_user_id, text):
-    new_message = UserMessageModel(sender_user_id, target_user_id, text, datetime.utcnow())
-    db.session.add(new_message)
-    db.session.commit()
-    return user_message_schema.dump(new_message)
+    """Store a new message and return it serialized.
+
+    With ``MESSAGES_WRITE_BEHIND`` the message is group committed by the write
+    behind queue, in 'async' mode this returns None as soon as it was queued.
+    Raises ``WriteBehindError`` when it could not be queued or stored, ``StoreTimeout``
+    when it is still queued after ``MESSAGES_WRITE_BEHIND_WAIT_TIMEOUT``.
+    """
+    if app.config['MESSAGES_WRITE_BEHIND']:
+        pending = _get_write_behind_queue().submit((sender_user_id, target_user_id, text))
+        if app.config['MESSAGES_WRITE_BEHIND_MODE'] == 'async':
+            return None
+        return pending.result(timeout=app.config['MESSAGES_WRITE_BEHIND_WAIT_TIMEOUT'])
+
+    rows = _store_messages([(sender_user_id, target_user_id, text)], datetime.utcnow())
+    _messages_added(rows)
+    return serialize_message(rows[0])
+
+
+def add_messages(messages):
+    """Bulk insert ``messages``, a list of (sender_user_id, target_user_id, text).
+
+    Messages are inserted with core statements, one transaction for every
+    ``MESSAGES_BULK_CHUNK_SIZE`` messages, and shard when sharded. Returns the
+    stored messages serialized in the same order, None for the messages of a
+    transaction that failed.
+    """
+    chunk_size = app.config['MESSAGES_BULK_CHUNK_SIZE']
+
+    stored_messages = [None] * len(messages)
+    for start in range(0, len(messages), chunk_size):
+        sent_time = datetime.utcnow()
+        for indexes in _group_by_shard(messages, range(start, min(start + chunk_size, len(messages)))):
+            group = [messages[i] for i in indexes]
+            try:
+                rows = _store_messages(group, sent_time)
+            except SQLAlchemyError:
+                app.logger.exception('Failed to store %d messages', len(group))
+            else:
+                _messages_added(rows)
+                for i, message in zip(indexes, serialize_messages(rows)):
+                    stored_messages[i] = message
+
+    return stored_messages
+
+
+def _store_messages(messages, sent_time):
+    """Insert ``messages`` of the same shard in one transaction, see ``_insert_messages``."""
+    for attempt in range(2):
+        try:
+            with _write_transaction(messages[0][1]) as connection:
+                return _insert_messages(connection, messages, sent_time)
+        except IntegrityError:
+            # another transaction inserted the first message of a target first, now its counters exist
+            if attempt:
+                raise
+
+
+def _insert_messages(connection, messages, sent_time):
+    """Insert (sender_user_id, target_user_id, text) ``messages`` to mailboxes of the same shard,
+    referencing the keys of their users, index them for searches and count them on their targets.
+
+    Returns their (id, sender, target, text, sent_time) rows. Ids are generated
+    within the transaction: when it took the write lock up front, ids of a
+    database are committed in order.
+    """
+    rows = [(message_id, sender_user_id, target_user_id, text, sent_time)
+            for message_id, (sender_user_id, target_user_id, text)
+            in zip(_get_id_generator().next_ids(len(messages)), messages)]
+
+    keys = _user_keys(connection, {user_id for message in messages for user_id in message[:2]})
+
+    connection.execute(UserMessageModel.__table__.insert(), [
+        {'id': message_id, 'sender_key': keys[sender_user_id], 'target_key': keys[target_user_id],
+         'text': text, 'sent_time': sent_time}
+        for message_id, sender_user_id, target_user_id, text, sent_time in rows])
+    search.index_messages(connection, [
+        (message_id, keys[target_user_id], text) for message_id, _, target_user_id, text, _ in rows])
+    _count_new_messages(connection, Counter(keys[target_user_id] for _, target_user_id, _ in messages))
+    return rows
+
+
+def _count_new_messages(connection, counts):
+    """Add ``counts``, {target_key: number of new messages}, to the counters of the targets.
+
+    New messages are counted as unread: ids are time ordered, a message only
+    gets an id below the read marker when the clocks of two nodes disagree,
+    ``reconcile_counters`` repairs those.
+    """
+    user_model = UserModel.__table__
+    counted_key = bindparam('counted_key', type_=UserModel.id.type)
+    added_count = bindparam('added_count', type_=UserModel.message_count.type)
+
+    connection.execute(
+        user_model.update()
+        .where(user_model.c.id == counted_key)
+        .values(message_count=user_model.c.message_count + added_count,
+                unread_count=user_model.c.unread_count + added_count,
+                mailbox_version=user_model.c.mailbox_version + 1),
+        [{'counted_key': key, 'added_count': count} for key, count in counts.items()])
+
+
+def _user_key(bind, user_id):
+    """Key of ``user_id`` on the database of ``bind``, None when it has none: nothing was sent
+    by or to that user there. See ``message_api.user_keys``."""
+    user_key_cache = _get_user_key_cache()
+    database = engines.bind_url(bind)
+    key = user_key_cache.get(database, user_id)
+    if key is None:
+        key = bind.execute(select([UserModel.id]).where(UserModel.user_id == user_id)).scalar()
+        if key is not None:
+            user_key_cache.set(database, user_id, key)
+    return key
+
+
+def _user_keys(connection, user_ids):
+    """Keys of ``user_ids`` on the database of ``connection``, {user_id: key}, users without one
+    are inserted within its transaction."""
+    user_key_cache = _get_user_key_cache()
+    database = engines.bind_url(connection)
+    user_model = UserModel.__table__
+
+    keys = {}
+    for user_id in user_ids:
+        key = user_key_cache.get(database, user_id)
+        if key is not None:
+            keys[user_id] = key
+    missing = [user_id for user_id in user_ids if user_id not in keys]
+    if not missing:
+        return keys
+
+    for user_id, key in connection.execute(
+            select([user_model.c.user_id, user_model.c.id]).where(user_model.c.user_id.in_(missing))):
+        user_key_cache.set(database, user_id, key)
+        keys[user_id] = key
+
+    new_user_ids = [user_id for user_id in missing if user_id not in keys]
+    if new_user_ids:
+        connection.execute(user_model.insert(), [{'user_id': user_id} for user_id in new_user_ids])
+        # not cached until committed, see UserKeyCache
+        keys.update(connection.execute(
+            select([user_model.c.user_id, user_model.c.id]).where(user_model.c.user_id.in_(new_user_ids))).fetchall())
+    return keys
+
+
+_user_key_cache = None
+_user_key_cache_lock = threading.Lock()
+
+
+def _get_user_key_cache():
+    global _user_key_cache
+    max_size = app.config['MESSAGES_USER_KEY_CACHE_SIZE']
+    with _user_key_cache_lock:
+        if _user_key_cache is None or _user_key_cache.max_size != max_size:
+            _user_key_cache = UserKeyCache(max_size)
+        return _user_key_cache
+
+
+def _forget_user_keys(*args, **kwargs):
+    # keys are reused once the table is created again
+    if _user_key_cache is not None:
+        _user_key_cache.clear()
+
+
+_id_generator = None
+_id_generator_lock = threading.Lock()
+
+
+def _get_id_generator():
+    """Generator of message ids of this process, its node id is ``MESSAGES_ID_NODE`` plus the
+    ``MESSAGES_ID_WORKER`` environment variable, which gunicorn.conf.py sets for every worker."""
+    global _id_generator
+    with _id_generator_lock:
+        if _id_generator is None or _id_generator[0] != os.getpid():
+            node_id = app.config['MESSAGES_ID_NODE'] + int(os.environ.get('MESSAGES_ID_WORKER', 0))
+            _id_generator = (os.getpid(), IdGenerator(node_id))
+        return _id_generator[1]
+
+
+@contextmanager
+def _write_transaction(user_id):
+    """Transaction of a write to the mailbox of ``user_id``, committed when the
+    block exits, rolled back if it raises.
+
+    Yields the session, or a connection to the shard of ``user_id`` or of the
+    single writer connection pool with the 'concurrent' SQLite profile (see
+    ``message_api.engines``), all of them execute core statements.
+    """
+    shard = _shard_of(user_id)
+    if shard is not None:
+        with shard.writer.begin() as connection:
+            yield connection
+        return
+
+    writer = _get_writer_engine()
+    if writer is not None:
+        with writer.begin() as connection:
+            yield connection
+        return
+
+    try:
+        yield db.session
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+
+
+_writer_engine = None
+_writer_engine_lock = threading.Lock()
+
+
+def _get_writer_engine():
+    global _writer_engine
+    key = (app.config['SQLALCHEMY_DATABASE_URI'], app.config['SQLITE_PROFILE'])
+
+    with _writer_engine_lock:
+        if _writer_engine is None or _writer_engine[0] != key:
+            _writer_engine = (key, engines.writer_engine(app.config, key[0]))
+        return _writer_engine[1]
+
+
+@contextmanager
+def _mailbox_database(user_id):
+    """Executes queries over the mailbox of ``user_id`` on the database that holds it."""
+    shard = _shard_of(user_id)
+    if shard is None:
+        yield db.session
+        return
+
+    with shard.engine.connect() as connection:
+        yield connection
+
+
+def _shard_of(user_id):
+    """Shard of the mailbox of ``user_id``, None when the database is not sharded."""
+    shard_router = _get_shard_router()
+    return shard_router.shard_for(user_id) if shard_router is not None else None
+
+
+def _group_by_shard(messages, indexes):
+    """Split the ``indexes`` of (sender_user_id, target_user_id, text) ``messages`` by shard of their target."""
+    shard_router = _get_shard_router()
+    if shard_router is None:
+        return [list(indexes)]
+
+    groups = {}
+    for i in indexes:
+        groups.setdefault(shard_router.shard_for(messages[i][1]).number, []).append(i)
+    return list(groups.values())
+
+
+_shard_router = None
+_shard_router_lock = threading.Lock()
+
+
+def _get_shard_router():
+    """Router of mailboxes to ``SQLALCHEMY_SHARDS``, None when the database is not sharded.
+
+    Shards are brought to the latest schema when first used.
+    """
+    global _shard_router
+    shard_uris = tuple(sorted(app.config['SQLALCHEMY_SHARDS'].items()))
+    if not shard_uris:
+        return None
+
+    key = (shard_uris, app.config['SQLALCHEMY_SHARD_VNODES'])
+    with _shard_router_lock:
+        if _shard_router is None or _shard_router[0] != key:
+            shards = []
+            for number, uri in shard_uris:
+                engine = create_engine(uri, **engines.engine_options(app.config, uri))
+                engines.configure_engine(engine, app.config)
+                migrations.upgrade(engine)
+                shards.append(Shard(int(number), engine, engines.writer_engine(app.config, uri)))
+            _shard_router = (key, ShardRouter(shards, vnodes=app.config['SQLALCHEMY_SHARD_VNODES']))
+        return _shard_router[1]
+
+
+_write_behind_queue = None
+_write_behind_queue_lock = threading.Lock()
+
+
+def _get_write_behind_queue():
+    global _write_behind_queue
+    with _write_behind_queue_lock:
+        # the flusher thread does not survive a fork, every worker process starts its own
+        if _write_behind_queue is None or _write_behind_queue.pid != os.getpid():
+            _write_behind_queue = WriteBehindQueue(
+                app._get_current_object(),
+                add_messages,
+                max_size=app.config['MESSAGES_WRITE_BEHIND_QUEUE_SIZE'],
+                batch_size=app.config['MESSAGES_WRITE_BEHIND_BATCH_SIZE'],
+                max_linger=app.config['MESSAGES_WRITE_BEHIND_MAX_LINGER_MS'] / 1000,
+                enqueue_timeout=app.config['MESSAGES_WRITE_BEHIND_ENQUEUE_TIMEOUT_MS'] / 1000)
+        return _write_behind_queue
+
+
+def queue_depths():
+    """What this process has waiting, without starting anything: messages to store, clients
+    subscribed to new messages, and connections in use by database pool."""
+    write_behind_queue = _write_behind_queue
+    notification_hub = _notification_hub[1] if _notification_hub is not None else None
+    pools = {'primary': db.engine.pool}
+    if _writer_engine is not None and _writer_engine[1] is not None:
+        pools['writer'] = _writer_engine[1].pool
+
+    return {
+        'write_behind': (write_behind_queue.qsize()
+                         if write_behind_queue is not None and write_behind_queue.pid == os.getpid() else 0),
+        'subscribers': notification_hub.subscribers() if isinstance(notification_hub, NotificationHub) else 0,
+        'connections': {name: pool.checkedout() for name, pool in pools.items() if isinstance(pool, QueuePool)},
+    }
+
+
+def get_messages(user_id, get_old_messages=False, page=None, page_size=None, mark_as_read=True):
+    """Messages of ``user_id``, only the unread ones unless ``get_old_messages`` or paginating.
+
+    With ``mark_as_read`` the read marker is advanced past the returned messages.
+    """
+    unread_only = not get_old_messages and page is None and page_size is None
+
+    mailbox_cache = _get_mailbox_cache()
+    if unread_only and mailbox_cache is not None:
+        unread = _cached_unread_messages(mailbox_cache, user_id)
+        if unread is not None:
+            if mark_as_read and unread:
+                _advance_read_marker(user_id, unread[-1][0])
+            return [message for _, message in unread]
+
+    with _mailbox_reader(user_id) as reader:
+        messages_filter = _mailbox_query(
+            user_id, _user_key(reader, user_id), after=_read_marker(user_id, reader) if unread_only else None)
+
+        if page is not None or page_size is not None:
+            if page_size is None:
+                page_size = 10
+            messages_filter = messages_filter.limit(page_size)
+            messages_filter = messages_filter.offset(page_size * page)
+
+        messages = reader.execute(messages_filter.statement).fetchall()
+    result = serialize_messages(messages)
+
+    if mark_as_read and messages:
+        # messages are sorted by id, the last one is the latest
+        _advance_read_marker(user_id, messages[-1].id)
+
+    return result
+
+
+def iter_messages(user_id, get_old_messages=False, mark_as_read=True):
+    """Like ``get_messages`` without pagination, but yields the messages one by one.
+
+    Rows are fetched ``MESSAGES_STREAM_BATCH_SIZE`` at a time with a server side
+    cursor where the driver supports it, so memory use does not depend on the
+    mailbox size. The read marker is advanced once every message was yielded.
+    """
+    batch_size = app.config['MESSAGES_STREAM_BATCH_SIZE']
+    latest_message_id = None
+
+    with _mailbox_reader(user_id) as reader:
+        messages_filter = _mailbox_query(
+            user_id, _user_key(reader, user_id), after=None if get_old_messages else _read_marker(user_id, reader))
+        result = reader.execute(messages_filter.statement.execution_options(stream_results=True))
+
+        for messages in iter(lambda: result.fetchmany(batch_size), []):
+            for message in messages:
+                yield serialize_message(message)
+            latest_message_id = messages[-1].id
+
+    if mark_as_read and latest_message_id:
+        _advance_read_marker(user_id, latest_message_id)
+
+
+def _mailbox_query(user_id, target_key, after=None):
+    """Messages of ``user_id``, whose key is ``target_key``, in mailbox order, by id, only those after
+    the id ``after`` if given.
+
+    Without a key the user has no messages, the query has no rows.
+    """
+    messages_filter = (db.session.query(*_message_columns(user_id))
+                       .filter(UserMessageModel.target_key == target_key)
+                       .order_by(UserMessageModel.id))
+
+    if after is not None:
+        messages_filter = messages_filter.filter(UserMessageModel.id > after)
+
+    return messages_filter
+
+
+def _read_marker(user_id, reader):
+    """Id of the last message read by ``user_id``, None if nothing was read."""
+    return reader.execute(
+        select([UserModel.last_message_read_id]).where(UserModel.user_id == user_id)).scalar()
+
+
+def _cached_unread_messages(mailbox_cache, user_id):
+    """Unread (id, message) pairs of ``user_id``, loaded into the cache on a miss.
+
+    Returns None when the user has too many unread messages to be cached,
+    which is cached too. Entries are loaded from the primary, a lagging replica would leave
+    messages out of them until they expire.
+    """
+    entry = mailbox_cache.get(user_id)
+    if entry is not None:
+        return entry.unread
+
+    generation = mailbox_cache.generation(user_id)
+    max_unread = app.config['MESSAGES_CACHE_MAX_UNREAD']
+    with _mailbox_database(user_id) as database:
+        read_marker = _read_marker(user_id, database)
+        messages = database.execute(
+            _mailbox_query(user_id, _user_key(database, user_id), after=read_marker)
+            .limit(max_unread + 1).statement).fetchall()
+    if len(messages) > max_unread:
+        mailbox_cache.set(user_id, MailboxEntry(read_marker, None), generation)
+        return None
+
+    unread = [(message.id, serialize_message(message)) for message in messages]
+    mailbox_cache.set(user_id, MailboxEntry(read_marker, unread), generation)
+    return unread
+
+
+@contextmanager
+def _mailbox_reader(user_id):
+    """Executes the read-only queries of a listing of ``user_id``'s mailbox.
+
+    A connection to a replica when ``SQLALCHEMY_REPLICA_URIS`` is set and the
+    mailbox was not written recently, else the primary or the shard of ``user_id``.
+    """
+    replica_router = _get_replica_router() if _get_shard_router() is None else None
+    for replica in replica_router.replicas_for(user_id) if replica_router is not None else []:
+        try:
+            connection = replica.connect()
+        except DBAPIError:
+            app.logger.warning('Replica %r is unavailable', replica.url, exc_info=True)
+            replica_router.failed(replica)
+            continue
+
+        try:
+            with connection:
+                yield connection
+        except DBAPIError:
+            replica_router.failed(replica)
+            raise
+        return
+
+    with _mailbox_database(user_id) as database:
+        yield database
+
+
+_replica_router = None
+_replica_router_lock = threading.Lock()
+
+
+def _get_replica_router():
+    """Router of reads to ``SQLALCHEMY_REPLICA_URIS``, None without replicas."""
+    global _replica_router
+    replica_uris = tuple(app.config['SQLALCHEMY_REPLICA_URIS'])
+    if not replica_uris:
+        return None
+
+    with _replica_router_lock:
+        if _replica_router is None or _replica_router[0] != replica_uris:
+            replicas = []
+            for uri in replica_uris:
+                replica = create_engine(uri, **engines.engine_options(app.config, uri))
+                engines.configure_engine(replica, app.config)
+                replicas.append(replica)
+            _replica_router = (replica_uris, ReplicaRouter(
+                replicas,
+                retry_after=app.config['DATABASE_REPLICA_RETRY_AFTER'],
+                read_after_write_window=app.config['DATABASE_READ_AFTER_WRITE_WINDOW'],
+                max_users=app.config['DATABASE_READ_AFTER_WRITE_MAX_USERS']))
+        return _replica_router[1]
+
+
+def replicas():
+    """Engines of the replicas listings are read from, none when sharded."""
+    replica_router = _get_replica_router() if _get_shard_router() is None else None
+    return replica_router.replicas if replica_router is not None else []
+
+
+def _mailbox_written(user_id):
+    replica_router = _get_replica_router()
+    if replica_router is not None:
+        replica_router.wrote(user_id)
+
+
+_mailbox_cache = None
+_mailbox_cache_lock = threading.Lock()
+
+
+def _get_mailbox_cache():
+    """The cache configured by ``MESSAGES_CACHE``, 'memory' or the import path of a
+    factory called with the app config, None when caching is disabled."""
+    global _mailbox_cache
+    backend = app.config['MESSAGES_CACHE']
+    if not backend:
+        return None
+
+    with _mailbox_cache_lock:
+        if _mailbox_cache is None or _mailbox_cache[0] != backend:
+            if backend == 'memory':
+                mailbox_cache = InProcessMailboxCache(
+                    ttl=app.config['MESSAGES_CACHE_TTL'],
+                    max_users=app.config['MESSAGES_CACHE_MAX_USERS'],
+                    max_bytes=app.config['MESSAGES_CACHE_MAX_BYTES'],
+                    max_unread=app.config['MESSAGES_CACHE_MAX_UNREAD'])
+            else:
+                mailbox_cache = import_string(backend)(app.config)
+            _mailbox_cache = (backend, mailbox_cache)
+        return _mailbox_cache[1]
+
+
+def _messages_added(rows):
+    """Called once new (id, sender, target, text, sent_time) ``rows`` were committed."""
+    messages_by_target = {}
+    for row in rows:
+        messages_by_target.setdefault(row[2], []).append((row[0], serialize_message(row)))
+
+    mailbox_cache = _get_mailbox_cache()
+    notification_hub = _get_notification_hub()
+    for target_user_id, messages in messages_by_target.items():
+        _mailbox_written(target_user_id)
+        if mailbox_cache is not None:
+            mailbox_cache.append(target_user_id, messages)
+        notification_hub.publish(target_user_id, messages)
+
 
+def subscribe_to_messages(user_id):
+    """Subscription to the new messages of ``user_id``, to be closed once done."""
+    return _get_notification_hub().subscribe(user_id)
 
-def get_messages(user_id, get_old_messages=False, page=None, page_size=None):
 
-    messages_filter = (UserMessageModel.query
-                       .filter_by(target=user_id)
-                       .order_by(UserMessageModel.sent_time))
+def wait_for_messages(subscription, after_id, timeout):
+    """Messages of the subscribed user with an id after ``after_id``, in id order.
 
-    if not get_old_messages and page is None and page_size is None:
-        user_data = UserModel.query.filter_by(user_id=user_id).first()
-        if user_data and user_data.last_message_read_timestamp:
-            messages_filter = messages_filter.filter(UserMessageModel.sent_time > user_data.last_message_read_timestamp)
+    When there are none, waits up to ``timeout`` seconds for new ones. Only
+    queries the database when the subscription can't tell which messages came
+    after ``after_id``, or when the wait of a partial subscription times out,
+    the message may have been posted through another process. Never holds a
+    connection while waiting.
+    """
+    messages = subscription.wait(after_id, timeout=0)
+    if messages is None:
+        messages = _catch_up(subscription, after_id)
 
-    if page is not None or page_size is not None:
-        if page_size is None:
-            page_size = 10
-        messages_filter = messages_filter.limit(page_size)
-        messages_filter = messages_filter.offset(page_size * page)
+    if not messages and timeout > 0:
+        messages = subscription.wait(after_id, timeout)
+        if messages is None or (not messages and getattr(subscription, 'partial', False)):
+            # the buffer overflowed while waiting, or the wait timed out
+            return _catch_up(subscription, after_id)
 
-    messages = messages_filter.all()
+    return messages
 
-    latest_message = max(messages, key=lambda x: x.sent_time, default=None)
-    if latest_message and latest_message.sent_time:
-        _set_last_read_timestamp(user_id, latest_message.sent_time)
 
-    return user_messages_schema.dump(messages)
+def _catch_up(subscription, after_id):
+    limit = app.config['MESSAGES_MAX_PAGE_SIZE']
+    with _mailbox_database(subscription.user_id) as database:
+        rows = database.execute(
+            _mailbox_query(subscription.user_id, _user_key(database, subscription.user_id), after=after_id)
+            .limit(limit)
+            .statement).fetchall()
+    db.session.close()
+
+    if len(rows) < limit:
+        subscription.caught_up(rows[-1].id if rows else after_id)
+    return serialize_messages(rows) if rows else []
+
+
+def latest_message_id(user_id):
+    """Id of the latest message of ``user_id``, 0 when there are none."""
+    with _mailbox_database(user_id) as database:
+        latest_id = database.execute(
+            select([func.max(UserMessageModel.id)])
+            .where(UserMessageModel.target_key == _user_key(database, user_id))).scalar()
+    db.session.close()
+    return latest_id or 0
+
+
+_notification_hub = None
+_notification_hub_lock = threading.Lock()
+
+
+def _get_notification_hub():
+    """The hub configured by ``MESSAGES_NOTIFICATION_HUB``, 'memory' or the import
+    path of a factory called with the app config. The in-process hub is partial
+    with more than one ``WSGI_WORKERS``."""
+    global _notification_hub
+    backend = app.config['MESSAGES_NOTIFICATION_HUB']
+    partial = app.config['WSGI_WORKERS'] > 1
+
+    with _notification_hub_lock:
+        if _notification_hub is None or _notification_hub[0] != (backend, partial):
+            if backend == 'memory':
+                notification_hub = NotificationHub(
+                    buffer_size=app.config['MESSAGES_NOTIFICATION_BUFFER_SIZE'],
+                    max_users=app.config['MESSAGES_NOTIFICATION_MAX_USERS'],
+                    partial=partial)
+            else:
+                notification_hub = import_string(backend)(app.config)
+            _notification_hub = ((backend, partial), notification_hub)
+        return _notification_hub[1]
+
+
+def _messages_deleted(user_id):
+    _mailbox_written(user_id)
+    mailbox_cache = _get_mailbox_cache()
+    if mailbox_cache is not None:
+        mailbox_cache.invalidate(user_id)
+
+
+def _read_marker_moved(user_id, read_marker):
+    """Called once the read marker of ``user_id`` was committed, None when it is unknown."""
+    _mailbox_written(user_id)
+    mailbox_cache = _get_mailbox_cache()
+    if mailbox_cache is not None:
+        if read_marker is None:
+            mailbox_cache.invalidate(user_id)
+        else:
+            mailbox_cache.advance(user_id, read_marker)
+
+
+def get_messages_after(user_id, cursor=None, page_size=10, mark_as_read=True):
+    """Keyset pagination over every message of ``user_id``.
+
+    Returns the page that follows ``cursor`` (from the start when None) and the
+    cursor for the next page, None once the end of the mailbox was reached.
+    """
+    after = decode_cursor(cursor) if cursor else None
+
+    # one extra row tells if there is a next page without a count query
+    with _mailbox_reader(user_id) as reader:
+        messages = reader.execute(
+            _mailbox_query(user_id, _user_key(reader, user_id), after=after).limit(page_size + 1).statement).fetchall()
+    has_next_page = len(messages) > page_size
+    messages = messages[:page_size]
+    result = serialize_messages(messages)
+
+    next_cursor = None
+    if has_next_page:
+        next_cursor = encode_cursor(messages[-1].id)
+
+    if mark_as_read and messages:
+        _advance_read_marker(user_id, messages[-1].id)
+
+    return result, next_cursor
+
+
+def search_messages(user_id, query, page=0, page_size=10):
+    """Messages of ``user_id`` with every term of ``query``, best matches first, see ``message_api.search``.
+
+    Read or unread, searching does not move the read marker. Raises
+    ValueError when ``query`` has no terms.
+    """
+    terms = search.parse_terms(query)
+    if not terms:
+        raise ValueError('The search has no terms')
+
+    with _mailbox_reader(user_id) as reader:
+        messages = reader.execute(search.search_statement(
+            reader, UserMessageModel.__table__, _message_columns(user_id), _user_key(reader, user_id), terms,
+            limit=page_size, offset=page * page_size, candidates=app.config['MESSAGES_SEARCH_CANDIDATES'])).fetchall()
+    return serialize_messages(messages)
+
+
+def _message_columns(target=None):
+    """Columns of the (id, sender, target, text, sent_time) rows of messages, in the order of
+    UserMessageSchema.Meta.fields. Messages of a mailbox all have the same ``target``, when
+    given it is bound instead of being looked up for every row."""
+    return (UserMessageModel.id, UserMessageModel.sender,
+            UserMessageModel.target if target is None else literal(target, UserModel.user_id.type).label('target'),
+            UserMessageModel.text, UserMessageModel.sent_time)
+
+
+def serialize_message(row):
+    """Fast path of ``user_message_schema.dump`` for an (id, sender, target, text, sent_time) row.
+
+    Listings execute the core statement of these columns instead of loading
+    models, and build the same dict marshmallow would, fields in the same order.
+    """
+    message_id, sender, target, text, sent_time = row
+    return {'id': message_id, 'sender': sender, 'target': target, 'text': text, 'sent_time': sent_time.isoformat()}
+
+
+def serialize_messages(rows):
+    with metrics.serialization():
+        return [serialize_message(row) for row in rows]
+
+
+def encode_cursor(message_id):
+    value = str(message_id).encode()
+    return base64.urlsafe_b64encode(value).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Id of the last message before the page, raises ValueError if ``cursor`` was not built by ``encode_cursor``."""
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        # cursors of older versions were 'sent_time|id'
+        return int(value.split('|')[-1])
+    except ValueError as e:
+        raise ValueError(f'Invalid cursor {cursor!r}') from e
 
 
 def delete_message(user_id, *message_ids):
-    deleted_count = db.session.query(UserMessageModel)\
-        .filter_by(target=user_id)\
-        .filter(UserMessageModel.id.in_(message_ids))\
-        .delete(synchronize_session=False)
+    user_message_model = UserMessageModel.__table__
+    user_model = UserModel.__table__
+    read_id = user_model.c.last_message_read_id
+
+    with _write_transaction(user_id) as connection:
+        target_key = _user_key(connection, user_id)
+        deleted = (select([func.count()])
+                   .where(user_message_model.c.target_key == target_key)
+                   .where(user_message_model.c.id.in_(message_ids)))
+        deleted_unread = deleted.where(or_(read_id.is_(None), user_message_model.c.id > read_id))
+        connection.execute(
+            user_model.update()
+            .where(user_model.c.user_id == user_id)
+            .where(deleted.as_scalar() > 0)
+            .values(message_count=user_model.c.message_count - deleted.as_scalar(),
+                    unread_count=user_model.c.unread_count - deleted_unread.as_scalar(),
+                    mailbox_version=user_model.c.mailbox_version + 1))
+        search.unindex_messages(connection, select([user_message_model.c.id])
+                                .where(user_message_model.c.target_key == target_key)
+                                .where(user_message_model.c.id.in_(message_ids)))
+        deleted_count = connection.execute(
+            user_message_model.delete()
+            .where(user_message_model.c.target_key == target_key)
+            .where(user_message_model.c.id.in_(message_ids))).rowcount
 
-    db.session.commit()
+    if deleted_count:
+        _messages_deleted(user_id)
     return deleted_count
 
 
-def _set_last_read_timestamp(user_id, timestamp):
-    user_data = UserModel.query.filter_by(user_id=user_id).first()
-    if not user_data:
-        user_data = UserModel(user_id, last_message_read_timestamp=timestamp)
-        db.session.add(user_data)
+def acknowledge_messages(user_id, message_id=None):
+    """Mark the messages of ``user_id`` as read up to ``message_id``, up to the latest one when None.
+
+    Returns True if the read marker moved forward, False if it was already
+    past that message, and None when the message is not in the mailbox.
+    """
+    with _mailbox_database(user_id) as database:
+        messages_filter = (select([func.max(UserMessageModel.id)])
+                           .where(UserMessageModel.target_key == _user_key(database, user_id)))
+        if message_id is not None:
+            messages_filter = messages_filter.where(UserMessageModel.id == message_id)
+        found_message_id = database.execute(messages_filter).scalar()
+    if found_message_id is None:
+        return False if message_id is None else None
+
+    return _advance_read_marker(user_id, found_message_id)
+
+
+def _advance_read_marker(user_id, message_id):
+    """Move the read marker of ``user_id`` forward to ``message_id``, never backwards.
+
+    A conditional update, and a conditional insert the first time a user reads.
+    Returns True if the marker moved.
+    """
+    update_marker, insert_marker = _read_marker_statements(user_id, message_id)
+
+    for _ in range(2):
+        try:
+            with _write_transaction(user_id) as connection:
+                advanced = connection.execute(update_marker).rowcount or connection.execute(insert_marker).rowcount
+            break
+        except IntegrityError:
+            # another request inserted the user first, now the update applies
+            pass
     else:
-        user_data.last_message_read_timestamp = timestamp
-    db.session.commit()
+        advanced = False
+
+    # when it did not move, it is already past this message and the caller had a stale view
+    _read_marker_moved(user_id, message_id if advanced else None)
+    return bool(advanced)
+
+
+def _read_marker_statements(user_id, message_id):
+    """Update moving the read marker of ``user_id`` forward to ``message_id``, and the insert
+    of the marker for when the user has none yet. Both keep the unread counter in step."""
+    user_message_model = UserMessageModel.__table__
+    user_model = UserModel.__table__
+    read_id = user_model.c.last_message_read_id
+    # of the updated user
+    mailbox = select([func.count()]).where(user_message_model.c.target_key == user_model.c.id)
+
+    newly_read = (mailbox
+                  .where(user_message_model.c.id <= message_id)
+                  .where(or_(read_id.is_(None), user_message_model.c.id > read_id)))
+    # MySQL assigns in order and the count needs the old marker
+    update_marker = (user_model.update(preserve_parameter_order=True)
+                     .where(user_model.c.user_id == user_id)
+                     .where(or_(read_id.is_(None), read_id < message_id))
+                     .values([(user_model.c.unread_count, user_model.c.unread_count - newly_read.as_scalar()),
+                              (read_id, message_id)]))
+    # without a row the user has no key, and no messages
+    insert_marker = user_model.insert().from_select(
+        ['user_id', 'last_message_read_id', 'message_count', 'unread_count'],
+        select([
+            literal(user_id, UserModel.user_id.type),
+            literal(message_id, UserModel.last_message_read_id.type),
+            literal(0, UserModel.message_count.type),
+            literal(0, UserModel.unread_count.type),
+        ]).where(~exists().where(user_model.c.user_id == user_id)))
+    return update_marker, insert_marker
+
+
+def mailbox_version(user_id, with_read_marker=False):
+    """Version of the mailbox of ``user_id``, it changes whenever a message is added or deleted.
+
+    With ``with_read_marker`` it also changes when the read marker moves, as
+    listings of unread messages do. Returns a string, for ETags. With the mailbox
+    cache it is the one of the cached unread messages, read without querying the database.
+    """
+    mailbox_cache = _get_mailbox_cache() if with_read_marker else None
+    if mailbox_cache is not None:
+        _cached_unread_messages(mailbox_cache, user_id)
+        entry = mailbox_cache.get(user_id)
+        if entry is not None and entry.unread is not None:
+            # ids are never reused, the read marker, last id and count only repeat for the same messages
+            last_id = entry.unread[-1][0] if entry.unread else 0
+            return f'c{entry.read_marker or 0}.{last_id}.{len(entry.unread)}'
+
+    user_model = UserModel.__table__
+    with _mailbox_reader(user_id) as reader:
+        user = reader.execute(
+            select([user_model.c.mailbox_version, user_model.c.last_message_read_id])
+            .where(user_model.c.user_id == user_id)).first()
+
+    version, read_marker = user if user is not None else (0, None)
+    return f'{version}.{read_marker or 0}' if with_read_marker else str(version)
+
+
+def count_messages(user_id):
+    """Unread and total number of messages in the mailbox of ``user_id``.
+
+    Read from counters of the user that every write to the mailbox maintains
+    in its transaction, so it costs one row whatever the size of the mailbox.
+    """
+    user_model = UserModel.__table__
+    with _mailbox_reader(user_id) as reader:
+        counters = reader.execute(
+            select([user_model.c.unread_count, user_model.c.message_count])
+            .where(user_model.c.user_id == user_id)).first()
+
+    unread_count, message_count = counters if counters is not None else (0, 0)
+    return {'unread': unread_count, 'total': message_count}
+
+
+def reconcile_counters(batch_size=1000):
+    """Recount the messages of every user whose counters drifted from their mailbox, on every database.
+
+    Users are recounted ``batch_size`` at a time, one transaction each.
+    Returns the number of users whose counters were repaired.
+    """
+    user_model = UserModel.__table__
+
+    repaired_count = 0
+    for _, engine, writer in databases():
+        last_id = 0
+        while True:
+            ids = engine.execute(
+                select([user_model.c.id]).where(user_model.c.id > last_id)
+                .order_by(user_model.c.id).limit(batch_size)).fetchall()
+            if not ids:
+                break
+
+            with writer.begin() as connection:
+                repaired_count += connection.execute(
+                    _recount_statement()
+                    .where(user_model.c.id > last_id)
+                    .where(user_model.c.id <= ids[-1].id)).rowcount
+            last_id = ids[-1].id
+
+    return repaired_count
+
+
+def _recount_statement():
+    """Update of the counters of users that don't match their mailbox."""
+    user_message_model = UserMessageModel.__table__
+    user_model = UserModel.__table__
+    read_id = user_model.c.last_message_read_id
+
+    mailbox = select([func.count()]).where(user_message_model.c.target_key == user_model.c.id)
+    message_count = mailbox.as_scalar()
+    unread_count = mailbox.where(or_(read_id.is_(None), user_message_model.c.id > read_id)).as_scalar()
+    return (user_model.update()
+            .where(or_(user_model.c.message_count != message_count, user_model.c.unread_count != unread_count))
+            .values(message_count=message_count, unread_count=unread_count))
+
+
+def databases():
+    """(shard, engine, writer engine) of every database holding mailboxes, the shard is None
+    for ``SQLALCHEMY_DATABASE_URI`` (which is included unless it is a shard itself)."""
+    shard_router = _get_shard_router()
+    shards = shard_router.shards if shard_router is not None else []
+
+    databases = [(shard, shard.engine, shard.writer) for shard in shards]
+    if str(db.engine.url) not in {str(shard.engine.url) for shard in shards}:
+        databases.append((None, db.engine, _get_writer_engine() or db.engine))
+    return databases
+
+
+def rebalance_shards(batch_size=1000):
+    """Move every mailbox that is not on the shard it belongs to, there.
+
+    Mailboxes are moved from every shard, and from ``SQLALCHEMY_DATABASE_URI``
+    when it is not a shard itself, so an existing database can be sharded.
+    Messages are copied ``batch_size`` at a time, each batch is deleted from
+    the source once committed on the destination, and the read marker and
+    counters go last. It can run while serving: moved messages keep their ids, and
+    mailboxes being moved are incomplete until they are. If interrupted, run it
+    again. Returns the number of mailboxes moved.
+
+    Keys of users are per database, messages are copied with the keys of their
+    users on the destination. Users stay on the source, keys of the messages
+    they sent there still reference them, with an empty mailbox.
+    """
+    shard_router = _get_shard_router()
+    if shard_router is None:
+        raise RuntimeError('SQLALCHEMY_SHARDS is not set')
+
+    user_message_model = UserMessageModel.__table__
+    user_model = UserModel.__table__
+    moved_count = 0
+    for source_shard, source, source_writer in databases():
+        # users with a mailbox
+        user_ids = source.execute(
+            select([user_model.c.id, user_model.c.user_id])
+            .where(or_(exists().where(user_message_model.c.target_key == user_model.c.id),
+                       user_model.c.last_message_read_id.isnot(None)))).fetchall()
+        for source_key, user_id in user_ids:
+            destination = shard_router.shard_for(user_id)
+            if destination is source_shard:
+                continue
+
+            while True:
+                messages = source.execute(
+                    select(_message_columns())
+                    .where(user_message_model.c.target_key == source_key)
+                    .order_by(user_message_model.c.id)
+                    .limit(batch_size)).fetchall()
+                if not messages:
+                    break
+
+                moved_ids = [message.id for message in messages]
+                with destination.writer.begin() as connection:
+                    # copied by a run that was interrupted before deleting them from the source
+                    connection.execute(user_message_model.delete().where(user_message_model.c.id.in_(moved_ids)))
+                    search.unindex_messages(connection, moved_ids)
+                    keys = _user_keys(connection, {user_id} | {message.sender for message in messages})
+                    connection.execute(user_message_model.insert(), [
+                        {'id': message.id, 'sender_key': keys[message.sender], 'target_key': keys[user_id],
+                         'text': message.text, 'sent_time': message.sent_time}
+                        for message in messages])
+                    search.index_messages(
+                        connection, [(message.id, keys[user_id], message.text) for message in messages])
+                with source_writer.begin() as connection:
+                    connection.execute(user_message_model.delete().where(user_message_model.c.id.in_(moved_ids)))
+                    search.unindex_messages(connection, moved_ids)
+
+            read_marker = _read_marker(user_id, source)
+            version = source.execute(
+                select([user_model.c.mailbox_version]).where(user_model.c.user_id == user_id)).scalar() or 0
+            with destination.writer.begin() as connection:
+                _user_keys(connection, [user_id])
+                if read_marker is not None:
+                    update_marker, _ = _read_marker_statements(user_id, read_marker)
+                    connection.execute(update_marker)
+                connection.execute(_recount_statement().where(user_model.c.user_id == user_id))
+                # past the version of the source, versions of the mailbox are never reused
+                connection.execute(
+                    user_model.update()
+                    .where(user_model.c.user_id == user_id)
+                    .values(mailbox_version=user_model.c.mailbox_version + version + 1))
+            with source_writer.begin() as connection:
+                connection.execute(
+                    user_model.update()
+                    .where(user_model.c.id == source_key)
+                    .values(last_message_read_id=None, last_message_read_timestamp=None,
+                            message_count=0, unread_count=0))
+
+            _messages_deleted(user_id)
+            moved_count += 1
+
+    return moved_count
+
+
+def purge_messages(max_age=None, max_per_user=None, read_max_age=None, batch_size=500, pause=0,
+                   archive=None, archive_path=None):
+    """Delete the messages past the retention policies, on every database.
+
+    - ``max_age``: messages sent longer than this timedelta ago
+    - ``max_per_user``: the oldest messages of mailboxes with more than this many
+    - ``read_max_age``: read messages sent longer than this timedelta ago
+
+    Messages are deleted ``batch_size`` at a time, one short transaction each,
+    ``pause`` seconds apart, so writes to a mailbox never wait long for a purge.
+    With ``archive`` 'table' they are copied to the archive table in the same
+    transaction, with 'ndjson' appended to the ``archive_path`` file before it
+    commits, a batch that failed to commit may be archived twice.
+    Returns the number of messages deleted by policy.
+    """
+    if archive not in (None, '', 'table', 'ndjson'):
+        raise ValueError(f"Archive to 'table' or 'ndjson', not {archive!r}")
+    if archive == 'ndjson' and not archive_path:
+        raise ValueError('Archiving to ndjson needs a path')
+
+    user_message_model = UserMessageModel.__table__
+    user_model = UserModel.__table__
+    candidates = select([user_message_model.c.id, user_message_model.c.target_key]).order_by(user_message_model.c.id)
+
+    now = datetime.utcnow()
+    purged = {'max_age': 0, 'max_per_user': 0, 'read_max_age': 0}
+    batches = dict(batch_size=batch_size, pause=pause, archive=archive, archive_path=archive_path)
+    for _, _, writer in databases():
+        if max_age is not None:
+            purged['max_age'] += _purge_oldest(
+                writer, 'max_age', _sent_before(candidates, now - max_age), **batches)
+
+        if read_max_age is not None:
+            read_id = (select([user_model.c.last_message_read_id])
+                       .where(user_model.c.id == user_message_model.c.target_key).as_scalar())
+            purged['read_max_age'] += _purge_oldest(
+                writer, 'read_max_age',
+                _sent_before(candidates, now - read_max_age).where(user_message_model.c.id <= read_id), **batches)
+
+        if max_per_user is not None:
+            # from the counters, reconcile_counters repairs those that drifted
+            for target_key, excess in writer.execute(
+                    select([user_model.c.id, user_model.c.message_count - max_per_user])
+                    .where(user_model.c.message_count > max_per_user)).fetchall():
+                purged['max_per_user'] += _purge_oldest(
+                    writer, 'max_per_user', candidates.where(user_message_model.c.target_key == target_key),
+                    limit=excess, **batches)
+
+    return purged
+
+
+def _purge_oldest(writer, policy, candidates, batch_size, pause, archive, archive_path, limit=None):
+    """Purge the messages selected by ``candidates``, at most ``limit``, oldest first in batches.
+    Returns how many were deleted."""
+    purged_count = 0
+    last_id = -1
+    while limit is None or purged_count < limit:
+        size = batch_size if limit is None else min(batch_size, limit - purged_count)
+        rows, purged = _purge_batch(
+            writer, candidates.where(UserMessageModel.__table__.c.id > last_id).limit(size), archive, archive_path)
+        purged_count += len(purged)
+        metrics.MESSAGES_PURGED.inc(policy, amount=len(purged))
+        # another purger is on these messages, left to it
+        if len(rows) < size or len(purged) < len(rows):
+            break
+        # ids are time ordered, batches walk them upwards from the oldest
+        last_id = rows[-1].id
+        time.sleep(pause)
+    return purged_count
+
+
+def _sent_before(candidates, moment):
+    # the id range comes from the primary key, the time excludes messages of older versions, whose ids are not times
+    return (candidates
+            .where(UserMessageModel.__table__.c.id < first_id_at(moment))
+            .where(UserMessageModel.__table__.c.sent_time < moment))
+
+
+def _purge_batch(writer, candidates, archive, archive_path):
+    """Delete the messages selected by ``candidates``, a select of (id, target_key), in one transaction,
+    uncount them and archive them first when asked to.
+
+    Only the messages this transaction could lock are deleted, those of another
+    purger running at once are skipped (SQLite has a single writer, it does
+    not lock rows). Returns the (id, target_key) rows selected and those deleted.
+    """
+    user_message_model = UserMessageModel.__table__
+    with writer.begin() as connection:
+        rows = connection.execute(candidates).fetchall()
+        if not rows:
+            return rows, rows
+        purged = rows
+        if connection.dialect.name != 'sqlite':
+            purged = connection.execute(
+                select([user_message_model.c.id, user_message_model.c.target_key])
+                .where(user_message_model.c.id.in_([row.id for row in rows]))
+                .order_by(user_message_model.c.id)
+                .with_for_update(skip_locked=True)).fetchall()
+            if not purged:
+                return rows, purged
+        message_ids = [row.id for row in purged]
+
+        if archive == 'table':
+            # archived with the user ids, the archive does not depend on the keys of a database
+            connection.execute(UserMessageArchiveModel.__table__.insert().from_select(
+                [column.name for column in UserMessageArchiveModel.__table__.columns],
+                select(_message_columns()).where(user_message_model.c.id.in_(message_ids))))
+        elif archive == 'ndjson':
+            messages = connection.execute(
+                select(_message_columns()).where(user_message_model.c.id.in_(message_ids))).fetchall()
+            with open(archive_path, 'a') as archive_file:
+                archive_file.writelines(json.dumps(serialize_message(message)) + '\n' for message in messages)
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
+        if archive:
+            metrics.MESSAGES_ARCHIVED.inc(amount=len(purged))
+
+        user_ids = _uncount_messages(connection, purged)
+        search.unindex_messages(connection, message_ids)
+        connection.execute(user_message_model.delete().where(user_message_model.c.id.in_(message_ids)))
+
+    for user_id in user_ids:
+        _messages_deleted(user_id)
+    return rows, purged
+
+
+def _uncount_messages(connection, rows):
+    """Remove the (id, target_key) ``rows`` about to be deleted from the counters of their targets.
+    Returns the user ids of the targets."""
+    user_model = UserModel.__table__
+    counts = Counter(target_key for _, target_key in rows)
+    users = connection.execute(
+        select([user_model.c.id, user_model.c.user_id, user_model.c.last_message_read_id])
+        .where(user_model.c.id.in_(list(counts)))).fetchall()
+    read_markers = {key: read_marker for key, _, read_marker in users}
+    unread_counts = Counter(target_key for message_id, target_key in rows
+                            if read_markers.get(target_key) is None or message_id > read_markers[target_key])
+
+    uncounted_key = bindparam('uncounted_key', type_=UserModel.id.type)
+    removed_count = bindparam('removed_count', type_=UserModel.message_count.type)
+    removed_unread_count = bindparam('removed_unread_count', type_=UserModel.unread_count.type)
+    connection.execute(
+        user_model.update()
+        .where(user_model.c.id == uncounted_key)
+        .values(message_count=user_model.c.message_count - removed_count,
+                unread_count=user_model.c.unread_count - removed_unread_count,
+                mailbox_version=user_model.c.mailbox_version + 1),
+        [{'uncounted_key': key, 'removed_count': count, 'removed_unread_count': unread_counts[key]}
+         for key, count in counts.items()])
+    return [user_id for _, user_id, _ in users]
+
+
+def oldest_message_time():
+    """When the oldest message, on every database, was sent, None without messages."""
+    oldest = []
+    for _, engine, _ in databases():
+        sent_time = engine.execute(
+            select([UserMessageModel.sent_time]).order_by(UserMessageModel.id).limit(1)).scalar()
+        if sent_time is not None:
+            oldest.append(sent_time)
+    return min(oldest, default=None)
 
 
 USER_ID_LEN = 100
 
 
+# 64 bits, but an alias of the rowid in SQLite, which only does that for INTEGER
+MESSAGE_ID_TYPE = db.BigInteger().with_variant(db.Integer(), 'sqlite')
+
+
 class UserMessageModel(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    sender = db.Column(db.String(USER_ID_LEN), nullable=False)
-    target = db.Column(db.String(USER_ID_LEN), nullable=False)
+    __table_args__ = (
+        # serves every mailbox read: filter by target, ordered by id
+        db.Index('ix_user_message_model_target_key_id', 'target_key', 'id'),
+    )
+
+    # see message_api/ids.py
+    id = db.Column(MESSAGE_ID_TYPE, primary_key=True, autoincrement=False)
+    # ids of the users in user_model, see message_api/user_keys.py
+    sender_key = db.Column(db.Integer, nullable=False)
+    target_key = db.Column(db.Integer, nullable=False)
     text = db.Column(db.Text, nullable=False)
     sent_time = db.Column(db.DateTime, nullable=False)
 
-    def __init__(self, sender, target, text, sent_time):
-        self.sender = sender
-        self.target = target
+    def __init__(self, sender_key, target_key, text, sent_time):
+        self.sender_key = sender_key
+        self.target_key = target_key
         self.text = text
         self.sent_time = sent_time
 
 
+class UserMessageArchiveModel(db.Model):
+    """Messages purged by the retention policies, see purge_messages, only indexed by id."""
+    id = db.Column(MESSAGE_ID_TYPE, primary_key=True, autoincrement=False)
+    sender = db.Column(db.String(USER_ID_LEN), nullable=False)
+    target = db.Column(db.String(USER_ID_LEN), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    sent_time = db.Column(db.DateTime, nullable=False)
+
+
 class UserModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.String(USER_ID_LEN), nullable=False)
+    user_id = db.Column(db.String(USER_ID_LEN), nullable=False, unique=True, index=True)
+    # read marker of older versions, the id is the read marker now
     last_message_read_timestamp = db.Column(db.DateTime, nullable=True)
+    last_message_read_id = db.Column(MESSAGE_ID_TYPE, nullable=True)
+    # counters of the mailbox, maintained by every write to it, see count_messages
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # bumped by every added or deleted message, see mailbox_version
+    mailbox_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
-    def __init__(self, user_id, last_message_read_timestamp=None):
+    def __init__(self, user_id, last_message_read_timestamp=None, last_message_read_id=None):
         self.user_id = user_id
         self.last_message_read_timestamp = last_message_read_timestamp
+        self.last_message_read_id = last_message_read_id
+
+
+# the user ids of the keys of a message, looked up by primary key
+UserMessageModel.sender = db.column_property(
+    select([UserModel.user_id]).where(UserModel.id == UserMessageModel.sender_key).as_scalar().label('sender'))
+UserMessageModel.target = db.column_property(
+    select([UserModel.user_id]).where(UserModel.id == UserMessageModel.target_key).as_scalar().label('target'))
+
+event.listen(UserModel.__table__, 'after_drop', _forget_user_keys)
 
 
 class UserMessageSchema(ma.Schema):
@@ -99,4 +1257,6 @@ class UserMessageSchema(ma.Schema):
 
 user_message_schema = UserMessageSchema()
 user_messages_schema = UserMessageSchema(many=True)
-db.create_all()
+
+from message_api import migrations  # noqa: E402  (needs the models above)
+migrations.upgrade()
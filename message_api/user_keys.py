@@ -0,0 +1,48 @@
+"""Integer keys of user ids.
+
+Messages don't repeat the sender and target user id strings in every row and
+in the (target, id) index, they reference users by key: the ``id`` of their
+row in ``user_model``, which every sender and target has. Keys are assigned
+by every database, a user has a different key on every shard.
+
+The store looks keys up in a ``UserKeyCache`` before it filters a mailbox, so
+only the first read of a mailbox by a process costs an extra query. A key
+never changes: rows of ``user_model`` are never deleted, except when the
+table is dropped, which clears the cache.
+"""
+import threading
+from collections import OrderedDict
+
+
+class UserKeyCache:
+    """LRU of the keys of at most ``max_size`` (database url, user id) pairs.
+
+    Only committed keys may be cached, a key inserted by a transaction that
+    rolls back could be assigned to another user.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, database, user_id):
+        with self._lock:
+            key = self._keys.get((database, user_id))
+            if key is not None:
+                self._keys.move_to_end((database, user_id))
+            return key
+
+    def set(self, database, user_id, key):
+        with self._lock:
+            self._keys[(database, user_id)] = key
+            self._keys.move_to_end((database, user_id))
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
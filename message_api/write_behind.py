@@ -0,0 +1,129 @@
+"""Group commit for posted messages.
+
+Posted messages are put on a bounded in-process queue, a background thread
+takes them in groups of up to ``batch_size`` (waiting at most ``max_linger``
+seconds for a group to fill) and stores every group in a single transaction,
+so concurrent posts share one commit instead of queueing for the database.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+
+
+class WriteBehindError(Exception):
+    pass
+
+
+class QueueFull(WriteBehindError):
+    pass
+
+
+class StoreTimeout(WriteBehindError):
+    """The message is still queued, it may be stored later."""
+
+
+class PendingMessage:
+    def __init__(self, message):
+        self.message = message
+        self._stored = threading.Event()
+        self._result = None
+
+    def set_result(self, result):
+        self._result = result
+        self._stored.set()
+
+    def result(self, timeout=None):
+        """Wait until the group of this message was committed and return the stored message."""
+        if not self._stored.wait(timeout):
+            raise StoreTimeout('Timed out waiting for the message to be stored')
+        if self._result is None:
+            raise WriteBehindError('Message could not be stored')
+        return self._result
+
+
+class WriteBehindQueue:
+    """``flush`` is called with a list of messages inside an app context, and
+    must return the stored messages in the same order, None for failed ones."""
+
+    def __init__(self, app, flush, max_size=10000, batch_size=100, max_linger=0.005, enqueue_timeout=0.1):
+        self._app = app
+        self._flush = flush
+        self._queue = queue.Queue(maxsize=max_size)
+        self._batch_size = batch_size
+        self._max_linger = max_linger
+        self._enqueue_timeout = enqueue_timeout
+        self._closed = False
+        self.pid = os.getpid()
+
+        self._thread = threading.Thread(target=self._run, name='write-behind-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, message):
+        """Queue ``message``, when the queue is full wait up to ``enqueue_timeout`` seconds for room."""
+        if self._closed:
+            raise WriteBehindError('Write behind queue is closed')
+
+        pending = PendingMessage(message)
+        try:
+            self._queue.put(pending, timeout=self._enqueue_timeout)
+        except queue.Full:
+            raise QueueFull('Too many messages waiting to be stored') from None
+        return pending
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def join(self):
+        """Wait until every queued message was stored."""
+        self._queue.join()
+
+    def close(self, timeout=5):
+        """Stop accepting messages and wait for the queued ones to be stored."""
+        if self._closed:
+            return
+        self._closed = True
+        deadline = time.monotonic() + timeout
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            # the flusher is stuck or died, queued messages are lost
+            return
+        self._thread.join(max(deadline - time.monotonic(), 0))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._max_linger
+            while batch[-1] is not None and len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+
+            if batch:
+                self._store(batch)
+
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+
+            if stop:
+                return
+
+    def _store(self, batch):
+        try:
+            with self._app.app_context():
+                results = self._flush([pending.message for pending in batch])
+        except Exception:
+            self._app.logger.exception('Failed to store %d queued messages', len(batch))
+            results = [None] * len(batch)
+
+        for pending, result in zip(batch, results):
+            pending.set_result(result)
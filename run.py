@@ -1,6 +1,10 @@
 from os import environ
 
 from message_api import create_app
+from message_api.retention import start_retention
 
 app = create_app(environ.get('CONFIG_NAME', 'development'))
+# the reloader runs the app in a child process
+if not app.debug or environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    start_retention(app)
 app.run(host='0.0.0.0', port=int(environ.get('PORT', 8080)), debug=app.config["DEBUG"])
@@ -0,0 +1,8 @@
+class Clock:
+    """A clock for the ``clock`` arguments of the code under test, it only moves when ``now`` is set."""
+
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,142 @@
+import json
+import threading
+from unittest import TestCase
+
+from clock import Clock
+from test_message_api import app
+from message_api import admission
+from message_api.admission import InProcessAdmissionBackend, InFlightLimiter, route_rates
+
+
+class TokenBuckets(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.backend = InProcessAdmissionBackend(clock=self.clock)
+
+    def test_burst_then_rate(self):
+        self.assertEqual([(True, 0), (True, 0)], [self.backend.acquire('norbert', 1, 2, 0) for _ in range(2)])
+        self.assertEqual((False, 1), self.backend.acquire('norbert', 1, 2, 0))
+
+        self.clock.now = 1
+        self.assertEqual((True, 0), self.backend.acquire('norbert', 1, 2, 0))
+        self.assertFalse(self.backend.acquire('norbert', 1, 2, 0)[0])
+        # other users have their own bucket
+        self.assertTrue(self.backend.acquire('albert', 1, 2, 0)[0])
+
+    def test_waits_up_to_max_wait_for_a_token(self):
+        self.backend.acquire('norbert', 2, 1, 0)
+
+        self.assertEqual((True, 0.5), self.backend.acquire('norbert', 2, 1, 0.5))
+        # the next token is owed to the request that waits
+        self.assertEqual((False, 1), self.backend.acquire('norbert', 2, 1, 0.5))
+
+    def test_refunded_token_can_be_taken_again(self):
+        self.backend.acquire('norbert', 1, 1, 0)
+        self.backend.refund('norbert')
+        self.backend.refund('norbert')
+
+        self.assertTrue(self.backend.acquire('norbert', 1, 1, 0)[0])
+        # not beyond the burst
+        self.assertFalse(self.backend.acquire('norbert', 1, 1, 0)[0])
+
+    def test_least_recently_used_buckets_are_evicted(self):
+        backend = InProcessAdmissionBackend(max_keys=2, clock=self.clock)
+        for user_id in ('albert', 'norbert', 'robert'):
+            backend.acquire(user_id, 1, 1, 0)
+
+        self.assertEqual(2, len(backend))
+        # evicted, it starts full again
+        self.assertTrue(backend.acquire('albert', 1, 1, 0)[0])
+        self.assertFalse(backend.acquire('robert', 1, 1, 0)[0])
+
+    def test_route_rates_from_config(self):
+        config = {'ADMISSION_ROUTE_RATES': {'/messages/bulk': '20:40', '/users/<string:user_id>/messages': '2.5'}}
+
+        self.assertEqual({'/messages/bulk': (20, 40), '/users/<string:user_id>/messages': (2.5, 3)},
+                         route_rates(config))
+
+
+class InFlight(TestCase):
+
+    def test_waits_for_a_slot_up_to_timeout(self):
+        limiter = InFlightLimiter(1)
+        self.assertTrue(limiter.acquire(0))
+        self.assertFalse(limiter.acquire(0.01))
+
+        threading.Timer(0.01, limiter.release).start()
+        self.assertTrue(limiter.acquire(5))
+        self.assertEqual(1, limiter.in_flight)
+
+
+class AdmissionControl(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+        admission._backend = None
+        self.set_config(ADMISSION_MAX_QUEUE_DELAY_MS=0)
+
+    def set_config(self, **config):
+        for name, value in config.items():
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+
+    def test_user_over_its_rate_is_rejected(self):
+        self.set_config(ADMISSION_USER_RATE=0.001, ADMISSION_USER_BURST=2)
+
+        self.assertEqual([200, 200], [self.client.get('/users/norbert/messages').status_code for _ in range(2)])
+        res = self.client.get('/users/norbert/messages/count')
+
+        self.assertEqual(429, res.status_code)
+        self.assertEqual('1000', res.headers['Retry-After'])
+        self.assertIn('Too many requests', json.loads(res.data)['message'])
+        self.assertEqual(200, self.client.get('/users/albert/messages').status_code)
+        self.assertEqual(200, self.client.get('/health/live').status_code)
+
+        metrics = self.client.get('/metrics').data.decode()
+        self.assertIn('admission_shed_total{route="/users/<string:user_id>/messages/count",limit="user"} 1', metrics)
+        self.assertIn('admission_accepted_total{route="/users/<string:user_id>/messages"}', metrics)
+
+    def test_route_over_its_rate_is_rejected(self):
+        self.set_config(ADMISSION_ROUTE_RATES={'/users/<string:user_id>/messages/count': '0.001:1'})
+
+        self.assertEqual(200, self.client.get('/users/norbert/messages/count').status_code)
+        self.assertEqual(429, self.client.get('/users/albert/messages/count').status_code)
+        self.assertEqual(200, self.client.get('/users/albert/messages').status_code)
+
+    def test_shed_before_the_body_is_inflated(self):
+        self.set_config(ADMISSION_ROUTE_RATES={'/messages/bulk': '0.001:1'})
+
+        def post_bulk():
+            return self.client.post('/messages/bulk', data=b'not gzip', headers={'Content-Encoding': 'gzip'})
+
+        self.assertEqual(400, post_bulk().status_code)
+        self.assertEqual(429, post_bulk().status_code)
+
+    def test_shed_by_route_keeps_the_token_of_the_user(self):
+        self.set_config(ADMISSION_USER_RATE=0.001, ADMISSION_USER_BURST=1,
+                        ADMISSION_ROUTE_RATES={'/users/<string:user_id>/messages/count': '0.001:1'})
+
+        self.assertEqual(200, self.client.get('/users/norbert/messages/count').status_code)
+        self.assertEqual(429, self.client.get('/users/albert/messages/count').status_code)
+        self.assertEqual(200, self.client.get('/users/albert/messages').status_code)
+
+    def test_busy_process_sheds_requests(self):
+        self.set_config(ADMISSION_MAX_IN_FLIGHT=1)
+        with app.app_context():
+            limiter = admission._get_limiter()
+        self.assertTrue(limiter.acquire(0))
+
+        self.set_config(ADMISSION_USER_RATE=0.001, ADMISSION_USER_BURST=1)
+        res = self.client.get('/users/norbert/messages')
+        self.assertEqual(503, res.status_code)
+        self.assertEqual('1', res.headers['Retry-After'])
+
+        limiter.release()
+        self.assertEqual(200, self.client.get('/users/norbert/messages').status_code)
+        self.assertEqual(0, limiter.in_flight)
@@ -0,0 +1,185 @@
+import json
+from unittest import TestCase
+
+from sqlalchemy import event
+
+import test_message_api
+from clock import Clock
+from test_message_api import app
+from message_api.cache import InProcessMailboxCache, MailboxEntry
+
+
+def message(message_id, text='test message'):
+    return message_id, {'id': message_id, 'text': text}
+
+
+class InProcessCache(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def make_cache(self, **kwargs):
+        return InProcessMailboxCache(clock=self.clock, **kwargs)
+
+    def set(self, mailbox_cache, user_id, *messages):
+        mailbox_cache.set(user_id, MailboxEntry(None, list(messages)), mailbox_cache.generation(user_id))
+
+    def test_append_and_advance(self):
+        mailbox_cache = self.make_cache()
+        self.set(mailbox_cache, 'norbert', message(1))
+
+        mailbox_cache.append('norbert', [message(2), message(3)])
+        self.assertEqual([1, 2, 3], [x['id'] for _, x in mailbox_cache.get('norbert').unread])
+
+        mailbox_cache.advance('norbert', message(2)[0])
+        self.assertEqual([3], [x['id'] for _, x in mailbox_cache.get('norbert').unread])
+
+    def test_entries_expire(self):
+        mailbox_cache = self.make_cache(ttl=10)
+        self.set(mailbox_cache, 'norbert')
+
+        self.clock.now = 9
+        self.assertIsNotNone(mailbox_cache.get('norbert'))
+        self.clock.now = 10
+        self.assertIsNone(mailbox_cache.get('norbert'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        mailbox_cache = self.make_cache(max_users=2)
+        self.set(mailbox_cache, 'albert')
+        self.set(mailbox_cache, 'norbert')
+
+        mailbox_cache.get('albert')
+        self.set(mailbox_cache, 'hubert')
+
+        self.assertIsNotNone(mailbox_cache.get('albert'))
+        self.assertIsNone(mailbox_cache.get('norbert'))
+        self.assertIsNotNone(mailbox_cache.get('hubert'))
+
+    def test_memory_cap(self):
+        mailbox_cache = self.make_cache(max_bytes=2000)
+        self.set(mailbox_cache, 'albert', message(1, 'x' * 500))
+        self.set(mailbox_cache, 'norbert', message(2, 'x' * 1000))
+
+        self.assertIsNone(mailbox_cache.get('albert'))
+        self.assertIsNotNone(mailbox_cache.get('norbert'))
+        self.assertLessEqual(mailbox_cache.size, 2000)
+
+    def test_too_many_unread_messages_are_not_cached(self):
+        mailbox_cache = self.make_cache(max_unread=2)
+        self.set(mailbox_cache, 'norbert', message(1), message(2), message(3))
+        self.assertIsNone(mailbox_cache.get('norbert'))
+
+        self.set(mailbox_cache, 'norbert', message(1), message(2))
+        mailbox_cache.append('norbert', [message(3)])
+        self.assertIsNone(mailbox_cache.get('norbert'))
+
+    def test_too_large_marker_until_read(self):
+        mailbox_cache = self.make_cache(max_unread=2)
+        mailbox_cache.set('norbert', MailboxEntry(0, None), mailbox_cache.generation('norbert'))
+
+        mailbox_cache.append('norbert', [message(4)])
+        self.assertIsNone(mailbox_cache.get('norbert').unread)
+
+        mailbox_cache.advance('norbert', 4)
+        self.assertIsNone(mailbox_cache.get('norbert'))
+
+    def test_load_racing_with_a_write_is_dropped(self):
+        mailbox_cache = self.make_cache()
+        generation = mailbox_cache.generation('norbert')
+
+        # a message is posted while the entry is loaded from the database
+        mailbox_cache.append('norbert', [message(1)])
+
+        mailbox_cache.set('norbert', MailboxEntry(None, []), generation)
+        self.assertIsNone(mailbox_cache.get('norbert'))
+
+
+class CachedMessagesApi(test_message_api.MessagesApi):
+    """The whole API test suite with the in-process cache enabled."""
+
+    def setUp(self):
+        super().setUp()
+        app.config['MESSAGES_CACHE'] = 'memory'
+        with app.app_context():
+            from message_api.sqlalquemy_store import _get_mailbox_cache
+            _get_mailbox_cache().clear()
+
+    def tearDown(self):
+        app.config['MESSAGES_CACHE'] = ''
+
+    def test_empty_poll_does_not_query_the_database(self):
+        self.post_message('test message 1')
+        self.assertEqual(1, len(self.get_messages()))
+        self.assertEqual(0, len(self.get_messages()))
+
+        statements = []
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            engine = db.engine
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            self.assertEqual(0, len(self.get_messages()))
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+
+        self.assertEqual([], statements)
+
+        self.post_message('test message 2')
+        self.assertEqual(["test message 2"], [x.get("text") for x in self.get_messages()])
+
+    def test_too_many_unread_messages_are_probed_once(self):
+        for name, value in (('MESSAGES_CACHE_MAX_UNREAD', 2), ('MESSAGES_READ_ONLY_GET', True)):
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+        for i in range(3):
+            self.post_message(f'test message {i}')
+        # the key of the user is cached by the first read
+        with app.app_context():
+            from message_api.sqlalquemy_store import _get_mailbox_cache
+            self.get_messages()
+            _get_mailbox_cache().clear()
+
+        first = self.statements(lambda: self.assertEqual(3, len(self.get_messages())))
+        second = self.statements(lambda: self.assertEqual(3, len(self.get_messages())))
+
+        # the unread messages are loaded up to MESSAGES_CACHE_MAX_UNREAD + 1 only once
+        self.assertEqual(1, len([x for x in first if 'LIMIT' in x]))
+        self.assertEqual([], [x for x in second if 'LIMIT' in x])
+        self.assertEqual(len(first) - 2, len(second))
+
+    def test_conditional_read_only_poll_does_not_query_the_database(self):
+        self.addCleanup(app.config.__setitem__, 'MESSAGES_READ_ONLY_GET', app.config['MESSAGES_READ_ONLY_GET'])
+        app.config['MESSAGES_READ_ONLY_GET'] = True
+        self.post_message('test message 1')
+        uri = self.messages_uri(self._target)
+        etag = self.client.get(uri).headers['ETag']
+
+        # the ETag comes from the cached unread messages
+        self.assertEqual([], self.statements(lambda: self.assertEqual(etag, self.client.get(uri).headers['ETag'])))
+        self.assertEqual([], self.statements(
+            lambda: self.assertEqual(304, self.client.get(uri, headers={'If-None-Match': etag}).status_code)))
+
+        self.post_message('test message 2')
+        res = self.client.get(uri, headers={'If-None-Match': etag})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(["test message 1", "test message 2"], [x.get("text") for x in json.loads(res.data)])
+
+    def statements(self, func):
+        statements = []
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            engine = db.engine
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            func()
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+        return statements
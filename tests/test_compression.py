@@ -0,0 +1,87 @@
+import gzip
+import json
+from unittest import TestCase
+
+from test_message_api import app
+
+
+class Compression(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+        for i in range(50):
+            self.post('/users/norbert/messages', {'user_id': 'albert', 'text': f'test message {i}'}, 201)
+
+    def test_large_listing_is_gzipped(self):
+        res = self.client.get('/users/norbert/messages?get_old_messages=true', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+        messages = json.loads(gzip.decompress(res.data))
+        self.assertEqual([f'test message {i}' for i in range(50)], [x['text'] for x in messages])
+
+        # the ETag has the encoding, the 304 carries it the same way
+        etag = res.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        self.assertFalse(etag.startswith('W/'))
+        res = self.client.get('/users/norbert/messages?get_old_messages=true',
+                              headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(etag, res.headers['ETag'])
+
+        # nor is the compressed body the client has sent to one without the encoding
+        res = self.client.get('/users/norbert/messages?get_old_messages=true', headers={'If-None-Match': etag})
+        self.assertEqual(200, res.status_code)
+
+    def test_small_or_not_accepted_responses_are_not_compressed(self):
+        res = self.client.get('/users/norbert/messages/count', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual({'unread': 50, 'total': 50}, json.loads(res.data))
+
+        res = self.client.get('/users/norbert/messages?get_old_messages=true')
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(50, len(json.loads(res.data)))
+
+    def test_streamed_listing_is_gzipped(self):
+        res = self.client.get('/users/norbert/messages?get_old_messages=true&stream=true',
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        self.assertEqual(50, len(json.loads(gzip.decompress(res.data))))
+
+    def test_gzipped_request_bodies(self):
+        message = self.post('/users/norbert/messages', {'user_id': 'albert', 'text': 'gzipped'}, 201, compress=True)
+        self.assertEqual('gzipped', message['text'])
+
+        res = self.client.delete('/users/norbert/messages', data=gzip.compress(json.dumps([message['id']]).encode()),
+                                 headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(1, json.loads(res.data)['deleted_count'])
+
+    def test_fail_request_body_not_valid_gzip(self):
+        res = self.client.post('/users/norbert/messages', data=b'not gzip', headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(400, res.status_code)
+
+        res = self.client.post('/users/norbert/messages', data=b'{}', headers={'Content-Encoding': 'compress'})
+        self.assertEqual(415, res.status_code)
+
+    def test_fail_request_body_too_large_once_decompressed(self):
+        app.config['COMPRESSION_MAX_REQUEST_SIZE'] = 100
+        self.addCleanup(app.config.__setitem__, 'COMPRESSION_MAX_REQUEST_SIZE', 16 * 1024 * 1024)
+
+        self.post('/users/norbert/messages', {'user_id': 'albert', 'text': 'x' * 1000}, 413, compress=True)
+
+    def post(self, uri, data, status_code, compress=False):
+        body = json.dumps(data).encode()
+        headers = {'Content-Encoding': 'gzip'} if compress else {}
+        res = self.client.post(uri, data=gzip.compress(body) if compress else body, headers=headers)
+        self.assertEqual(status_code, res.status_code)
+
+        return json.loads(res.data)
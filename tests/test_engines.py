@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from config import app_config
+from message_api.engines import TimedQueuePool, engine_options, configure_engine, writer_engine
+
+
+class EngineOptions(TestCase):
+
+    def setUp(self):
+        self.config = {key: getattr(app_config['production'], key) for key in dir(app_config['production'])}
+
+    def test_in_memory_sqlite_keeps_the_default_pool(self):
+        self.assertEqual({}, engine_options(self.config, 'sqlite://'))
+
+    def test_sqlite_file_gets_a_pool(self):
+        options = engine_options(self.config, 'sqlite:////tmp/messages.db')
+
+        self.assertIs(TimedQueuePool, options['poolclass'])
+        self.assertEqual(self.config['DATABASE_POOL_SIZE'], options['pool_size'])
+        self.assertEqual(self.config['SQLITE_BUSY_TIMEOUT'], options['connect_args']['timeout'])
+
+    def test_server_database_connections_are_checked(self):
+        options = engine_options(self.config, 'postgresql://messages@localhost/messages')
+
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(self.config['DATABASE_POOL_RECYCLE'], options['pool_recycle'])
+
+    def test_connections_of_another_process_are_not_reused(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/messages.db',
+                                   **engine_options(self.config, f'sqlite:///{directory}/messages.db'))
+            with engine.connect() as connection:
+                connection.execute('select 1')
+                record = connection.connection._connection_record
+                first = record.connection
+            # as seen from a forked worker
+            record.info['pid'] = os.getpid() + 1
+
+            with engine.connect() as connection:
+                connection.execute('select 1')
+                self.assertIsNot(first, connection.connection.connection)
+            first.close()
+            engine.dispose()
+
+
+class ConcurrentSqliteProfile(TestCase):
+
+    def setUp(self):
+        self.config = {key: getattr(app_config['production'], key) for key in dir(app_config['production'])}
+        self.config['SQLITE_PROFILE'] = 'concurrent'
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.uri = f'sqlite:///{directory.name}/messages.db'
+
+    def make_engine(self):
+        engine = create_engine(self.uri, **engine_options(self.config, self.uri))
+        configure_engine(engine, self.config)
+        self.addCleanup(engine.dispose)
+        return engine
+
+    def test_connections_use_wal(self):
+        engine = self.make_engine()
+
+        self.assertEqual('wal', engine.execute('PRAGMA journal_mode').scalar())
+        self.assertEqual(self.config['SQLITE_CACHE_SIZE'], engine.execute('PRAGMA cache_size').scalar())
+
+    def test_writer_takes_the_write_lock_up_front(self):
+        self.make_engine().execute('create table t (x integer)')
+        writer = writer_engine(self.config, self.uri)
+        self.addCleanup(writer.dispose)
+        other_writer = sqlite3.connect(self.uri[len('sqlite:///'):], timeout=0)
+        self.addCleanup(other_writer.close)
+
+        with writer.begin():
+            # nothing written yet, but the lock is taken
+            with self.assertRaises(sqlite3.OperationalError):
+                other_writer.execute('insert into t values (1)')
+        other_writer.execute('insert into t values (1)')
+
+    def test_default_profile_has_no_writer(self):
+        self.config['SQLITE_PROFILE'] = 'default'
+
+        self.assertIsNone(writer_engine(self.config, self.uri))
+        self.assertIsNone(writer_engine(dict(self.config, SQLITE_PROFILE='concurrent'), 'sqlite://'))
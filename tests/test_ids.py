@@ -0,0 +1,99 @@
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from clock import Clock
+from test_message_api import app
+from message_api.ids import IdGenerator, MAX_NODE_ID, NODE_BITS, SEQUENCE_BITS, MAX_AHEAD_MS, EPOCH, first_id_at
+
+
+class Ids(TestCase):
+
+    def setUp(self):
+        self.clock = Clock(1600000000.0)
+
+    def test_ids_grow_with_time(self):
+        generator = IdGenerator(0, clock=self.clock)
+        first = generator.next_ids(3)
+        self.clock.now += 0.001
+        second = generator.next_ids(1)
+
+        self.assertEqual(sorted(first), first)
+        self.assertLess(first[-1], second[0])
+        self.assertLess(second[0], 2 ** 63)
+
+    def test_ids_keep_growing_when_the_clock_goes_back_or_a_millisecond_is_full(self):
+        generator = IdGenerator(0, clock=self.clock)
+        message_ids = generator.next_ids(3 * 2 ** SEQUENCE_BITS)
+        self.clock.now -= 1
+        message_ids += generator.next_ids(2)
+
+        self.assertEqual(sorted(set(message_ids)), message_ids)
+
+    def test_waits_for_the_clock_beyond_max_ahead(self):
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            self.clock.now += seconds
+
+        generator = IdGenerator(0, clock=self.clock, sleep=sleep)
+        message_ids = generator.next_ids((MAX_AHEAD_MS + 3) * 2 ** SEQUENCE_BITS)
+
+        self.assertEqual(sorted(set(message_ids)), message_ids)
+        self.assertTrue(sleeps)
+        # the last id is no more than MAX_AHEAD_MS ahead of the clock
+        last_ms = message_ids[-1] >> NODE_BITS + SEQUENCE_BITS
+        now_ms = first_id_at(datetime.utcfromtimestamp(self.clock.now)) >> NODE_BITS + SEQUENCE_BITS
+        self.assertLessEqual(last_ms - now_ms, MAX_AHEAD_MS + 1)
+
+    def test_nodes_never_clash(self):
+        message_ids = IdGenerator(1, clock=self.clock).next_ids(100) + IdGenerator(2, clock=self.clock).next_ids(100)
+        self.assertEqual(200, len(set(message_ids)))
+
+    def test_node_id_must_fit(self):
+        IdGenerator(MAX_NODE_ID)
+        with self.assertRaises(ValueError):
+            IdGenerator(MAX_NODE_ID + 1)
+
+    def test_first_id_at(self):
+        generator = IdGenerator(MAX_NODE_ID, clock=self.clock)
+        before = generator.next_ids(1)[0]
+        self.clock.now += 0.001
+        after = generator.next_ids(1)[0]
+
+        moment = datetime.utcfromtimestamp(self.clock.now)
+        self.assertLess(before, first_id_at(moment))
+        self.assertLessEqual(first_id_at(moment), after)
+        self.assertEqual(0, first_id_at(EPOCH - timedelta(days=1)))
+
+
+class IdsAcrossNodes(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+        from message_api import sqlalquemy_store
+        self.addCleanup(setattr, sqlalquemy_store, '_id_generator', None)
+
+    def use_node(self, node_id):
+        from message_api import sqlalquemy_store
+        sqlalquemy_store._id_generator = (os.getpid(), IdGenerator(node_id))
+
+    def test_message_of_another_node_after_a_bulk_is_unread(self):
+        self.use_node(2)
+        bulk = [{'sender': 'albert', 'target': 'norbert', 'text': f'test message {i}'} for i in range(10000)]
+        self.assertEqual(201, self.client.post('/messages/bulk', data=json.dumps(bulk)).status_code)
+        self.assertEqual(10000, len(json.loads(self.client.get('/users/norbert/messages').data)))
+
+        self.use_node(1)
+        res = self.client.post('/users/norbert/messages', data=json.dumps({'user_id': 'albert', 'text': 'hi'}))
+        self.assertEqual(201, res.status_code)
+
+        unread = json.loads(self.client.get('/users/norbert/messages?get_old_messages=false').data)
+        self.assertEqual(['hi'], [message['text'] for message in unread])
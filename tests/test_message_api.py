@@ -1,6 +1,7 @@
 import json
 from datetime import datetime
 from unittest import TestCase
+from urllib.parse import urlencode
 from message_api import create_app
 
 
@@ -36,6 +37,34 @@ class MessagesApi(TestCase):
         d = res.get("sent_time")
         datetime.fromisoformat(d)
 
+    def test_post_message_with_write_behind(self):
+        app.config['MESSAGES_WRITE_BEHIND'] = True
+        try:
+            res = self.post_message('test message 1')
+            self.assertIsNotNone(res.get("id"))
+            self.assertEqual("test message 1", res.get("text"))
+
+            app.config['MESSAGES_WRITE_BEHIND_MODE'] = 'async'
+            res = self.post(self.messages_uri(self._target), self.make_message('test message 2'), 202)
+            self.assertIsNone(res.get("id"))
+
+            app.config['MESSAGES_WRITE_BEHIND_MODE'] = 'sync'
+            app.config['MESSAGES_WRITE_BEHIND_WAIT_TIMEOUT'] = 0
+            # still queued, not an error the client should retry
+            res = self.post(self.messages_uri(self._target), self.make_message('test message 3'), 202)
+            self.assertEqual("test message 3", res.get("text"))
+
+            with app.app_context():
+                from message_api.sqlalquemy_store import _get_write_behind_queue
+                _get_write_behind_queue().join()
+        finally:
+            app.config['MESSAGES_WRITE_BEHIND'] = False
+            app.config['MESSAGES_WRITE_BEHIND_MODE'] = 'sync'
+            app.config['MESSAGES_WRITE_BEHIND_WAIT_TIMEOUT'] = 5
+
+        res = self.get_messages()
+        self.assertEqual(["test message 1", "test message 2", "test message 3"], [x.get("text") for x in res])
+
     def test_fail_post_message_no_data(self):
         self.post(
             self.messages_uri(self._target),
@@ -54,6 +83,21 @@ class MessagesApi(TestCase):
             {'text': 'test message 1'},
             400)
 
+    def test_fail_post_message_not_valid_sender_user_id(self):
+        for user_id in (5, ['albert'], 'x' * 101):
+            self.post(self.messages_uri(self._target), {'user_id': user_id, 'text': 'test message 1'}, 400)
+
+    def test_fail_post_message_not_valid_sender_user_id_with_write_behind(self):
+        app.config['MESSAGES_WRITE_BEHIND'] = True
+        try:
+            self.post(self.messages_uri(self._target), {'user_id': 5, 'text': 'test message 1'}, 400)
+            # messages of the same group commit are stored
+            self.post_message('test message 2')
+        finally:
+            app.config['MESSAGES_WRITE_BEHIND'] = False
+
+        self.assertEqual(["test message 2"], [x.get("text") for x in self.get_messages()])
+
     def test_fail_post_message_no_text(self):
         self.post(
             self.messages_uri(self._target),
@@ -109,6 +153,239 @@ class MessagesApi(TestCase):
         self.assertEqual("test message 4", res[1].get("text"))
         self.assertEqual("test message 5", res[2].get("text"))
 
+    def test_read_only_get_with_explicit_acknowledgement(self):
+        self.post_message('test message 1')
+        message = self.post_message('test message 2')
+        self.post_message('test message 3')
+
+        app.config['MESSAGES_READ_ONLY_GET'] = True
+        try:
+            res = self.get_messages()
+            self.assertEqual(3, len(res))
+
+            res = self.get_messages()
+            self.assertEqual(3, len(res))
+
+            res = self.acknowledge_messages(message.get("id"))
+            self.assertTrue(res["advanced"])
+
+            res = self.get_messages()
+            self.assertEqual(["test message 3"], [x.get("text") for x in res])
+
+            res = self.acknowledge_messages()
+            self.assertTrue(res["advanced"])
+
+            res = self.get_messages()
+            self.assertEqual(0, len(res))
+        finally:
+            app.config['MESSAGES_READ_ONLY_GET'] = False
+
+    def test_acknowledgement_never_moves_read_marker_backwards(self):
+        message = self.post_message('test message 1')
+        self.post_message('test message 2')
+
+        res = self.get_messages()
+        self.assertEqual(2, len(res))
+
+        res = self.acknowledge_messages(message.get("id"))
+        self.assertFalse(res["advanced"])
+
+        res = self.get_messages()
+        self.assertEqual(0, len(res))
+
+    def test_count_messages(self):
+        self.assertEqual({'unread': 0, 'total': 0}, self.count_messages())
+
+        first = self.post_message('test message 1')
+        self.post_message('test message 2')
+        third = self.post_message('test message 3')
+        self.post_message('test message 4', target=self._target + "_jr")
+        self.assertEqual({'unread': 3, 'total': 3}, self.count_messages())
+
+        app.config['MESSAGES_READ_ONLY_GET'] = True
+        try:
+            self.get_messages()
+            self.assertEqual({'unread': 3, 'total': 3}, self.count_messages())
+
+            self.acknowledge_messages(first.get("id"))
+            self.assertEqual({'unread': 2, 'total': 3}, self.count_messages())
+        finally:
+            app.config['MESSAGES_READ_ONLY_GET'] = False
+
+        # one read and one unread message
+        self.assertEqual(2, self.delete_messages(first.get("id"), third.get("id")))
+        self.assertEqual({'unread': 1, 'total': 1}, self.count_messages())
+
+        self.get_messages()
+        self.assertEqual({'unread': 0, 'total': 1}, self.count_messages())
+
+        self.post('/messages/bulk', [
+            {'sender': self._sender, 'target': self._target, 'text': 'bulk message 1'},
+            {'sender': self._sender, 'target': self._target, 'text': 'bulk message 2'},
+        ], 201)
+        self.assertEqual({'unread': 2, 'total': 3}, self.count_messages())
+        self.assertEqual({'unread': 1, 'total': 1}, self.count_messages(self._target + "_jr"))
+
+    def test_reconcile_counters_repairs_drift(self):
+        self.post_message('test message 1')
+        self.post_message('test message 2')
+        self.get_messages()
+        self.post_message('test message 3')
+
+        with app.app_context():
+            from message_api.sqlalquemy_store import db, reconcile_counters, UserModel
+            db.session.execute(UserModel.__table__.update()
+                               .where(UserModel.user_id == self._target).values(message_count=7, unread_count=0))
+            db.session.commit()
+
+            self.assertEqual(1, reconcile_counters(batch_size=1))
+            self.assertEqual(0, reconcile_counters())
+        self.assertEqual({'unread': 1, 'total': 3}, self.count_messages())
+
+    def test_conditional_get_of_old_messages(self):
+        message = self.post_message('test message 1')
+        uri = self.messages_uri(self._target, get_old_messages=True)
+
+        res = self.client.get(uri)
+        self.assertEqual(200, res.status_code)
+        etag = res.headers['ETag']
+
+        res = self.client.get(uri, headers={'If-None-Match': etag})
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(b'', res.data)
+
+        self.post_message('test message 2')
+        res = self.client.get(uri, headers={'If-None-Match': etag})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(2, len(json.loads(res.data)))
+        etag = res.headers['ETag']
+
+        self.delete_messages(message.get("id"))
+        res = self.client.get(uri, headers={'If-None-Match': etag})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(["test message 2"], [x.get("text") for x in json.loads(res.data)])
+
+    def test_conditional_get_of_unread_messages(self):
+        message = self.post_message('test message 1')
+        self.post_message('test message 2')
+
+        # listings that mark messages as read are never answered from the client's copy
+        res = self.client.get(self.messages_uri(self._target))
+        self.assertNotIn('ETag', res.headers)
+
+        self.post_message('test message 3')
+        app.config['MESSAGES_READ_ONLY_GET'] = True
+        try:
+            uri = self.messages_uri(self._target)
+            etag = self.client.get(uri).headers['ETag']
+            self.assertEqual(304, self.client.get(uri, headers={'If-None-Match': etag}).status_code)
+
+            self.acknowledge_messages()
+            res = self.client.get(uri, headers={'If-None-Match': etag})
+            self.assertEqual(200, res.status_code)
+            self.assertEqual([], json.loads(res.data))
+        finally:
+            app.config['MESSAGES_READ_ONLY_GET'] = False
+
+        self.assertFalse(self.acknowledge_messages(message.get("id"))["advanced"])
+
+    def test_conditional_get_per_representation(self):
+        self.post_message('test message 1')
+        uri = self.messages_uri(self._target, get_old_messages=True)
+        ndjson = {'Accept': 'application/x-ndjson'}
+
+        etags = {self.client.get(uri).headers['ETag'], self.client.get(uri + '&stream=true').headers['ETag'],
+                 self.client.get(uri, headers=ndjson).headers['ETag']}
+        self.assertEqual(3, len(etags))
+
+        # a client with the JSON listing doesn't get a 304 for the newline delimited one
+        etag = self.client.get(uri).headers['ETag']
+        res = self.client.get(uri, headers={'If-None-Match': etag, **ndjson})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(['test message 1'], [json.loads(line).get("text") for line in res.data.splitlines()])
+        self.assertEqual(304, self.client.get(uri, headers={'If-None-Match': res.headers['ETag'], **ndjson}).status_code)
+
+    def test_conditional_get_of_index(self):
+        res = self.client.get('/')
+        self.assertEqual(200, res.status_code)
+        self.assertIn(b'<h1>', res.data)
+
+        res = self.client.get('/', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(304, res.status_code)
+
+    def test_search_messages(self):
+        self.post_message('the friday meeting moved, friday at noon')
+        first = self.post_message('lunch on friday?')
+        self.post_message('Café on Monday')
+        self.post_message('friday lunch', target=self._target + "_jr")
+        self.post('/messages/bulk', [{'sender': self._sender, 'target': self._target, 'text': 'bulk lunch'}], 201)
+
+        # the message repeating the term ranks first, not the newest
+        self.assertEqual(['the friday meeting moved, friday at noon', 'lunch on friday?'],
+                         [x.get("text") for x in self.search_messages('Friday')])
+        self.assertEqual(['lunch on friday?'], [x.get("text") for x in self.search_messages('lunch friday')])
+        self.assertEqual(['Café on Monday'], [x.get("text") for x in self.search_messages('cafe mon*')])
+        self.assertEqual([], self.search_messages('"friday" OR lunch'))
+
+        self.assertEqual(['bulk lunch'], [x.get("text") for x in self.search_messages('lunch', page_size=1)])
+        self.assertEqual(['lunch on friday?'], [x.get("text") for x in self.search_messages('lunch', page=1, page_size=1)])
+
+        # searching does not mark messages as read
+        self.assertEqual(4, len(self.get_messages()))
+
+        self.delete_messages(first.get("id"))
+        self.assertEqual(['bulk lunch'], [x.get("text") for x in self.search_messages('lunch')])
+
+    def test_search_terms_do_not_match_the_mailbox(self):
+        self.post_message('lunch on friday?')
+        self.post_message('lunch', target=self._target + "_jr")
+        with app.app_context():
+            from message_api.sqlalquemy_store import db, _user_key
+            key = _user_key(db.engine, self._target)
+
+        # the key of the mailbox is in the index too, terms only match the text
+        self.assertEqual([], self.search_messages(str(key)))
+        self.assertEqual(['lunch on friday?'], [x.get("text") for x in self.search_messages('lunch')])
+
+    def test_search_messages_without_full_text_index(self):
+        from message_api import search
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            search._indexed[str(db.engine.url)] = False
+        self.addCleanup(search._indexed.clear)
+
+        self.post_message('lunch on friday?')
+        self.post_message('100% friday')
+        self.post_message('lunch at noon')
+
+        self.assertEqual(['lunch at noon', 'lunch on friday?'], [x.get("text") for x in self.search_messages('lunch')])
+        self.assertEqual(['100% friday'], [x.get("text") for x in self.search_messages('% fri*')])
+
+    def test_conditional_search(self):
+        self.post_message('lunch on friday?')
+        uri = self.messages_uri(self._target) + '/search?q=lunch'
+
+        etag = self.client.get(uri).headers['ETag']
+        self.assertEqual(304, self.client.get(uri, headers={'If-None-Match': etag}).status_code)
+
+        self.post_message('lunch at noon')
+        res = self.client.get(uri, headers={'If-None-Match': etag})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(2, len(json.loads(res.data)))
+
+    def test_fail_search_without_terms(self):
+        self.get(self.messages_uri(self._target) + '/search', 400)
+        self.get(self.messages_uri(self._target) + '/search?q=%20*%20', 400)
+        self.get(self.messages_uri(self._target) + '/search?q=lunch&page=-1', 400)
+
+    def test_fail_acknowledge_message_of_different_user(self):
+        message = self.post_message('test message 1', target=self._target + "_jr")
+
+        self.post(self.messages_uri(self._target) + '/read', {'message_id': message.get("id")}, 404)
+
+    def test_fail_acknowledge_with_not_valid_message_id(self):
+        self.post(self.messages_uri(self._target) + '/read', {'message_id': 'qwerty'}, 400)
+
     def test_get_old_messages_returns_every_message_on_multiple_get_calls(self):
         self.post_message('test message 1')
         self.post_message('test message 2')
@@ -168,6 +445,111 @@ class MessagesApi(TestCase):
         self.assertEqual("test message 5", res[0].get("text"))
         self.assertEqual("test message 6", res[1].get("text"))
 
+    def test_get_old_messages_with_cursor_pagination(self):
+        for i in range(1, 13):
+            self.post_message(f'test message {i}')
+
+        res = self.get_messages_page('', page_size=5)
+        self.assertEqual([f'test message {i}' for i in range(1, 6)], [x.get("text") for x in res["messages"]])
+        self.assertIsNotNone(res["next_cursor"])
+
+        # messages posted while scrolling don't shift the following pages
+        self.post_message('test message 13')
+
+        res = self.get_messages_page(res["next_cursor"], page_size=5)
+        self.assertEqual([f'test message {i}' for i in range(6, 11)], [x.get("text") for x in res["messages"]])
+
+        res = self.get_messages_page(res["next_cursor"], page_size=5)
+        self.assertEqual([f'test message {i}' for i in range(11, 14)], [x.get("text") for x in res["messages"]])
+        self.assertIsNone(res["next_cursor"])
+
+    def test_page_size_is_capped_to_max_page_size(self):
+        for i in range(1, 5):
+            self.post_message(f'test message {i}')
+
+        max_page_size = app.config['MESSAGES_MAX_PAGE_SIZE']
+        app.config['MESSAGES_MAX_PAGE_SIZE'] = 3
+        try:
+            res = self.get_messages(get_old_messages=True, page=0, page_size=10)
+            self.assertEqual(3, len(res))
+
+            res = self.get_messages_page('', page_size=10)
+            self.assertEqual(3, len(res["messages"]))
+        finally:
+            app.config['MESSAGES_MAX_PAGE_SIZE'] = max_page_size
+
+    def test_fail_get_with_not_valid_cursor(self):
+        self.get(self.messages_uri(self._target, get_old_messages="true") + '&cursor=qwerty', 400)
+
+    def test_fail_get_with_page_and_cursor(self):
+        self.get(self.messages_uri(self._target, get_old_messages="true", page=1) + '&cursor=', 400)
+
+    def test_fail_get_with_cursor_but_not_get_old_message_set_to_true(self):
+        self.get(self.messages_uri(self._target) + '?cursor=', 400)
+
+    def test_bulk_post_messages_to_several_users(self):
+        chunk_size = app.config['MESSAGES_BULK_CHUNK_SIZE']
+        app.config['MESSAGES_BULK_CHUNK_SIZE'] = 2
+        try:
+            res = self.post('/messages/bulk', [
+                {'sender': self._sender, 'target': self._target, 'text': 'test message 1'},
+                {'sender': self._sender, 'target': self._target + "_jr", 'text': 'test message 2'},
+                {'sender': self._sender, 'target': self._target},
+                {'sender': self._sender, 'target': self._target, 'text': 'test message 3'},
+                'test message 4',
+            ], 201)
+        finally:
+            app.config['MESSAGES_BULK_CHUNK_SIZE'] = chunk_size
+
+        self.assertEqual([0, 1, 3], [x['index'] for x in res['created']])
+        self.assertEqual(3, len({x['id'] for x in res['created']}))
+        self.assertEqual([2, 4], [x['index'] for x in res['errors']])
+
+        res = self.get_messages(get_old_messages=True)
+        self.assertEqual(["test message 1", "test message 3"], [x.get("text") for x in res])
+
+        res = self.get_messages(user_name=self._target + "_jr")
+        self.assertEqual(["test message 2"], [x.get("text") for x in res])
+
+    def test_fail_bulk_post_with_no_valid_message(self):
+        res = self.post('/messages/bulk', [{'sender': self._sender, 'target': 'x' * 101, 'text': 'test'}], 400)
+        self.assertEqual([], res['created'])
+        self.assertEqual(1, len(res['errors']))
+
+    def test_fail_bulk_post_wrong_data_type(self):
+        self.post('/messages/bulk', {'sender': self._sender, 'target': self._target, 'text': 'test'}, 400)
+
+    def test_stream_messages_as_json_array(self):
+        for i in range(1, 4):
+            self.post_message(f'test message {i}')
+
+        res = self.client.get(self.messages_uri(self._target, get_old_messages=True, stream=True))
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(
+            ["test message 1", "test message 2", "test message 3"],
+            [x.get("text") for x in json.loads(res.data)])
+
+        res = self.client.get(self.messages_uri(self._target, stream=True))
+        self.assertEqual([], json.loads(res.data))
+
+    def test_stream_messages_as_ndjson(self):
+        self.post_message('test message 1')
+        self.post_message('test message 2')
+
+        res = self.client.get(self.messages_uri(self._target), headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('application/x-ndjson', res.mimetype)
+        lines = res.data.decode().splitlines()
+        self.assertEqual(["test message 1", "test message 2"], [json.loads(x).get("text") for x in lines])
+
+        # streamed messages are marked as read
+        res = self.get_messages()
+        self.assertEqual(0, len(res))
+
+    def test_fail_stream_with_pagination(self):
+        self.get(self.messages_uri(self._target, get_old_messages=True, stream=True, page=0), 400)
+
     def test_fail_get_with_not_valid_get_old_messages(self):
         return self.get(self.messages_uri(
             self._target,
@@ -276,6 +658,23 @@ class MessagesApi(TestCase):
             get_old_messages=get_old_messages, page=page, page_size=page_size),
             200)
 
+    def get_messages_page(self, cursor, page_size=None, user_name=None):
+        uri = self.messages_uri(user_name or self._target, get_old_messages=True, page_size=page_size)
+        return self.get(uri + '&' + urlencode({'cursor': cursor}), 200)
+
+    def acknowledge_messages(self, message_id=None, target=None):
+        data = {'message_id': message_id} if message_id is not None else {}
+        return self.post(self.messages_uri(target or self._target) + '/read', data, 200)
+
+    def count_messages(self, target=None):
+        return self.get(self.messages_uri(target or self._target) + '/count', 200)
+
+    def search_messages(self, query, page=None, page_size=None, target=None):
+        uri = self.messages_uri(target or self._target) + '/search?' + urlencode(
+            {name: value for name, value in (('q', query), ('page', page), ('page_size', page_size))
+             if value is not None})
+        return self.get(uri, 200)
+
     def delete_messages(self, *message_ids, target=None):
 
         res = self.delete(
@@ -0,0 +1,91 @@
+import json
+from unittest import TestCase
+
+from test_message_api import app
+from message_api.metrics import Counter, Histogram, Gauge, Registry
+
+
+class Rendering(TestCase):
+
+    def test_prometheus_text_format(self):
+        registry = Registry()
+        requests = registry.register(Counter('requests_total', 'Requests.', ('route', 'method')))
+        duration = registry.register(Histogram('duration_seconds', 'Duration.', buckets=(.1, 1)))
+        registry.register(Gauge('depth', 'Depth.', lambda: 3))
+
+        requests.inc('/users/"x"', 'GET')
+        requests.inc('/users/"x"', 'GET')
+        duration.observe(.05)
+        duration.observe(.5)
+        duration.observe(5)
+
+        self.assertEqual([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{route="/users/\\"x\\"",method="GET"} 2',
+            '# HELP duration_seconds Duration.',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{le="0.1"} 1',
+            'duration_seconds_bucket{le="1"} 2',
+            'duration_seconds_bucket{le="+Inf"} 3',
+            'duration_seconds_sum 5.55',
+            'duration_seconds_count 3',
+            '# HELP depth Depth.',
+            '# TYPE depth gauge',
+            'depth 3',
+        ], registry.render().splitlines())
+
+
+class MetricsEndpoint(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def test_requests_and_sql_are_measured(self):
+        res = self.client.post('/users/norbert/messages', data=json.dumps({'user_id': 'albert', 'text': 'hi'}))
+        self.assertEqual(201, res.status_code)
+        self.client.get('/users/norbert/messages')
+
+        res = self.client.get('/metrics')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('text/plain', res.mimetype)
+        lines = res.data.decode().splitlines()
+
+        route = 'route="/users/<string:user_id>/messages"'
+        # metrics are per process, other tests count too
+        self.assertTrue(any(line.startswith(f'http_requests_total{{{route},method="POST",status="201"}}')
+                            for line in lines))
+        self.assertTrue(any(line.startswith(f'http_request_duration_seconds_count{{{route},method="GET"}}')
+                            for line in lines))
+        sql_queries = [line for line in lines if line.startswith(f'http_request_sql_queries_sum{{{route}}}')]
+        self.assertGreater(float(sql_queries[0].split()[-1]), 0)
+        self.assertIn('database_pool_checked_out_connections', res.data.decode())
+        self.assertIn('messages_write_behind_queue_depth 0', lines)
+
+    def test_failed_statements_are_measured(self):
+        from sqlalchemy.exc import OperationalError
+        from message_api import metrics
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            queries = metrics.SQL_QUERIES._values.get((), 0)
+            with db.engine.connect() as connection:
+                with self.assertRaises(OperationalError):
+                    connection.execute('SELECT * FROM no_such_table')
+
+                self.assertEqual([], connection.info['metrics_started'])
+        self.assertEqual(queries + 1, metrics.SQL_QUERIES._values[()])
+
+    def test_slow_requests_are_logged_with_their_sql(self):
+        app.config['METRICS_SLOW_REQUEST_MS'] = 0.000001
+        self.addCleanup(app.config.__setitem__, 'METRICS_SLOW_REQUEST_MS', 500)
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get('/users/norbert/messages?get_old_messages=true')
+
+        self.assertIn('Slow request GET /users/norbert/messages?get_old_messages=true 200', logs.output[0])
+        self.assertIn('FROM user_message_model', logs.output[0])
@@ -0,0 +1,113 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect, text
+
+from test_message_api import app
+
+BASELINE_SCHEMA = (
+    'CREATE TABLE user_message_model ('
+    ' id INTEGER NOT NULL PRIMARY KEY, sender VARCHAR(100) NOT NULL, target VARCHAR(100) NOT NULL,'
+    ' text TEXT NOT NULL, sent_time DATETIME NOT NULL)',
+    'CREATE TABLE user_model ('
+    ' id INTEGER NOT NULL PRIMARY KEY, user_id VARCHAR(100) NOT NULL, last_message_read_timestamp DATETIME)',
+)
+
+
+class Migrations(TestCase):
+
+    def setUp(self):
+        fd, self._path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.engine = create_engine('sqlite:///' + self._path)
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self._path)
+
+    def test_fresh_database_is_created_at_head(self):
+        from message_api import migrations
+
+        with app.app_context():
+            version = migrations.upgrade(self.engine)
+
+        self.assertEqual(migrations.head(), version)
+        self.assertEqual(version, migrations.current_version(self.engine))
+        self.assertIn('ix_user_message_model_target_key_id', self.index_names('user_message_model'))
+        self.assertIn('user_message_search', inspect(self.engine).get_table_names())
+
+    def test_upgrade_baseline_database_in_place(self):
+        from message_api import migrations
+
+        with self.engine.begin() as connection:
+            for statement in BASELINE_SCHEMA:
+                connection.execute(text(statement))
+            connection.execute(text(
+                "INSERT INTO user_message_model (sender, target, text, sent_time)"
+                " VALUES ('albert', 'norbert', 'hi', '2020-09-07 23:42:26.448303')"))
+            connection.execute(text(
+                "INSERT INTO user_model (user_id, last_message_read_timestamp)"
+                " VALUES ('norbert', '2020-09-08 10:00:00.000000'), ('norbert', '2020-09-07 10:00:00.000000')"))
+
+        with app.app_context():
+            version = migrations.upgrade(self.engine)
+            # running again is a no-op
+            self.assertEqual(version, migrations.upgrade(self.engine))
+
+        self.assertEqual(migrations.head(), version)
+        self.assertIn('ix_user_message_model_target_key_id', self.index_names('user_message_model'))
+        self.assertIn('ix_user_model_user_id', self.index_names('user_model'))
+        self.assertLessEqual({'last_message_read_id', 'mailbox_version'},
+                             {x['name'] for x in inspect(self.engine).get_columns('user_model')})
+        self.assertEqual({'id', 'sender_key', 'target_key', 'text', 'sent_time'},
+                         {x['name'] for x in inspect(self.engine).get_columns('user_message_model')})
+
+        with self.engine.connect() as connection:
+            users = connection.execute(text(
+                'SELECT user_id, last_message_read_timestamp, last_message_read_id FROM user_model'
+                " WHERE user_id = 'norbert'")).fetchall()
+            messages = connection.execute(text(
+                'SELECT s.user_id, t.user_id, m.text FROM user_message_model m'
+                ' JOIN user_model s ON s.id = m.sender_key JOIN user_model t ON t.id = m.target_key')).fetchall()
+            counters = connection.execute(text(
+                'SELECT user_id, message_count, unread_count FROM user_model ORDER BY user_id')).fetchall()
+            indexed = connection.execute(text(
+                "SELECT rowid FROM user_message_search WHERE user_message_search MATCH"
+                " 'target_key : ' || (SELECT id FROM user_model WHERE user_id = 'norbert') || ' AND text : hi'")).fetchall()
+        # the read marker points to the last message sent before it
+        self.assertEqual([('norbert', '2020-09-08 10:00:00.000000', 1)], [tuple(x) for x in users])
+        # senders and targets are interned into user_model
+        self.assertEqual([('albert', 'norbert', 'hi')], [tuple(x) for x in messages])
+        self.assertEqual([('albert', 0, 0), ('norbert', 1, 0)], [tuple(x) for x in counters])
+        # existing messages are indexed for searches of their mailbox
+        self.assertEqual([(1,)], [tuple(x) for x in indexed])
+
+    def test_steps_create_their_own_indexes(self):
+        from message_api import migrations
+
+        with self.engine.begin() as connection:
+            for statement in BASELINE_SCHEMA:
+                connection.execute(text(statement))
+            steps = dict(migrations.MIGRATIONS)
+            steps[1](connection)
+            self.assertEqual({'ix_user_message_model_target_sent_time_id'}, self.index_names('user_message_model', connection))
+            self.assertEqual({'ix_user_model_user_id'}, self.index_names('user_model', connection))
+
+            for version in range(2, 7):
+                steps[version](connection)
+            # not the index of the current model, the columns it is on come with step 7
+            self.assertEqual({'ix_user_message_model_target_id'}, self.index_names('user_message_model', connection))
+            self.assertEqual(['text'], self.column_names('user_message_search', connection))
+
+            steps[7](connection)
+            self.assertEqual({'ix_user_message_model_target_key_id'}, self.index_names('user_message_model', connection))
+
+            steps[8](connection)
+            self.assertEqual(['text', 'target_key'], self.column_names('user_message_search', connection))
+
+    def column_names(self, table_name, bind=None):
+        return [column['name'] for column in inspect(bind or self.engine).get_columns(table_name)]
+
+    def index_names(self, table_name, bind=None):
+        return {index['name'] for index in inspect(bind or self.engine).get_indexes(table_name)}
@@ -0,0 +1,201 @@
+import json
+import threading
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from test_message_api import app
+from message_api.notifications import NotificationHub
+
+
+class Hub(TestCase):
+
+    def test_subscription_gets_published_messages(self):
+        hub = NotificationHub()
+        with hub.subscribe('norbert') as subscription:
+            self.assertIsNone(subscription.wait(0, timeout=0))
+            subscription.caught_up(0)
+
+            threading.Timer(0.05, hub.publish, ('norbert', [(1, {'id': 1})])).start()
+            self.assertEqual([{'id': 1}], subscription.wait(0, timeout=5))
+            self.assertEqual([], subscription.wait(1, timeout=0))
+
+    def test_messages_of_other_users_are_not_delivered(self):
+        hub = NotificationHub()
+        with hub.subscribe('norbert') as subscription:
+            subscription.caught_up(0)
+            hub.publish('albert', [(1, {'id': 1})])
+            self.assertEqual([], subscription.wait(0, timeout=0.01))
+
+    def test_buffer_overflow_requires_catching_up(self):
+        hub = NotificationHub(buffer_size=2)
+        with hub.subscribe('norbert') as subscription:
+            subscription.caught_up(0)
+            hub.publish('norbert', [(1, {'id': 1}), (2, {'id': 2}), (3, {'id': 3})])
+
+            self.assertIsNone(subscription.wait(0, timeout=0))
+            self.assertEqual([{'id': 2}, {'id': 3}], subscription.wait(1, timeout=0))
+
+    def test_messages_dropped_before_catching_up_require_catching_up(self):
+        hub = NotificationHub(buffer_size=2)
+        with hub.subscribe('norbert') as subscription:
+            # published while the subscriber reads up to 1 from the database
+            hub.publish('norbert', [(2, {'id': 2}), (3, {'id': 3}), (4, {'id': 4})])
+            subscription.caught_up(1)
+
+            self.assertIsNone(subscription.wait(1, timeout=0))
+            self.assertEqual([{'id': 3}, {'id': 4}], subscription.wait(2, timeout=0))
+
+    def test_last_unsubscribe_of_partial_hub_forgets_the_mailbox_is_complete(self):
+        hub = NotificationHub(partial=True)
+        with hub.subscribe('norbert') as subscription:
+            subscription.caught_up(0)
+        with hub.subscribe('norbert') as subscription:
+            self.assertIsNone(subscription.wait(0, timeout=0))
+
+    def test_mailbox_stays_complete_across_subscriptions(self):
+        hub = NotificationHub()
+        with hub.subscribe('norbert') as subscription:
+            subscription.caught_up(0)
+        hub.publish('norbert', [(1, {'id': 1})])
+        with hub.subscribe('norbert') as subscription:
+            self.assertEqual([{'id': 1}], subscription.wait(0, timeout=0))
+
+    def test_unsubscribed_mailboxes_are_evicted(self):
+        hub = NotificationHub(max_users=1)
+        with hub.subscribe('norbert'):
+            with hub.subscribe('albert'):
+                self.assertEqual(2, hub.subscribers())
+        hub.subscribe('hubert').close()
+        self.assertEqual(0, hub.subscribers())
+
+
+class PushDelivery(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+        # ids start over with the database, start over with an empty hub too
+        from message_api import sqlalquemy_store
+        sqlalquemy_store._notification_hub = None
+
+    def post_message(self, text, target='norbert'):
+        res = self.client.post(f'/users/{target}/messages', data=json.dumps({'user_id': 'albert', 'text': text}))
+        return json.loads(res.data)
+
+    def test_long_poll_waits_for_new_message(self):
+        first = self.post_message('test message 1')
+
+        def post_later():
+            with app.app_context():
+                from message_api.sqlalquemy_store import add_message
+                add_message('albert', 'norbert', 'test message 2')
+
+        threading.Timer(0.1, post_later).start()
+        res = self.client.get('/users/norbert/messages/poll?wait=5')
+        self.assertEqual(200, res.status_code)
+        res = json.loads(res.data)
+        self.assertEqual(['test message 2'], [x['text'] for x in res['messages']])
+        self.assertEqual(res['messages'][0]['id'], res['last_id'])
+
+        # resume from an older id
+        res = json.loads(self.client.get(f'/users/norbert/messages/poll?after_id={first["id"] - 1}').data)
+        self.assertEqual(['test message 1', 'test message 2'], [x['text'] for x in res['messages']])
+
+    def test_long_poll_times_out_empty(self):
+        message = self.post_message('test message 1')
+
+        res = json.loads(self.client.get('/users/norbert/messages/poll?wait=0.05').data)
+        self.assertEqual([], res['messages'])
+        self.assertEqual(message['id'], res['last_id'])
+
+    def set_workers(self, workers):
+        self.addCleanup(app.config.__setitem__, 'WSGI_WORKERS', app.config['WSGI_WORKERS'])
+        app.config['WSGI_WORKERS'] = workers
+
+    def test_idle_long_polls_do_not_query_the_database(self):
+        self.set_workers(1)
+        message = self.post_message('test message 1')
+        poll = f'/users/norbert/messages/poll?after_id={message["id"]}&wait=0.01'
+        self.client.get(poll)
+
+        statements = []
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            engine = db.engine
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            for _ in range(3):
+                self.assertEqual([], json.loads(self.client.get(poll).data)['messages'])
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+        self.assertEqual([], statements)
+
+    def test_long_poll_timeout_finds_message_of_other_process(self):
+        self.set_workers(2)
+        message = self.post_message('test message 1')
+        from message_api import sqlalquemy_store
+        sqlalquemy_store._notification_hub = None
+
+        def post_elsewhere():
+            with app.app_context():
+                app.config['MESSAGES_NOTIFICATION_HUB'] = 'tests.test_notifications:isolated_hub'
+                try:
+                    sqlalquemy_store.add_message('albert', 'norbert', 'test message 2')
+                finally:
+                    app.config['MESSAGES_NOTIFICATION_HUB'] = 'memory'
+
+        with app.app_context():
+            subscription = sqlalquemy_store.subscribe_to_messages('norbert')
+        with subscription:
+            self.assertEqual([], self.wait(subscription, message['id'], 0))
+            post_elsewhere()
+            messages = self.wait(subscription, message['id'], 0.05)
+        self.assertEqual(['test message 2'], [x['text'] for x in messages])
+
+    def wait(self, subscription, after_id, timeout):
+        with app.app_context():
+            from message_api.sqlalquemy_store import wait_for_messages
+            return wait_for_messages(subscription, after_id, timeout)
+
+    def test_server_sent_events_resume_from_last_event_id(self):
+        first = self.post_message('test message 1')
+        self.post_message('test message 2')
+
+        keepalive = app.config['MESSAGES_SSE_KEEPALIVE']
+        app.config['MESSAGES_SSE_KEEPALIVE'] = 0.05
+        try:
+            res = self.client.get('/users/norbert/messages/events', headers={'Last-Event-ID': str(first['id'])})
+            self.assertEqual('text/event-stream', res.mimetype)
+            events = iter(res.response)
+            self.assertEqual(b'retry: 1000\n\n', next(events))
+
+            event = next(events).decode()
+            self.assertIn('event: message\n', event)
+            self.assertEqual('test message 2', json.loads(event.split('data: ')[1])['text'])
+
+            self.assertEqual(b': keepalive\n\n', next(events))
+
+            self.post_message('test message 3')
+            event = next(events).decode()
+            self.assertEqual('test message 3', json.loads(event.split('data: ')[1])['text'])
+            res.close()
+        finally:
+            app.config['MESSAGES_SSE_KEEPALIVE'] = keepalive
+
+    def test_fail_poll_with_not_valid_after_id(self):
+        self.assertEqual(400, self.client.get('/users/norbert/messages/poll?after_id=qwerty').status_code)
+
+
+def isolated_hub(config):
+    """The hub of another process, its messages don't reach the subscribers of this one."""
+    return NotificationHub()
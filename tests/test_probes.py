@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from unittest import TestCase
+
+from clock import Clock
+from test_message_api import app
+from message_api.probes import Prober
+
+
+class Probing(TestCase):
+
+    def test_results_expire(self):
+        clock = Clock()
+        started = threading.Event()
+
+        def probe():
+            started.wait(5)
+            return True, 'fine'
+
+        prober = Prober(app, {'probe': probe}, interval=5, ttl=15, clock=clock)
+        self.addCleanup(prober.close)
+        self.assertEqual((False, 'not probed yet'), prober.result('probe'))
+
+        # probed in the background
+        started.set()
+        deadline = time.monotonic() + 5
+        while not prober.result('probe')[0] and time.monotonic() < deadline:
+            time.sleep(0.001)
+        clock.now = 15
+        self.assertEqual((True, 'fine'), prober.result('probe'))
+
+        clock.now = 16
+        self.assertEqual((False, 'last probed 16 seconds ago'), prober.result('probe'))
+
+    def test_failing_probe(self):
+        prober = Prober(app, {'probe': lambda: 1 / 0}, interval=0)
+        passed, output = prober.result('probe')
+        self.assertFalse(passed)
+        self.assertEqual('division by zero', output)
+
+    def test_without_interval_polls_probe_once_results_expire(self):
+        clock = Clock()
+        calls = []
+        prober = Prober(app, {'probe': lambda: calls.append(1) or (True, 'fine')}, interval=0, ttl=15, clock=clock)
+
+        prober.result('probe')
+        prober.result('probe')
+        self.assertEqual(1, len(calls))
+
+        clock.now = 16
+        prober.result('probe')
+        self.assertEqual(2, len(calls))
+
+
+class HealthEndpoints(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def test_liveness(self):
+        res = self.client.get('/health/live')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('success', json.loads(res.data)['status'])
+
+    def test_readiness_checks_the_database(self):
+        with app.app_context():
+            from message_api.healthcheck_routes import _get_prober
+            _get_prober().run_once()
+
+        for uri in ('/health/ready', '/healthcheck'):
+            res = self.client.get(uri)
+            self.assertEqual(200, res.status_code)
+            results = {x['checker']: x for x in json.loads(res.data)['results']}
+            self.assertEqual({'database', 'database_pool', 'database_write', 'database_replicas'}, set(results))
+            self.assertTrue(all(x['passed'] for x in results.values()))
+            self.assertIn('primary', results['database']['output'])
+            self.assertIn('primary', results['database_write']['output'])
+
+    def test_not_ready_when_the_database_fails(self):
+        with app.app_context():
+            from message_api.healthcheck_routes import _get_prober
+            prober = _get_prober()
+            probe = prober.probes['database']
+            prober.probes['database'] = lambda: 1 / 0
+            self.addCleanup(prober.probes.__setitem__, 'database', probe)
+            prober.run_once()
+            self.addCleanup(prober.run_once)
+
+        res = self.client.get('/health/ready')
+        self.assertEqual(503, res.status_code)
+        self.assertEqual('failure', json.loads(res.data)['status'])
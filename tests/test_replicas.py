@@ -0,0 +1,108 @@
+import json
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from clock import Clock
+from test_message_api import app
+from message_api.replicas import ReplicaRouter
+
+
+class Router(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.router = ReplicaRouter(['replica 1', 'replica 2'], retry_after=30, read_after_write_window=5,
+                                    clock=self.clock)
+
+    def test_reads_go_round_robin(self):
+        self.assertEqual(['replica 1', 'replica 2'], self.router.replicas_for('norbert'))
+        self.assertEqual(['replica 2', 'replica 1'], self.router.replicas_for('norbert'))
+
+    def test_failed_replica_is_skipped_until_retry(self):
+        self.router.failed('replica 1')
+        self.assertEqual(['replica 2'], self.router.replicas_for('norbert'))
+        self.assertEqual(['replica 2'], self.router.replicas_for('norbert'))
+
+        self.router.failed('replica 2')
+        self.assertEqual([], self.router.replicas_for('norbert'))
+
+        self.clock.now = 30
+        self.assertEqual(2, len(self.router.replicas_for('norbert')))
+
+    def test_reads_stay_on_primary_after_write(self):
+        self.router.wrote('norbert')
+        self.assertEqual([], self.router.replicas_for('norbert'))
+        self.assertEqual(2, len(self.router.replicas_for('albert')))
+
+        self.clock.now = 5
+        self.assertEqual(2, len(self.router.replicas_for('norbert')))
+
+
+class ReadFromReplica(TestCase):
+    """The in memory test database is the primary, a SQLite file copied from it is the replica."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.replica_path = os.path.join(directory.name, 'replica.db')
+
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+        self.set_config(SQLALCHEMY_REPLICA_URIS=[f'sqlite:///{self.replica_path}'],
+                        DATABASE_READ_AFTER_WRITE_WINDOW=0)
+        self.replicate()
+
+    def set_config(self, **values):
+        for key, value in values.items():
+            self.addCleanup(app.config.__setitem__, key, app.config[key])
+            app.config[key] = value
+
+    def replicate(self):
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            primary = db.engine.raw_connection()
+            try:
+                with sqlite3.connect(self.replica_path) as replica:
+                    primary.connection.backup(replica)
+            finally:
+                primary.close()
+
+    def post_message(self, text, target='norbert'):
+        res = self.client.post(f'/users/{target}/messages', data=json.dumps({'user_id': 'albert', 'text': text}))
+        self.assertEqual(201, res.status_code)
+        return json.loads(res.data)
+
+    def get_messages(self, target='norbert'):
+        res = self.client.get(f'/users/{target}/messages?get_old_messages=true')
+        self.assertEqual(200, res.status_code)
+        return [message['text'] for message in json.loads(res.data)]
+
+    def test_listing_reads_replica(self):
+        self.post_message('test message 1')
+        self.assertEqual([], self.get_messages())
+
+        self.replicate()
+        self.assertEqual(['test message 1'], self.get_messages())
+
+    def test_read_after_write_stays_on_primary(self):
+        self.set_config(DATABASE_READ_AFTER_WRITE_WINDOW=60)
+
+        self.post_message('test message 1')
+        self.assertEqual(['test message 1'], self.get_messages())
+        # other mailboxes still read the replica
+        self.post_message('test message 2', target='albert')
+        self.assertEqual(['test message 2'], self.get_messages(target='albert'))
+        self.assertEqual([], self.get_messages(target='norbert_2'))
+
+    def test_unavailable_replica_falls_back_to_primary(self):
+        self.set_config(SQLALCHEMY_REPLICA_URIS=[f'sqlite:///{self.replica_path}.missing/replica.db'])
+
+        self.post_message('test message 1')
+        self.assertEqual(['test message 1'], self.get_messages())
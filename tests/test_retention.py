@@ -0,0 +1,149 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from test_message_api import app
+from message_api.retention import RetentionWorker, purge_options, start_retention
+
+
+class Purge(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def test_purge_messages_older_than_max_age(self):
+        self.post_message('old message')
+        time.sleep(0.01)
+        moment = datetime.utcnow()
+        time.sleep(0.01)
+        self.post_message('new message')
+
+        purged = self.purge(max_age=datetime.utcnow() - moment, batch_size=1)
+
+        self.assertEqual({'max_age': 1, 'max_per_user': 0, 'read_max_age': 0}, purged)
+        self.assertEqual(['new message'], self.get_messages())
+        self.assertEqual({'unread': 0, 'total': 1}, self.count_messages())
+
+    def test_purge_read_messages(self):
+        self.post_message('message 1')
+        self.post_message('message 2')
+        self.get_messages()
+        self.post_message('message 3')
+
+        self.assertEqual(2, self.purge(read_max_age=timedelta(0))['read_max_age'])
+
+        self.assertEqual(['message 3'], self.get_messages())
+        self.assertEqual({'unread': 0, 'total': 1}, self.count_messages())
+
+    def test_purge_oldest_messages_above_max_per_user(self):
+        for i in range(5):
+            self.post_message(f'message {i}')
+        self.post_message('message to jr', target='norbert_jr')
+
+        self.assertEqual(3, self.purge(max_per_user=2, batch_size=2)['max_per_user'])
+        self.assertEqual(0, self.purge(max_per_user=2)['max_per_user'])
+
+        self.assertEqual({'unread': 2, 'total': 2}, self.count_messages())
+        self.assertEqual(['message 3', 'message 4'], self.get_messages())
+        self.assertEqual(['message to jr'], self.get_messages('norbert_jr'))
+
+    def test_purged_messages_are_archived_to_a_table(self):
+        message = self.post_message('lunch on friday?')
+
+        self.purge(max_age=timedelta(0), archive='table')
+
+        with app.app_context():
+            from message_api.sqlalquemy_store import db, UserMessageArchiveModel
+            archived = db.session.execute(UserMessageArchiveModel.__table__.select()).fetchall()
+        self.assertEqual([(message['id'], 'albert', 'norbert', 'lunch on friday?')], [tuple(x)[:4] for x in archived])
+        res = self.client.get('/users/norbert/messages/search?q=lunch')
+        self.assertEqual([], json.loads(res.data))
+
+    def test_purged_messages_are_archived_to_ndjson(self):
+        messages = [self.post_message('message 1'), self.post_message('message 2')]
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        self.purge(max_age=timedelta(0), batch_size=1, archive='ndjson', archive_path=path)
+
+        with open(path) as archive:
+            self.assertEqual(messages, [json.loads(line) for line in archive])
+
+    def test_purge_options_from_config(self):
+        options = dict(app.config, RETENTION_MAX_AGE_DAYS=30, RETENTION_READ_MAX_AGE_DAYS=0)
+
+        self.assertEqual(timedelta(days=30), purge_options(options)['max_age'])
+        self.assertIsNone(purge_options(options)['read_max_age'])
+        self.assertIsNone(purge_options(options)['max_per_user'])
+
+    def purge(self, **options):
+        from message_api.sqlalquemy_store import purge_messages
+        with app.app_context():
+            return purge_messages(**options)
+
+    def post_message(self, text, target='norbert'):
+        res = self.client.post(f'/users/{target}/messages', data=json.dumps({'user_id': 'albert', 'text': text}))
+        self.assertEqual(201, res.status_code)
+        return json.loads(res.data)
+
+    def get_messages(self, target='norbert'):
+        res = self.client.get(f'/users/{target}/messages?get_old_messages=true')
+        return [message['text'] for message in json.loads(res.data)]
+
+    def count_messages(self):
+        return json.loads(self.client.get('/users/norbert/messages/count').data)
+
+
+class Worker(TestCase):
+
+    def test_purges_every_interval(self):
+        purged = threading.Semaphore(0)
+
+        def purge():
+            purged.release()
+            return {'max_age': 1}
+
+        worker = RetentionWorker(app, purge, lambda: 5, interval=0.01)
+        self.addCleanup(worker.close)
+
+        self.assertTrue(purged.acquire(timeout=5))
+        self.assertTrue(purged.acquire(timeout=5))
+        deadline = time.monotonic() + 5
+        while worker.lag is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({'max_age': 1}, worker.last_purged)
+        self.assertEqual(5, worker.lag)
+        self.assertGreaterEqual(worker.last_duration, 0)
+
+    def test_keeps_purging_after_a_failure(self):
+        calls = threading.Semaphore(0)
+
+        def purge():
+            calls.release()
+            raise RuntimeError('database is locked')
+
+        worker = RetentionWorker(app, purge, lambda: 0, interval=0.01)
+        self.addCleanup(worker.close)
+
+        with self.assertLogs(app.logger, 'ERROR'):
+            self.assertTrue(calls.acquire(timeout=5))
+            self.assertTrue(calls.acquire(timeout=5))
+        self.assertIsNone(worker.last_run)
+
+    def test_disabled_instance_does_not_purge(self):
+        config = {'RETENTION_MAX_AGE_DAYS': 30, 'RETENTION_INTERVAL': 3600, 'RETENTION_ENABLED': False}
+        for name, value in config.items():
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+
+        self.assertIsNone(start_retention(app))
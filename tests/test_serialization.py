@@ -0,0 +1,47 @@
+import json
+from unittest import TestCase, skipIf
+
+from test_message_api import app
+from message_api import representations
+
+
+class Serialization(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def test_fast_path_matches_marshmallow(self):
+        with app.app_context():
+            from message_api.sqlalquemy_store import (
+                db, add_message, serialize_messages, user_messages_schema, UserMessageModel, _message_columns)
+
+            for i in range(3):
+                add_message('albert', 'norbert', f'test message {i}')
+
+            messages = UserMessageModel.query.order_by(UserMessageModel.id).all()
+            rows = db.session.query(*_message_columns()).order_by(UserMessageModel.id).all()
+
+            expected = user_messages_schema.dump(messages)
+            self.assertEqual([list(x.items()) for x in expected], [list(x.items()) for x in serialize_messages(rows)])
+            self.assertEqual(json.dumps(expected), json.dumps(serialize_messages(rows)))
+
+    @skipIf(representations.orjson is None, 'orjson is not installed')
+    def test_orjson_encoder(self):
+        self.client.post('/users/norbert/messages', data=json.dumps({'user_id': 'albert', 'text': 'test message'}))
+
+        app.config['MESSAGES_JSON_ENCODER'] = 'orjson'
+        app.debug = False
+        try:
+            res = self.client.get('/users/norbert/messages?get_old_messages=true')
+        finally:
+            app.config['MESSAGES_JSON_ENCODER'] = 'json'
+            app.debug = True
+
+        self.assertEqual(200, res.status_code)
+        self.assertNotIn(b', ', res.data)
+        self.assertEqual('test message', json.loads(res.data)[0]['text'])
@@ -0,0 +1,137 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from test_message_api import app
+from message_api.shards import HashRing
+
+
+class Ring(TestCase):
+
+    def test_keys_stay_on_their_shard(self):
+        ring = HashRing(['0', '1', '2'])
+        self.assertEqual([ring.get(f'user_{i}') for i in range(100)],
+                         [HashRing(['2', '1', '0']).get(f'user_{i}') for i in range(100)])
+        self.assertEqual({'0', '1', '2'}, {ring.get(f'user_{i}') for i in range(100)})
+
+    def test_new_shard_only_takes_keys(self):
+        users = [f'user_{i}' for i in range(1000)]
+        before = HashRing(['0', '1', '2'])
+        after = HashRing(['0', '1', '2', '3'])
+
+        moved = [user for user in users if before.get(user) != after.get(user)]
+        self.assertTrue(all(after.get(user) == '3' for user in moved))
+        self.assertLess(len(moved), len(users) / 2)
+
+
+class ShardedMailboxes(TestCase):
+    """Two SQLite files as shards, the in memory test database is the one before sharding."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.shard_uris = {str(i): f'sqlite:///{os.path.join(directory.name, f"shard_{i}.db")}' for i in range(2)}
+
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+        self.addCleanup(self.set_shards, {})
+        self.addCleanup(self.dispose_shards)
+        self.set_shards(self.shard_uris)
+
+    def set_shards(self, shard_uris):
+        app.config['SQLALCHEMY_SHARDS'] = shard_uris
+
+    def dispose_shards(self):
+        from message_api import sqlalquemy_store
+        if sqlalquemy_store._shard_router is not None:
+            for shard in sqlalquemy_store._shard_router[1].shards:
+                shard.engine.dispose()
+            sqlalquemy_store._shard_router = None
+
+    def post_message(self, text, target):
+        res = self.client.post(f'/users/{target}/messages', data=json.dumps({'user_id': 'albert', 'text': text}))
+        self.assertEqual(201, res.status_code)
+        return json.loads(res.data)
+
+    def get_messages(self, target, get_old_messages=False):
+        res = self.client.get(f'/users/{target}/messages?get_old_messages={str(get_old_messages).lower()}')
+        self.assertEqual(200, res.status_code)
+        return [message['text'] for message in json.loads(res.data)]
+
+    def count_messages(self, shard_number):
+        engine = create_engine(self.shard_uris[shard_number])
+        try:
+            return dict(engine.execute(
+                'SELECT u.user_id, COUNT(*) FROM user_message_model m JOIN user_model u ON u.id = m.target_key'
+                ' GROUP BY u.user_id').fetchall())
+        finally:
+            engine.dispose()
+
+    def count_indexed(self, shard_number):
+        engine = create_engine(self.shard_uris[shard_number])
+        try:
+            return engine.execute('SELECT COUNT(*) FROM user_message_search').scalar()
+        finally:
+            engine.dispose()
+
+    def test_mailboxes_are_spread_over_shards(self):
+        users = [f'user_{i}' for i in range(20)]
+        ids = [self.post_message(f'message to {user}', user)['id'] for user in users]
+
+        self.assertEqual(len(ids), len(set(ids)))
+        shard_users = [set(self.count_messages(number)) for number in self.shard_uris]
+        self.assertTrue(all(shard_users))
+        self.assertEqual(set(users), shard_users[0] | shard_users[1])
+
+        for user in users:
+            self.assertEqual([f'message to {user}'], self.get_messages(user))
+            self.assertEqual([], self.get_messages(user))
+
+    def test_bulk_post_and_delete_on_shards(self):
+        res = self.client.post('/messages/bulk', data=json.dumps([
+            {'sender': 'albert', 'target': f'user_{i % 5}', 'text': f'message {i}'} for i in range(20)]))
+        self.assertEqual(201, res.status_code)
+        created = json.loads(res.data)['created']
+        self.assertEqual(20, len({message['id'] for message in created}))
+
+        message_ids = [created[0]['id'], created[5]['id']]
+        res = self.client.delete('/users/user_0/messages', data=json.dumps(message_ids))
+        self.assertEqual({'deleted_count': 2}, json.loads(res.data))
+        self.assertEqual(['message 10', 'message 15'], self.get_messages('user_0'))
+
+    def test_rebalance_moves_mailboxes_with_their_read_marker(self):
+        from message_api.sqlalquemy_store import rebalance_shards
+
+        users = [f'user_{i}' for i in range(20)]
+        # every mailbox starts on the database before sharding
+        self.set_shards({})
+        for user in users:
+            self.post_message(f'message 1 to {user}', user)
+            self.get_messages(user)
+            self.post_message(f'message 2 to {user}', user)
+
+        self.set_shards(self.shard_uris)
+        with app.app_context():
+            self.assertEqual(len(users), rebalance_shards(batch_size=1))
+            self.assertEqual(0, rebalance_shards())
+
+        for user in users:
+            res = self.client.get(f'/users/{user}/messages/count')
+            self.assertEqual({'unread': 1, 'total': 2}, json.loads(res.data))
+            self.assertEqual([f'message 2 to {user}'], self.get_messages(user))
+            self.assertEqual([f'message 1 to {user}', f'message 2 to {user}'], self.get_messages(user, True))
+            res = self.client.get(f'/users/{user}/messages/search?q=message')
+            self.assertEqual({f'message 1 to {user}', f'message 2 to {user}'},
+                             {message['text'] for message in json.loads(res.data)})
+
+        self.assertEqual(2 * len(users), sum(sum(self.count_messages(number).values()) for number in self.shard_uris))
+        # moved messages are indexed on their shard only
+        self.assertEqual(2 * len(users), sum(self.count_indexed(number) for number in self.shard_uris))
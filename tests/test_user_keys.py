@@ -0,0 +1,103 @@
+import json
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from test_message_api import app
+from message_api.user_keys import UserKeyCache
+
+
+class KeyCache(TestCase):
+
+    def test_least_recently_used_keys_are_evicted(self):
+        user_key_cache = UserKeyCache(max_size=2)
+        user_key_cache.set('sqlite://', 'albert', 1)
+        user_key_cache.set('sqlite://', 'norbert', 2)
+        self.assertEqual(1, user_key_cache.get('sqlite://', 'albert'))
+
+        user_key_cache.set('sqlite://', 'robert', 3)
+
+        self.assertIsNone(user_key_cache.get('sqlite://', 'norbert'))
+        self.assertEqual(1, user_key_cache.get('sqlite://', 'albert'))
+        self.assertEqual(2, len(user_key_cache))
+
+    def test_keys_are_per_database(self):
+        user_key_cache = UserKeyCache(max_size=10)
+        user_key_cache.set('sqlite:///shard_0.db', 'albert', 1)
+
+        self.assertIsNone(user_key_cache.get('sqlite:///shard_1.db', 'albert'))
+
+
+class InternedUserIds(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def test_messages_reference_users_by_key(self):
+        message = self.post_message('test message')
+
+        with app.app_context():
+            from message_api.sqlalquemy_store import db, UserModel, UserMessageModel
+            keys = dict(db.session.query(UserModel.user_id, UserModel.id).all())
+            row = db.session.query(UserMessageModel.sender_key, UserMessageModel.target_key).one()
+        self.assertEqual((keys['albert'], keys['norbert']), tuple(row))
+        self.assertEqual(('albert', 'norbert'), (message['sender'], message['target']))
+
+    def test_cached_key_saves_a_query(self):
+        self.post_message('test message')
+        # both reads find the read marker past the message
+        self.get_messages()
+        with app.app_context():
+            from message_api.sqlalquemy_store import _get_user_key_cache
+            _get_user_key_cache().clear()
+
+        cold = self.count_statements(self.get_messages)
+        warm = self.count_statements(self.get_messages)
+
+        self.assertEqual(cold - 1, warm)
+
+    def test_unknown_user_has_no_messages(self):
+        self.post_message('test message')
+
+        self.assertEqual([], self.get_messages('robert'))
+        res = self.client.delete('/users/robert/messages', data=json.dumps([1]))
+        self.assertEqual({'deleted_count': 0}, json.loads(res.data))
+
+    def test_keys_are_forgotten_with_the_table(self):
+        self.post_message('test message')
+        self.get_messages()
+        with app.app_context():
+            from message_api.sqlalquemy_store import db, _get_user_key_cache
+            db.drop_all()
+            self.assertEqual(0, len(_get_user_key_cache()))
+
+    def post_message(self, text):
+        res = self.client.post('/users/norbert/messages', data=json.dumps({'user_id': 'albert', 'text': text}))
+        self.assertEqual(201, res.status_code)
+        return json.loads(res.data)
+
+    def get_messages(self, target='norbert'):
+        res = self.client.get(f'/users/{target}/messages?get_old_messages=true')
+        self.assertEqual(200, res.status_code)
+        return json.loads(res.data)
+
+    def count_statements(self, func):
+        statements = []
+        with app.app_context():
+            from message_api.sqlalquemy_store import db
+            engine = db.engine
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            func()
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+        return len(statements)
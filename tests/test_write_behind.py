@@ -0,0 +1,89 @@
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from message_api.write_behind import WriteBehindQueue, WriteBehindError, QueueFull, StoreTimeout
+
+
+class WriteBehind(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def flush(self, messages):
+        self.release.wait()
+        self.batches.append(messages)
+        return [None if message == 'fail' else {'text': message} for message in messages]
+
+    def make_queue(self, **kwargs):
+        write_behind_queue = WriteBehindQueue(Flask('message_api'), self.flush, **kwargs)
+        self.addCleanup(write_behind_queue.close)
+        return write_behind_queue
+
+    def test_messages_are_stored_in_groups(self):
+        self.release.clear()
+        write_behind_queue = self.make_queue(batch_size=3, max_linger=0.05)
+
+        # the first group is taken while the flusher is blocked
+        pending = [write_behind_queue.submit('message 0')]
+        pending += [write_behind_queue.submit(f'message {i}') for i in range(1, 5)]
+        self.release.set()
+
+        self.assertEqual([{'text': f'message {i}'} for i in range(5)], [x.result(timeout=1) for x in pending])
+        self.assertTrue(all(len(batch) <= 3 for batch in self.batches))
+        self.assertLess(len(self.batches), 5)
+
+    def test_failed_message_raises_on_result(self):
+        write_behind_queue = self.make_queue()
+
+        with self.assertRaises(WriteBehindError):
+            write_behind_queue.submit('fail').result(timeout=1)
+
+    def test_full_queue_rejects_messages(self):
+        self.release.clear()
+        write_behind_queue = self.make_queue(max_size=1, batch_size=1, enqueue_timeout=0.01)
+
+        write_behind_queue.submit('message 1')
+        with self.assertRaises(QueueFull):
+            # one message is being flushed and one waits on the queue
+            write_behind_queue.submit('message 2')
+            write_behind_queue.submit('message 3')
+
+        self.release.set()
+        write_behind_queue.join()
+
+    def test_timed_out_message_is_still_stored(self):
+        self.release.clear()
+        write_behind_queue = self.make_queue()
+        pending = write_behind_queue.submit('message 1')
+
+        with self.assertRaises(StoreTimeout):
+            pending.result(timeout=0.01)
+        self.release.set()
+        self.assertEqual({'text': 'message 1'}, pending.result(timeout=1))
+
+    def test_close_gives_up_after_timeout_when_stuck(self):
+        self.release.clear()
+        write_behind_queue = self.make_queue(max_size=1, batch_size=1)
+        write_behind_queue.submit('message 1')
+        write_behind_queue.submit('message 2')
+
+        started = time.monotonic()
+        write_behind_queue.close(timeout=0.05)
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.release.set()
+
+    def test_close_stores_queued_messages(self):
+        write_behind_queue = self.make_queue(max_linger=1)
+        pending = write_behind_queue.submit('message 1')
+
+        write_behind_queue.close()
+
+        self.assertEqual({'text': 'message 1'}, pending.result(timeout=0))
+        with self.assertRaises(WriteBehindError):
+            write_behind_queue.submit('message 2')
@@ -0,0 +1,5 @@
+from os import environ
+
+from message_api import create_app
+
+app = create_app(environ.get('CONFIG_NAME', 'production'))